@@ -0,0 +1,175 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+sys.path.append(project_dir)
+
+import io
+import json
+import argparse
+import datetime
+import platform
+import subprocess
+from timeit import default_timer as timer
+
+import dotenv
+from sqlalchemy import text
+
+from src.data.synthetic_waze import generate_feed
+from src.data.database_func import database_dict_from_env
+from src.data.fingerprint import benchmark as fingerprint_benchmark
+from src.data.store_data_file import (connect_database, tab_raw_data, tab_raw_data_chunks, tab_jams, tab_alerts,
+                                      tab_irregularities, bulk_store_raw_data, store_raw_data_by_row)
+
+dotenv_path = os.path.join(project_dir, '.env')
+dotenv.load_dotenv(dotenv_path)
+
+def best_of(func, repeat):
+    """
+    Run func "repeat" times and return (best time in seconds, last result).
+    """
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        result = func()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def result_entry(name, seconds, items, unit):
+    return {"name": name,
+            "seconds": seconds,
+            "items": items,
+            "unit": unit,
+            "items_per_second": items / seconds if seconds > 0 else None,
+           }
+
+def benchmark_tabulation(feed_bytes, repeat=3):
+    results = []
+    n_files = len(json.loads(feed_bytes))
+    mb = len(feed_bytes) / 1e6
+
+    seconds, raw_data = best_of(lambda: tab_raw_data("benchmark", {"Body": io.BytesIO(feed_bytes)}), repeat)
+    results.append(result_entry("tab_raw_data", seconds, n_files, "data_files"))
+    results.append(result_entry("tab_raw_data_MB", seconds, mb, "MB"))
+
+    seconds, _ = best_of(lambda: sum(len(c) for c in tab_raw_data_chunks("benchmark", {"Body": io.BytesIO(feed_bytes)})),
+                         repeat)
+    results.append(result_entry("tab_raw_data_chunks", seconds, n_files, "data_files"))
+
+    for tab_func in [tab_jams, tab_alerts, tab_irregularities]:
+        seconds, df = best_of(lambda: tab_func(raw_data), repeat)
+        results.append(result_entry(tab_func.__name__, seconds, 0 if df is None else len(df), "rows"))
+
+    return results, raw_data
+
+def benchmark_hashing(feed, repeat=3):
+    hashing = fingerprint_benchmark(feed, repeat=repeat)
+    return [result_entry("hash_" + r.method, r.seconds, len(feed), "data_files") for r in hashing.itertuples()]
+
+def delete_data_files(meta, json_hashes):
+    params = {"hashes": tuple(json_hashes)}
+    with meta.bind.begin() as con:
+        for table in ["jams", "alerts", "irregularities"]:
+            con.execute(text("DELETE FROM waze." + table + " WHERE datafile_id IN "
+                             "(SELECT id FROM waze.data_files WHERE json_hash IN :hashes)"), params)
+        con.execute(text("DELETE FROM waze.data_files WHERE json_hash IN :hashes"), params)
+
+def benchmark_database(meta, raw_data, row_mode=False):
+    """
+    Write rates against a scratch database. Rows written by the benchmark are deleted afterwards.
+    """
+    results = []
+    json_hashes = raw_data["json_hash"].tolist()
+    delete_data_files(meta, json_hashes)
+    try:
+        start = timer()
+        stats = bulk_store_raw_data(meta, raw_data)
+        results.append(result_entry("db_bulk_total", timer() - start, sum(n for n, _ in stats.values()), "rows"))
+        for table, (n, seconds) in stats.items():
+            results.append(result_entry("db_bulk_" + table, seconds, n, "rows"))
+        delete_data_files(meta, json_hashes)
+
+        if row_mode:
+            start = timer()
+            store_raw_data_by_row(meta, "benchmark", raw_data)
+            results.append(result_entry("db_row_by_row", timer() - start, len(raw_data), "data_files"))
+    finally:
+        delete_data_files(meta, json_hashes)
+
+    return results
+
+def compare_results(results, baseline, tolerance):
+    """
+    Print the throughput of each benchmark against a previous results file.
+    Returns the names of the benchmarks that got slower by more than "tolerance" (a fraction).
+    """
+    previous = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        old = previous.get(r["name"])
+        if not old or not old["items_per_second"] or not r["items_per_second"]:
+            continue
+        ratio = r["items_per_second"] / old["items_per_second"]
+        print(r["name"] + ":", str(round(ratio, 2)) + "x the baseline throughput.")
+        if ratio < 1 - tolerance:
+            regressions.append(r["name"])
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=project_dir).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Waze ingestion path on a synthetic feed")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--minutes', type=int, default=60, help="Number of one minute snapshots in the feed")
+    parser.add_argument('--jams', type=int, default=300, help="Mean number of jams per minute")
+    parser.add_argument('--alerts', type=int, default=150, help="Mean number of alerts per minute")
+    parser.add_argument('--irregularities', type=int, default=20, help="Mean number of irregularities per minute")
+    parser.add_argument('--linelength', type=int, default=20, help="Mean number of points per line")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--database', action='store_true',
+                        help="Also measure writes against the database in .env. Use a scratch database.")
+    parser.add_argument('--rowmode', action='store_true', help="With --database, also time the row by row path")
+    parser.add_argument('--output', type=str, default="benchmark_ingestion.json")
+    parser.add_argument('--compare', type=str, help="Previous results file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Slowdown, as a fraction of the baseline throughput, reported as a regression")
+    args = parser.parse_args()
+
+    params = {"seed": args.seed, "minutes": args.minutes, "jams": args.jams, "alerts": args.alerts,
+              "irregularities": args.irregularities, "line_length": args.linelength, "repeat": args.repeat}
+    feed = generate_feed(args.seed, args.minutes, jams=args.jams, alerts=args.alerts,
+                         irregularities=args.irregularities, line_length=args.linelength)
+    feed_bytes = json.dumps(feed).encode()
+
+    results, raw_data = benchmark_tabulation(feed_bytes, args.repeat)
+    results += benchmark_hashing(feed, args.repeat)
+
+    if args.database:
+        DATABASE = database_dict_from_env()
+        meta = connect_database(DATABASE)
+        results += benchmark_database(meta, raw_data, args.rowmode)
+
+    for r in results:
+        print(r["name"] + ":", str(round(r["items_per_second"] or 0, 1)), r["unit"] + "/s",
+              "(" + str(round(r["seconds"], 3)), "s)")
+
+    output = {"date": datetime.datetime.now().isoformat(),
+              "git_revision": git_revision(),
+              "python": platform.python_version(),
+              "params": params,
+              "results": results,
+             }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("Results written to", args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:", ", ".join(regressions))
+            sys.exit(1)
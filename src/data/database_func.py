@@ -0,0 +1,134 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+sys.path.append(project_dir)
+
+import pickle
+import hashlib
+
+from sqlalchemy import MetaData, create_engine, text
+from sqlalchemy.engine.url import URL
+
+SCHEMA_CACHE_DIR = os.path.join(project_dir, "data", "interim", "schema_cache")
+
+#Engines (and their connection pools) shared by every connect_database call of the process
+_engines = {}
+
+def database_dict_from_env():
+    return {
+        'drivername': os.environ.get("db_drivername"),
+        'host': os.environ.get("db_host"),
+        'port': os.environ.get("db_port"),
+        'username': os.environ.get("db_username"),
+        'password': os.environ.get("db_password"),
+        'database': os.environ.get("db_database"),
+    }
+
+def get_engine(database_dict, pool_size=5, max_overflow=10, pool_recycle=3600, pool_pre_ping=True):
+    """
+    One engine per database and pool configuration: scripts and functions that connect to the same
+    database share its connection pool instead of opening new connections.
+    """
+    db_url = URL(**database_dict)
+    key = (str(db_url), pool_size, max_overflow, pool_recycle, pool_pre_ping)
+    if key not in _engines:
+        if db_url.drivername.startswith("sqlite"):
+            _engines[key] = create_engine(db_url)
+        else:
+            _engines[key] = create_engine(db_url, pool_size=pool_size, max_overflow=max_overflow,
+                                          pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
+    return _engines[key]
+
+def dispose_engines():
+    """
+    Close every pooled connection of the process.
+    """
+    for engine in _engines.values():
+        engine.dispose()
+    _engines.clear()
+
+def reset_engines():
+    """
+    Forget the engines inherited from the parent process, without closing their connections (the parent
+    still uses them). Call it first thing in child processes.
+    """
+    _engines.clear()
+
+def schema_version(engine, schemas):
+    """
+    Hash of the catalog entries that reflection reads for "schemas" (None is the default schema):
+    columns, constraints and indexes. It changes whenever a table is created, dropped or altered.
+    """
+    if engine.dialect.name == "sqlite":
+        rows = engine.execute(text("SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY type, name"))
+        return hashlib.sha1(repr([tuple(r) for r in rows]).encode()).hexdigest()
+
+    names = [s if s is not None else "public" for s in schemas]
+    params = {"schemas": tuple(names)}
+    queries = ["""SELECT table_schema, table_name, column_name, ordinal_position, data_type, is_nullable,
+                         column_default
+                  FROM information_schema.columns WHERE table_schema IN :schemas
+                  ORDER BY table_schema, table_name, ordinal_position""",
+               """SELECT tc.table_schema, tc.table_name, tc.constraint_name, tc.constraint_type, kcu.column_name
+                  FROM information_schema.table_constraints tc
+                  LEFT JOIN information_schema.key_column_usage kcu
+                         ON tc.constraint_schema = kcu.constraint_schema AND tc.constraint_name = kcu.constraint_name
+                  WHERE tc.table_schema IN :schemas
+                  ORDER BY tc.table_schema, tc.table_name, tc.constraint_name, kcu.column_name""",
+               """SELECT schemaname, tablename, indexname, indexdef FROM pg_indexes WHERE schemaname IN :schemas
+                  ORDER BY schemaname, tablename, indexname"""]
+    digest = hashlib.sha1()
+    for query in queries:
+        for row in engine.execute(text(query), params):
+            digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
+def load_metadata(engine, schemas, cache_dir=SCHEMA_CACHE_DIR):
+    """
+    MetaData bound to "engine" with the tables of "schemas", unpickled from a snapshot when the schema
+    version still matches, or reflected from the database (refreshing the snapshot) otherwise.
+    """
+    version = schema_version(engine, schemas)
+    url = engine.url
+    name = hashlib.sha1(repr((url.drivername, url.host, url.port, url.database,
+                              sorted(str(s) for s in schemas))).encode()).hexdigest()
+    path = os.path.join(cache_dir, "metadata_" + name + ".pickle") if cache_dir else None
+
+    snapshot = None
+    if path and os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                cached = pickle.load(f)
+            if cached["version"] == version:
+                snapshot = cached["meta"]
+        except Exception as e:
+            print("Ignoring unreadable schema cache " + path + ":", repr(e))
+
+    if snapshot is None:
+        snapshot = MetaData()
+        for schema in schemas:
+            snapshot.reflect(bind=engine, schema=schema)
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = path + "." + str(os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump({"version": version, "meta": snapshot}, f)
+            os.replace(tmp_path, path)
+
+    snapshot.bind = engine
+    return snapshot
+
+def connect_database(database_dict, schemas=None, cache_dir=SCHEMA_CACHE_DIR, **pool_args):
+    """
+    MetaData bound to the shared engine of the database. With "schemas" (e.g. [None, "waze"],
+    None being the default schema) the tables are loaded with load_metadata.
+    Extra keyword arguments (pool_size, max_overflow, ...) go to get_engine.
+    """
+    engine = get_engine(database_dict, **pool_args)
+    if schemas:
+        return load_metadata(engine, schemas, cache_dir)
+
+    meta = MetaData()
+    meta.bind = engine
+
+    return meta
@@ -0,0 +1,154 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+sys.path.append(project_dir)
+
+import json
+import hashlib
+import argparse
+from timeit import default_timer as timer
+
+import pandas as pd
+
+AJI_TYPES = ("jams", "alerts", "irregularities")
+
+def encode(value):
+    return json.dumps(value, sort_keys=True)
+
+def canonical_record(rec, aji_types=AJI_TYPES):
+    """
+    Serialize a data file and its jams, alerts and irregularities with one json.dumps per object.
+    Returns (rec_string, aji_strings), where rec_string is json.dumps(rec, sort_keys=True)
+    and aji_strings[aji_type] lists json.dumps(dict(aji, rootStartTime=rec["startTimeMillis"]), sort_keys=True)
+    for every object of that type. The record is not modified.
+
+    Each child is serialized once with its rootStartTime, and the data file string is assembled from
+    those strings with the rootStartTime member cut out, instead of encoding every child a second time.
+    """
+    root_key = "rootStartTime"
+    root_start_time = rec.get("startTimeMillis")
+    root_member = encode(root_key) + ": " + encode(root_start_time)
+
+    members = []
+    aji_strings = {}
+    for key in sorted(rec):
+        value = rec[key]
+        if key in aji_types and type(value) is list and all(type(aji) is dict for aji in value):
+            plain = []
+            rooted = []
+            for aji in value:
+                rooted_string = encode(dict(aji, rootStartTime=root_start_time))
+                if (root_key not in aji) and (rooted_string.count(root_member) == 1):
+                    if len(aji) == 0:
+                        plain_string = "{}"
+                    elif rooted_string.startswith("{" + root_member):
+                        plain_string = rooted_string.replace(root_member + ", ", "", 1)
+                    else:
+                        plain_string = rooted_string.replace(", " + root_member, "", 1)
+                else:
+                    plain_string = encode(aji)
+                plain.append(plain_string)
+                rooted.append(rooted_string)
+            aji_strings[key] = rooted
+            members.append(encode(key) + ": [" + ", ".join(plain) + "]")
+        else:
+            members.append(encode(key) + ": " + encode(value))
+
+    return "{" + ", ".join(members) + "}", aji_strings
+
+def sha1_hexdigest(string):
+    return hashlib.sha1(string.encode()).hexdigest()
+
+def blake2b_hexdigest(string):
+    return hashlib.blake2b(string.encode(), digest_size=20).hexdigest()
+
+def xxh128_hexdigest(string):
+    import xxhash
+    return xxhash.xxh128_hexdigest(string.encode())
+
+DIGESTS = {"sha1": sha1_hexdigest,
+           "blake2b": blake2b_hexdigest,
+           "xxh128": xxh128_hexdigest,
+          }
+
+def get_hasher(digest="sha1"):
+    """
+    String -> hex digest function. "sha1" is the digest of every hash already stored in the database.
+    "blake2b" (20 bytes) and "xxh128" (non-cryptographic, needs the xxhash package) are faster but produce
+    different hashes, so they are only meant for deduplication on a database filled with the same digest.
+    """
+    if digest not in DIGESTS:
+        raise ValueError("digest must be one of " + ", ".join(DIGESTS))
+    if digest == "xxh128":
+        import xxhash
+    return DIGESTS[digest]
+
+def legacy_fingerprint(rec, hasher=sha1_hexdigest):
+    """
+    Hashes as computed before canonical_record: the data file and every child are serialized separately.
+    """
+    rec_hash = hasher(json.dumps(rec, sort_keys=True))
+    aji_hashes = {}
+    for aji_type in AJI_TYPES:
+        if type(rec.get(aji_type)) is list:
+            aji_hashes[aji_type] = [hasher(json.dumps(dict(aji, rootStartTime=rec["startTimeMillis"]), sort_keys=True))
+                                    for aji in rec[aji_type]]
+    return rec_hash, aji_hashes
+
+def fingerprint(rec, hasher=sha1_hexdigest):
+    rec_string, aji_strings = canonical_record(rec)
+    aji_hashes = {aji_type: [hasher(s) for s in strings] for aji_type, strings in aji_strings.items()}
+    return hasher(rec_string), aji_hashes
+
+def benchmark(rec_list, digests=("sha1", "blake2b", "xxh128"), repeat=3):
+    """
+    Time the legacy serialization (sha1 only) against canonical_record with each digest.
+    Returns a DataFrame with the best time of "repeat" runs per method.
+    """
+    size = sum(len(json.dumps(rec)) for rec in rec_list) / 1e6
+    methods = [("legacy_sha1", lambda rec: legacy_fingerprint(rec))]
+    for digest in digests:
+        try:
+            hasher = get_hasher(digest)
+        except ImportError:
+            print("Skipping", digest + ": package not installed.")
+            continue
+        methods.append(("canonical_" + digest, lambda rec, hasher=hasher: fingerprint(rec, hasher)))
+
+    results = []
+    for name, func in methods:
+        best = None
+        for _ in range(repeat):
+            start = timer()
+            for rec in rec_list:
+                func(rec)
+            elapsed = timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({"method": name,
+                        "seconds": best,
+                        "records_per_second": len(rec_list) / best,
+                        "MB_per_second": size / best,
+                       })
+
+    return pd.DataFrame(results, columns=["method", "seconds", "records_per_second", "MB_per_second"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark data file fingerprinting")
+    parser.add_argument('--datafile', type=str,
+                        help="JSON data file (a list of records) to benchmark on. Defaults to synthetic snapshots.")
+    parser.add_argument('--records', type=int, default=60, help="Number of synthetic records")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.datafile:
+        with open(args.datafile) as f:
+            rec_list = json.load(f)
+    else:
+        from src.data.synthetic_waze import generate_feed
+        rec_list = generate_feed(minutes=args.records)
+
+    for rec in rec_list:
+        if legacy_fingerprint(rec) != fingerprint(rec):
+            raise Exception("canonical_record hashes differ from the legacy ones.")
+
+    print(benchmark(rec_list, repeat=args.repeat).to_string(index=False))
@@ -7,71 +7,146 @@ dotenv_path = os.path.join(project_dir, '.env')
 dotenv.load_dotenv(dotenv_path)
 
 import json
-from bson.json_util import dumps
-import math
+from bson.json_util import dumps, loads
+from bson.objectid import ObjectId
 from timeit import default_timer as timer
 import argparse
 
-from pymongo import MongoClient, DESCENDING, ASCENDING
-from processing_func import collect_records
-
-parser = argparse.ArgumentParser(description="Collect Waze's raw data")
-parser.add_argument('--batchsize', type=int, help="Size of download batches")
-parser.add_argument('--update', type=bool, nargs='?', const=False,
-                    help="""If true, delete all documents and download them again.
-                    If false, continue from the last document""")
-
-args = parser.parse_args()
-if args.batchsize:
-	batch_size = args.batchsize
-else:
-	batch_size = 200
-
-update = args.update
-
-all_files = os.listdir(project_dir+"/data/raw/")
-all_files = [file for file in all_files if "wazerawdata" in file]
-all_files.sort()
-
-num_docs = 0
-if update:
-    for file in all_files:
-        os.remove(project_dir + "/data/raw/" + file)
-else:
-    if all_files[-1].split("_")[-2] == all_files[-1].split("_")[-4]:
-        os.remove(project_dir + "/data/raw/" + all_files[-1])
-    num_docs = int(all_files[-1].split("_")[-4])
-
-
-#MongoDB Connection
-uri = os.environ.get("mongo_uri")
-client = MongoClient(uri)
-db = client.ccp
-collection = db.ccp_collection
-
-#Divide the code by batches
-total_rows = collection.count()
-number_batches = math.ceil(total_rows / batch_size)
-width = len(str(total_rows))
-
-while num_docs < total_rows:
-    start = timer()
-    #Fetch documents
-    records = list(collection.find({}, skip=(num_docs), limit=batch_size, sort=[("_id", ASCENDING)]))
-    now_processed = num_docs + len(records)
-
-    with open(project_dir+"/data/raw/wazerawdata_" + str(num_docs).zfill(width) +
-             "_to_" + str(now_processed).zfill(width) + "_of_" + str(total_rows) + 
-             "_.txt", 'w') as outfile:
-        json_record = dumps(records)
-        json.dump(json_record, outfile)
-
-    end = timer()
-    duration = str(round(end - start))
-    print(str(now_processed), "rows of", str(total_rows) + ", took", duration, "s to be successfully stored.")
-    num_docs = now_processed
-
-
-
-
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import CursorNotFound, AutoReconnect
+
+from src.data.raw_archive import write_archive_file, read_index
+
+def count_documents(collection):
+    if hasattr(collection, "estimated_document_count"):
+        return collection.estimated_document_count()
+    return collection.count()
+
+def read_checkpoint(path):
+    """
+    Returns (last _id exported, number of documents exported), or (None, 0) if there is no checkpoint.
+    """
+    if not os.path.exists(path):
+        return None, 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    return ObjectId(checkpoint["last_id"]), checkpoint["documents"]
+
+def write_checkpoint(path, last_id, num_docs):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"last_id": str(last_id), "documents": num_docs}, f)
+    os.replace(tmp_path, path)
+
+def raw_files(out_dir):
+    """
+    Files in the old layout, a JSON string holding the JSON list of records.
+    """
+    all_files = [file for file in os.listdir(out_dir) if "wazerawdata" in file and file.endswith("_.txt")]
+    all_files.sort()
+    return all_files
+
+def checkpoint_from_files(out_dir):
+    """
+    Resume point of directories exported before checkpoints existed: the _id of the last document
+    in the last archive file (or in the last file of the old layout), and the number of documents up to it.
+    """
+    index = read_index(out_dir)
+    if len(index):
+        return ObjectId(index["last_id"].iloc[-1]), int(index["n_records"].sum())
+    all_files = raw_files(out_dir)
+    if not all_files:
+        return None, 0
+    with open(os.path.join(out_dir, all_files[-1])) as f:
+        records = loads(json.load(f))
+    if not records:
+        return None, 0
+    return records[-1]["_id"], int(all_files[-1].split("_")[-4])
+
+def iter_batches(collection, batch_size=200, after_id=None):
+    """
+    Yields lists of up to batch_size documents in _id order, starting after "after_id".
+    A single sorted cursor walks the collection; if it is lost, a new one starts after the last _id seen.
+    """
+    last_id = after_id
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        cursor = collection.find(query, sort=[("_id", ASCENDING)], batch_size=batch_size)
+        batch = []
+        try:
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) == batch_size:
+                    yield batch
+                    last_id = batch[-1]["_id"]
+                    batch = []
+        except (CursorNotFound, AutoReconnect):
+            #Documents of the unfinished batch are fetched again by the new cursor
+            print("Cursor lost after", str(last_id) + ", restarting it.")
+            continue
+        finally:
+            cursor.close()
+        if batch:
+            yield batch
+        return
+
+def export_collection(collection, out_dir, batch_size=200, checkpoint_path=None, restart=False):
+    """
+    Write every document of the collection newer than the checkpoint to the archive in out_dir
+    (see raw_archive.py), in files of batch_size documents. The checkpoint is updated after each file,
+    so an interrupted export resumes at the next document and a new run only exports new documents.
+    Returns the number of documents written.
+    """
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(out_dir, "wazerawdata.checkpoint")
+
+    if restart:
+        for file in raw_files(out_dir) + read_index(out_dir)["file"].tolist() + ["index.csv"]:
+            if os.path.exists(os.path.join(out_dir, file)):
+                os.remove(os.path.join(out_dir, file))
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    last_id, num_docs = read_checkpoint(checkpoint_path)
+    if last_id is None:
+        last_id, num_docs = checkpoint_from_files(out_dir)
+
+    total_rows = count_documents(collection)
+    width = max(len(str(total_rows)), 9)
+    exported = 0
 
+    start = timer()
+    for records in iter_batches(collection, batch_size, last_id):
+        now_processed = num_docs + len(records)
+        total_rows = max(total_rows, now_processed)
+        filename = "wazerawdata_" + str(num_docs).zfill(width) + "_to_" + str(now_processed).zfill(width) + ".ndjson.gz"
+        write_archive_file(out_dir, filename, records, dumps)
+        write_checkpoint(checkpoint_path, records[-1]["_id"], now_processed)
+
+        end = timer()
+        duration = str(round(end - start))
+        print(str(now_processed), "rows of", str(total_rows) + ", took", duration, "s to be successfully stored.")
+        num_docs = now_processed
+        exported += len(records)
+        start = timer()
+
+    return exported
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect Waze's raw data")
+    parser.add_argument('--batchsize', type=int, default=200, help="Size of download batches")
+    parser.add_argument('--update', type=bool, nargs='?', const=True, default=False,
+                        help="""If true, delete all documents and download them again.
+                        If false, continue from the last document""")
+    parser.add_argument('--checkpoint', type=str, help="Checkpoint file. Defaults to data/raw/wazerawdata.checkpoint")
+    args = parser.parse_args()
+
+    #MongoDB Connection
+    uri = os.environ.get("mongo_uri")
+    client = MongoClient(uri)
+    db = client.ccp
+    collection = db.ccp_collection
+
+    exported = export_collection(collection, project_dir + "/data/raw/", args.batchsize, args.checkpoint, args.update)
+    print("Exported", str(exported), "new documents.")
+    client.close()
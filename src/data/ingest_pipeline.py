@@ -0,0 +1,200 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+sys.path.append(project_dir)
+
+import io
+import time
+import asyncio
+import multiprocessing
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pandas as pd
+
+from src.data.store_data_file import (connect_database, tab_raw_data_chunks, tab_children, packed_tables,
+                                      bulk_store_raw_data)
+from src.data.ingestion_manifest import IngestionManifest
+
+def read_object(source, key):
+    s3object = source.get_object(key)
+    with closing(s3object['Body']) as stream:
+        body = stream.read()
+    return body
+
+#Chunks of an object held between its tabulation process and its writer
+CHUNK_QUEUE_SIZE = 2
+
+def tabulate_object(key, body, chunk_queue, digest="sha1", skip=0, packed=()):
+    """
+    Runs in the tabulation processes: puts each DataFrame of tab_raw_data_chunks in chunk_queue with
+    its jams, alerts and irregularities (tab_children), then None. chunk_queue is bounded, so the
+    process waits for the writer instead of holding every chunk of the object.
+    """
+    try:
+        for raw_data in tab_raw_data_chunks(key, {'Body': io.BytesIO(body)}, digest=digest, skip=skip):
+            chunk_queue.put((raw_data, tab_children(raw_data, packed)))
+    finally:
+        chunk_queue.put(None)
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+
+    def add(self, seconds, items=1):
+        self.items += items
+        self.busy += seconds
+
+async def fetch_worker(loop, executor, source, key_queue, body_queue, stats):
+    while True:
+        item = await key_queue.get()
+        if item is None:
+            return
+        key, skip = item
+        start = time.time()
+        body = await loop.run_in_executor(executor, read_object, source, key)
+        stats.add(time.time() - start)
+        await body_queue.put((key, skip, body))
+
+async def tabulate_worker(loop, executor, drain_executor, manager, body_queue, raw_queue, digest, packed, stats):
+    """
+    Hands each object to a tabulation process and forwards its chunks, as they come, to a queue of
+    the object that is put in raw_queue for the writers. Errors of the process are forwarded too.
+    """
+    while True:
+        item = await body_queue.get()
+        if item is None:
+            return
+        key, skip, body = item
+        object_queue = asyncio.Queue(maxsize=CHUNK_QUEUE_SIZE)
+        await raw_queue.put((key, skip, object_queue))
+        start = time.time()
+        rows = 0
+        chunk_queue = manager.Queue(maxsize=CHUNK_QUEUE_SIZE)
+        future = loop.run_in_executor(executor, tabulate_object, key, body, chunk_queue, digest, skip, packed)
+        del body
+        try:
+            while True:
+                chunk = await loop.run_in_executor(drain_executor, chunk_queue.get)
+                if chunk is None:
+                    break
+                rows += len(chunk[0])
+                await object_queue.put(chunk)
+            await future
+        except Exception as e:
+            await object_queue.put(e)
+            raise
+        stats.add(time.time() - start, rows)
+        await object_queue.put(None)
+
+async def write_worker(loop, executor, meta, raw_queue, manifest, summary, stats):
+    while True:
+        item = await raw_queue.get()
+        if item is None:
+            return
+        key, skip, object_queue = item
+        start = time.time()
+        rows = 0
+        data_files = 0
+        while True:
+            chunk = await object_queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            raw_data, children = chunk
+            table_stats = await loop.run_in_executor(executor, bulk_store_raw_data, meta, raw_data, None, children)
+            rows += sum(n for n, _ in table_stats.values())
+            data_files += len(raw_data)
+            #The manifest is only touched from the event loop thread
+            if manifest:
+                manifest.add_records(key, raw_data["record_position"], raw_data["json_hash"])
+        if manifest:
+            manifest.finish(key, skip + data_files)
+        elapsed = time.time() - start
+        stats.add(elapsed, rows)
+        summary.append({"key": key, "data_files": data_files, "rows": rows})
+
+async def close_stage(workers, queue, n_next):
+    await asyncio.gather(*workers)
+    for _ in range(n_next):
+        await queue.put(None)
+
+def run_pipeline(database_dict, source, keys, fetchers=4, tabulators=None, writers=2, queue_size=4,
+                 digest="sha1", manifest_path=None):
+    """
+    Store S3 objects with three overlapping stages connected by bounded queues:
+    fetch (threads), tabulate (processes, which also tabulate the jams, alerts and irregularities)
+    and write (threads, each write one transaction of COPYs). When a queue is full the stage before
+    it waits, so at most about queue_size objects are held between two stages, each with at most
+    CHUNK_QUEUE_SIZE tabulated chunks, and throughput approaches that of the slowest stage.
+    Returns a DataFrame with the data files and rows stored per object.
+    """
+    if tabulators is None:
+        tabulators = os.cpu_count() or 1
+    meta = connect_database(database_dict)
+    with meta.bind.connect() as con:
+        packed = packed_tables(con)
+    manifest = IngestionManifest(manifest_path) if manifest_path else None
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    key_queue = asyncio.Queue()
+    body_queue = asyncio.Queue(maxsize=queue_size)
+    raw_queue = asyncio.Queue(maxsize=queue_size)
+
+    for key in keys:
+        skip = manifest.resume_position(key) if manifest else 0
+        key_queue.put_nowait((key, skip))
+    for _ in range(fetchers):
+        key_queue.put_nowait(None)
+
+    stats = [StageStats("fetch"), StageStats("tabulate"), StageStats("write")]
+    summary = []
+    fetch_pool = ThreadPoolExecutor(max_workers=fetchers)
+    tabulate_pool = ProcessPoolExecutor(max_workers=tabulators)
+    #Threads waiting for the chunks of the tabulation processes
+    drain_pool = ThreadPoolExecutor(max_workers=tabulators)
+    manager = multiprocessing.Manager()
+    write_pool = ThreadPoolExecutor(max_workers=writers)
+
+    start = time.time()
+    try:
+        fetch_workers = [fetch_worker(loop, fetch_pool, source, key_queue, body_queue, stats[0])
+                         for _ in range(fetchers)]
+        tabulate_workers = [tabulate_worker(loop, tabulate_pool, drain_pool, manager, body_queue, raw_queue,
+                                            digest, packed, stats[1])
+                            for _ in range(tabulators)]
+        write_workers = [write_worker(loop, write_pool, meta, raw_queue, manifest, summary, stats[2])
+                         for _ in range(writers)]
+        pipeline = asyncio.gather(close_stage(fetch_workers, body_queue, tabulators),
+                                  close_stage(tabulate_workers, raw_queue, writers),
+                                  *write_workers)
+        try:
+            loop.run_until_complete(pipeline)
+        except BaseException:
+            pipeline.cancel()
+            raise
+    finally:
+        #Stopping the manager first releases the processes and threads still waiting on its queues
+        manager.shutdown()
+        fetch_pool.shutdown()
+        tabulate_pool.shutdown()
+        drain_pool.shutdown()
+        write_pool.shutdown()
+        loop.close()
+        if manifest:
+            manifest.close()
+
+    elapsed = time.time() - start
+    summary = pd.DataFrame(summary, columns=["key", "data_files", "rows"])
+    for s in stats:
+        print(s.name + ":", str(s.items), "items,", str(round(s.busy, 2)), "seconds busy.")
+    total_rows = summary["rows"].sum()
+    rate = total_rows / elapsed if elapsed > 0 else 0
+    print("Stored", str(len(summary)), "objects,", str(total_rows), "rows, in", str(round(elapsed, 2)),
+          "seconds (" + str(int(rate)), "rows/s).")
+
+    return summary
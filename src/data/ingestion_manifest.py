@@ -0,0 +1,63 @@
+import sqlite3
+import datetime
+
+class IngestionManifest:
+    """
+    Local SQLite record of what store_data_file.py has already loaded: every data file (by its position
+    in the S3 object and its json_hash) stored so far, and the objects that were fully processed.
+    Finished objects can be skipped without downloading them, and partially loaded objects resumed
+    at their first missing record.
+    Several processes may share the same file; each one should open its own IngestionManifest.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path, timeout=60)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        with self.con:
+            self.con.execute("""CREATE TABLE IF NOT EXISTS objects (
+                                    key TEXT PRIMARY KEY NOT NULL,
+                                    n_records INTEGER,
+                                    date_finished TEXT
+                                )""")
+            self.con.execute("""CREATE TABLE IF NOT EXISTS records (
+                                    key TEXT NOT NULL,
+                                    position INTEGER NOT NULL,
+                                    json_hash VARCHAR(40) NOT NULL,
+                                    PRIMARY KEY (key, position)
+                                )""")
+
+    def close(self):
+        self.con.close()
+
+    def finished_keys(self):
+        return set(r[0] for r in self.con.execute("SELECT key FROM objects"))
+
+    def is_finished(self, key):
+        return self.con.execute("SELECT 1 FROM objects WHERE key = ?", (key,)).fetchone() is not None
+
+    def stored_hashes(self, key):
+        return set(r[0] for r in self.con.execute("SELECT json_hash FROM records WHERE key = ?", (key,)))
+
+    def resume_position(self, key):
+        """
+        Position of the first record of "key" that is not stored yet.
+        """
+        position = 0
+        for (stored,) in self.con.execute("SELECT position FROM records WHERE key = ? ORDER BY position", (key,)):
+            if stored != position:
+                break
+            position += 1
+        return position
+
+    def add_records(self, key, positions, json_hashes):
+        """
+        Mark data files as stored. Call it only after the transaction that stored them was committed.
+        """
+        with self.con:
+            self.con.executemany("INSERT OR REPLACE INTO records (key, position, json_hash) VALUES (?, ?, ?)",
+                                 [(key, int(p), h) for p, h in zip(positions, json_hashes)])
+
+    def finish(self, key, n_records):
+        with self.con:
+            self.con.execute("INSERT OR REPLACE INTO objects (key, n_records, date_finished) VALUES (?, ?, ?)",
+                             (key, int(n_records), datetime.datetime.now().isoformat()))
@@ -0,0 +1,160 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+sys.path.append(project_dir)
+
+import json
+import datetime
+import hashlib
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import select, func, cast, and_, Date
+
+from src.data.processing_func import jams_query, line_columns
+
+CACHE_DIR = os.path.join(project_dir, "data", "interim", "jams_cache")
+MAX_BYTES = 2 * 1024**3
+
+def cache_key(meta, weekends=True, periods=None):
+    """
+    Directory name of the cached days of a query: the database and the filters of extract_df_jams.
+    """
+    url = meta.bind.url
+    jams = meta.tables["waze.jams"]
+    params = {"database": [url.host, url.port, url.database],
+              "weekends": bool(weekends),
+              "periods": sorted([list(t) for t in periods]) if periods else None,
+              "line": [column.name for column in line_columns(jams)]}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def day_signatures(meta, first_day, last_day):
+    """
+    Number and last id of the data files of each day from first_day to last_day, as {day: "count-id"}.
+    Data files stored late for a day (e.g. a backfill) change its signature, and so its cache file.
+    """
+    data_files = meta.tables["waze.data_files"]
+    day = cast(data_files.c.start_time, Date)
+    query = (select([day, func.count(data_files.c.id), func.max(data_files.c.id)])
+             .where(and_(data_files.c.start_time >= first_day,
+                         data_files.c.start_time < last_day + datetime.timedelta(days=1)))
+             .group_by(day))
+    return {row[0]: "%d-%d" % (row[1], row[2]) for row in meta.bind.execute(query)}
+
+def day_path(cache_dir, key, day, signature):
+    return os.path.join(cache_dir, key, day.strftime("%Y-%m-%d") + "_" + signature + ".parquet")
+
+def cached_days(cache_dir, key, days, signatures, today):
+    """
+    Paths of the days already cached with their current signature, as {day: path}, and the days to fetch.
+    Days from today on are still being collected, so they are never read from the cache.
+    """
+    paths = {}
+    missing = []
+    for day in days:
+        path = day_path(cache_dir, key, day, signatures.get(day, "0-0"))
+        if day < today and os.path.exists(path):
+            paths[day] = path
+        else:
+            missing.append(day)
+    return paths, missing
+
+def read_day(path):
+    df = pq.read_table(path).to_pandas()
+    if "line" in df.columns:
+        df["line"] = [json.loads(line) if line is not None else None for line in df["line"]]
+    #Last use, for the LRU eviction
+    os.utime(path, None)
+    return df
+
+def write_day(path, df):
+    df = df.copy()
+    if "line" in df.columns:
+        #Parquet has no type for the JSON lines
+        df["line"] = [json.dumps(line) if line is not None else None for line in df["line"]]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + "." + str(os.getpid())
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+    os.replace(tmp_path, path)
+    #Files of the same day cached before its signature changed
+    name = os.path.basename(path)
+    prefix = name.split("_")[0] + "_"
+    for other in os.listdir(os.path.dirname(path)):
+        if other.startswith(prefix) and other.endswith(".parquet") and other != name:
+            os.remove(os.path.join(os.path.dirname(path), other))
+
+def fetch_days(meta, first_day, last_day, weekends=True, periods=None):
+    """
+    Jams of the days from first_day to last_day (start_time from first_day 00:00 to last_day 24:00,
+    excluded), with the filters of extract_df_jams, as a dict {day: DataFrame}.
+    """
+    end = last_day + datetime.timedelta(days=1)
+    query = jams_query(meta, first_day, end, weekends, periods)
+    query = query.where(meta.tables["waze.data_files"].c.start_time < end)
+    df_jams = pd.read_sql(query, meta.bind)
+
+    days = df_jams["start_time"].dt.date
+    return {day.date(): df_jams[days == day.date()].reset_index(drop=True)
+            for day in pd.date_range(first_day, last_day)}
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    """
+    Delete the least recently used days until the cache holds at most max_bytes.
+    """
+    files = []
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            if name.endswith(".parquet"):
+                stat = os.stat(os.path.join(root, name))
+                files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+def cached_extract_df_jams(meta, date_begin, date_end, weekends=True, periods=None, cache_dir=CACHE_DIR,
+                           max_bytes=MAX_BYTES, today=None):
+    """
+    extract_df_jams through a local cache of Parquet files, one per day and set of filters.
+    Days already cached are read from disk, and only the missing ones are read from the database,
+    one query per run of consecutive missing days. Days from today on are still being collected,
+    so they are always read from the database and never cached. A day that got data files after
+    it was cached (see day_signatures) is read again.
+    """
+    if "waze.jams" not in meta.tables:
+        meta.reflect(schema="waze")
+    key = cache_key(meta, weekends, periods)
+    begin = pd.Timestamp(date_begin)
+    end = pd.Timestamp(date_end)
+    today = today or datetime.datetime.utcnow().date()
+
+    days = [d.date() for d in pd.date_range(begin.normalize(), end.normalize())]
+    signatures = day_signatures(meta, days[0], days[-1])
+    paths, missing = cached_days(cache_dir, key, days, signatures, today)
+    frames = {day: read_day(path) for day, path in paths.items()}
+
+    #Group consecutive missing days
+    runs = []
+    for day in missing:
+        if runs and day - runs[-1][-1] == datetime.timedelta(days=1):
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+    for run in runs:
+        fetched = fetch_days(meta, run[0], run[-1], weekends, periods)
+        for day, df in fetched.items():
+            if day < today:
+                write_day(day_path(cache_dir, key, day, signatures.get(day, "0-0")), df)
+            frames[day] = df
+    if runs:
+        evict(cache_dir, max_bytes)
+
+    df_jams = pd.concat([frames[day] for day in days], ignore_index=True)
+    #Same rows and order as extract_df_jams
+    df_jams = df_jams[df_jams["start_time"].between(begin, end)]
+    df_jams = df_jams.sort_values("start_time", ascending=False, kind="mergesort").reset_index(drop=True)
+
+    return df_jams
@@ -3,17 +3,41 @@ import numpy as np
 import pandas as pd
 import geopandas as gpd
 import numpy as np
-from sqlalchemy import extract, select, func
+from sqlalchemy import extract, select, func, cast, case, literal_column, Float, Integer, Date
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.sql import or_, and_
 import datetime
 from shapely.geometry import Point
 
-from src.data.processing_func import (get_direction, extract_geo_sections)
+from src.data.processing_func import (get_direction, line_directions, extract_geo_sections, stream_sql,
+                                      align_chunks, local_time, time_features, minute_bins,
+                                      minute_bin_labels, LOCAL_TIMEZONE)
 
-def extract_jps(meta, date_begin, date_end, periods=None, weekends=False,
-                summary=False, skip=None, limit=20000, return_count=False):
-    start = time.time()
+def jps_filters(meta, date_begin, date_end, periods=None, weekends=False):
+    """
+    Period, weekday and hour filters of the jams per section queries.
+    """
+    mongo_record = meta.tables["MongoRecord"]
+    filters = [mongo_record.c.MgrcDateStart.between(date_begin, date_end)]
+
+    if not weekends:
+        filters.append(extract("isodow", mongo_record.c.MgrcDateStart).in_(list(range(1,6))))
+
+    if periods:
+        or_list=[]
+        for t in periods:
+            or_list.append(and_(extract("hour", mongo_record.c.MgrcDateStart)>=t[0],
+                                extract("hour", mongo_record.c.MgrcDateStart)<t[1]
+                                )
+                          )
+        filters.append(or_(*or_list))
+
+    return filters
 
+def jps_queries(meta, date_begin, date_end, periods=None, weekends=False):
+    """
+    Count and data queries of the jams per section in the period, ordered by MgrcDateStart and JpsId.
+    """
     jps = meta.tables["JamPerSection"]
     jam = meta.tables["Jam"]
     sctn = meta.tables["Section"]
@@ -31,53 +55,41 @@ def extract_jps(meta, date_begin, date_end, periods=None, weekends=False,
                     jam.c.JamTimeDelayInSeconds,
                     jam.c.JamDscCoordinatesLonLat])
 
-    queries = [query_count, query_all]
+    filters = jps_filters(meta, date_begin, date_end, periods, weekends)
+    queries = [q.select_from(mongo_record.join(jam.join(jps), isouter=True)).where(and_(*filters))
+               for q in [query_count, query_all]]
 
-    queries = [q.select_from(mongo_record.join(jam.join(jps), isouter=True)).\
-                      where(mongo_record.c.MgrcDateStart.between(date_begin, date_end)) for q in queries]
+    query_count, query_all = queries
+    query_all = query_all.order_by(mongo_record.c.MgrcDateStart, jps.c.JpsId)
 
-    if not weekends:
-        queries = [q.where(extract("isodow", mongo_record.c.MgrcDateStart).in_(list(range(1,6))))
-                   for q in queries]
+    return query_count, query_all
 
-    if periods:
-        or_list=[]
-        for t in periods:
-            or_list.append(and_(extract("hour", mongo_record.c.MgrcDateStart)>=t[0],
-                                extract("hour", mongo_record.c.MgrcDateStart)<t[1]
-                                )
-                          )
-        queries = [q.where(or_(*or_list)) for q in queries]
+def transf_jps(df_jps, bin_width=15):
+    """
+    Speed in km/h, directions, local date, hour, period and minute_bin of the jams per section.
+    """
+    df_jps["JamSpdKmPerHour"] = df_jps["JamSpdMetersPerSecond"]*3.6
+    df_jps[["LonDirection","LatDirection", "MajorDirection"]] = line_directions(df_jps["JamDscCoordinatesLonLat"])
+    df_jps["MgrcDateStart"] = local_time(df_jps["MgrcDateStart"])
+    df_times = time_features(df_jps["MgrcDateStart"], bin_width)
+    df_jps[df_times.columns.tolist()] = df_times
 
-    query_count, query_all = queries
+    return df_jps
+
+def extract_jps(meta, date_begin, date_end, periods=None, weekends=False,
+                summary=False, skip=None, limit=20000, return_count=False, bin_width=15):
+    start = time.time()
+
+    query_count, query_all = jps_queries(meta, date_begin, date_end, periods, weekends)
 
     if return_count:
         size = query_count.execute().scalar()
         return size
 
-    query_all = query_all.order_by(mongo_record.c.MgrcDateStart, jps.c.JpsId).offset(skip).limit(limit)
+    query_all = query_all.offset(skip).limit(limit)
 
     df_jps = pd.read_sql(query_all, meta.bind)
-    df_jps["JamSpdKmPerHour"] = df_jps["JamSpdMetersPerSecond"]*3.6
-    df_jps[["LonDirection","LatDirection", "MajorDirection"]] = df_jps["JamDscCoordinatesLonLat"].apply(get_direction)
-    try:
-        df_jps["MgrcDateStart"] = df_jps["MgrcDateStart"].dt.tz_convert("America/Sao_Paulo")
-    except AttributeError:
-        pass
-    df_jps["date"] = pd.to_datetime(df_jps["MgrcDateStart"], utc=True).dt.date
-    df_jps["hour"] = df_jps["MgrcDateStart"].astype(str).str[11:13].astype(int)
-    df_jps["minute"] = df_jps["MgrcDateStart"].astype(str).str[14:16].astype(int)
-    df_jps["period"] = np.sign(df_jps["hour"]-12)
-
-    bins = [0, 14, 29, 44, 59]
-    labels = []
-    for i in range(1,len(bins)):
-        if i==1:
-            labels.append(str(bins[i-1]) + " a " + str(bins[i]))
-        else:
-            labels.append(str(bins[i-1]+1) + " a " + str(bins[i]))
-
-    df_jps['minute_bin'] = pd.cut(df_jps["minute"], bins, labels=labels, include_lowest=True)
+    df_jps = transf_jps(df_jps, bin_width)
     end = time.time()
 
     processing_time = round(end - start)
@@ -93,14 +105,109 @@ def extract_jps(meta, date_begin, date_end, periods=None, weekends=False,
 
     return df_jps
 
-def transf_flow_features(df_jps, geo_sections):
-    def get_main_direction(x):
-        if x["StreetDirection"] == "Norte/Sul":
-            return x["LatDirection"]
-        elif x["StreetDirection"] == "Leste/Oeste":
-            return x["LonDirection"]
+def jps_page_query(meta, date_begin, date_end, after=None, limit=20000, periods=None, weekends=False):
+    """
+    Query of a page of extract_jps_page. The token is applied as a range on MgrcDateStart alone
+    (MgrcDateStart >= the token), which PostgreSQL can start an index scan from, and the rows of
+    the token's MgrcDateStart already read are then left out by the OR on JpsId.
+    """
+    mongo_record = meta.tables["MongoRecord"]
+    jps = meta.tables["JamPerSection"]
+    _, query_all = jps_queries(meta, date_begin, date_end, periods, weekends)
+
+    if after is not None:
+        last_date = pd.Timestamp(after["MgrcDateStart"])
+        if after["JpsId"] is None:
+            #Rows without section (records without jams) sort last in their MgrcDateStart, so the
+            #page ended after every section of it. Skipping the remaining ones loses no feature.
+            query_all = query_all.where(mongo_record.c.MgrcDateStart > last_date)
+        else:
+            query_all = query_all.where(and_(mongo_record.c.MgrcDateStart >= last_date,
+                                             or_(mongo_record.c.MgrcDateStart > last_date,
+                                                 jps.c.JpsId > after["JpsId"],
+                                                 jps.c.JpsId.is_(None))))
+    return query_all.limit(limit)
+
+def extract_jps_page(meta, date_begin, date_end, after=None, limit=20000, periods=None, weekends=False,
+                     bin_width=15):
+    """
+    Keyset pagination of extract_jps: the next "limit" rows after the resume token "after"
+    (None for the first page), and the token of the page that follows, None after the last page.
+    Each page starts its index scan at its token (see jps_page_query) instead of at date_begin.
+    Tokens are dicts of MgrcDateStart (ISO string) and JpsId, and can be stored as JSON.
+    """
+    query_all = jps_page_query(meta, date_begin, date_end, after, limit, periods, weekends)
+
+    df_jps = pd.read_sql(query_all, meta.bind)
+    if len(df_jps) < limit:
+        token = None
+    else:
+        last = df_jps.iloc[-1]
+        token = {"MgrcDateStart": pd.Timestamp(last["MgrcDateStart"]).isoformat(),
+                 "JpsId": None if pd.isnull(last["JpsId"]) else int(last["JpsId"])}
+    df_jps = transf_jps(df_jps, bin_width)
+
+    return df_jps, token
+
+def iter_jps(meta, date_begin, date_end, periods=None, weekends=False, chunksize=20000, bin_width=15):
+    """
+    The rows of extract_jps for the whole period, in chunks of about chunksize rows read through
+    a server-side cursor, with the derived columns of extract_jps. A time slot (date, hour and
+    minute_bin) is never split between chunks, so transf_flow_features can be applied chunk by chunk
+    and its results concatenated.
+    """
+    _, query_all = jps_queries(meta, date_begin, date_end, periods, weekends)
+    chunks = (transf_jps(df_jps, bin_width) for df_jps in stream_sql(query_all, meta.bind, chunksize))
+    return align_chunks(chunks, lambda df: df[["date", "time_slot"]].astype(str))
+
+FLOW_MEASURES = ["JamQtdLengthMeters", "JamSpdMetersPerSecond", "JamTimeDelayInSeconds", "JamIndLevelOfTraffic"]
+
+def extract_jps_aggregated(meta, date_begin, date_end, periods=None, weekends=False, bin_width=15,
+                           tz=LOCAL_TIMEZONE):
+    """
+    The jams per section of the period already grouped by PostgreSQL per SctnId, local date, hour,
+    minute_bin, LonDirection and LatDirection, with the mean of each of FLOW_MEASURES (as <measure>_mean)
+    and the number of jams (JamId_count). Only the groups are transferred, not the rows nor their lines.
+    Directions are computed from the first and last points of JamDscCoordinatesLonLat, as get_direction.
+    """
+    jps = meta.tables["JamPerSection"]
+    jam = meta.tables["Jam"]
+    mongo_record = meta.tables["MongoRecord"]
 
+    start = mongo_record.c.MgrcDateStart
+    if not getattr(start.type, "timezone", False):
+        #Naive timestamps are UTC, as in local_time: timezone(tz, ...) alone would take them as local time
+        start = func.timezone("UTC", start)
+    local_start = func.timezone(tz, start)
+    coords = jam.c.JamDscCoordinatesLonLat
+    array_length = func.jsonb_array_length if isinstance(coords.type, postgresql.JSONB) else func.json_array_length
+    first = coords.op("->")(0)
+    last = coords.op("->")(array_length(coords) - 1)
+    delta_x = cast(last.op("->>")("x"), Float) - cast(first.op("->>")("x"), Float)
+    delta_y = cast(last.op("->>")("y"), Float) - cast(first.op("->>")("y"), Float)
 
+    keys = [jps.c.SctnId,
+            cast(local_start, Date).label("date"),
+            cast(extract("hour", local_start), Integer).label("hour"),
+            cast(func.floor(extract("minute", local_start) / bin_width), Integer).label("minute_bin"),
+            case([(delta_x >= 0, "East"), (delta_x < 0, "West")]).label("LonDirection"),
+            case([(delta_y >= 0, "North"), (delta_y < 0, "South")]).label("LatDirection")]
+    measures = [cast(func.avg(jam.c[m]), Float).label(m + "_mean") for m in FLOW_MEASURES]
+    measures.append(func.count(jam.c.JamId).label("JamId_count"))
+
+    filters = jps_filters(meta, date_begin, date_end, periods, weekends)
+    query = (select(keys + measures)
+             .select_from(mongo_record.join(jam.join(jps)))
+             .where(and_(jps.c.SctnId.isnot(None), *filters))
+             #By position, so that the grouped expressions are the selected ones
+             .group_by(*[literal_column(str(i)) for i in range(1, len(keys) + 1)]))
+
+    df_jps_agg = pd.read_sql(query, meta.bind)
+    df_jps_agg["minute_bin"] = pd.Categorical.from_codes(df_jps_agg["minute_bin"], minute_bin_labels(bin_width))
+
+    return df_jps_agg
+
+def transf_flow_features(df_jps, geo_sections):
     #Get Major Direction from geo_sections
     major_direction = geo_sections["StreetDirection"]
     df_jps = df_jps.join(major_direction, on="SctnId")
@@ -114,6 +221,31 @@ def transf_flow_features(df_jps, geo_sections):
                                                            "JamIndLevelOfTraffic": ["mean"],
                                                           })
     df_flow_features.columns = ['_'.join(col).strip() for col in df_flow_features.columns.values]
+
+    return format_flow_features(df_flow_features)
+
+def transf_flow_features_aggregated(df_jps_agg, geo_sections):
+    """
+    transf_flow_features of the output of extract_jps_aggregated.
+    """
+    df_jps_agg = df_jps_agg.join(geo_sections["StreetDirection"], on="SctnId")
+    df_flow_features = df_jps_agg.set_index(["SctnId", "date", "hour", "minute_bin",
+                                             "LonDirection", "LatDirection", "StreetDirection"])
+    df_flow_features = df_flow_features[[m + "_mean" for m in FLOW_MEASURES]]
+
+    return format_flow_features(df_flow_features)
+
+def format_flow_features(df_flow_features):
+    """
+    Speed in km/h, the direction of interest (latitude direction on North/South streets, longitude
+    direction on East/West ones) as index level and the feature names of the flow dataset.
+    """
+    def get_main_direction(x):
+        if x["StreetDirection"] == "Norte/Sul":
+            return x["LatDirection"]
+        elif x["StreetDirection"] == "Leste/Oeste":
+            return x["LonDirection"]
+
     df_flow_features["JamSpdKmPerHour_mean"] = df_flow_features["JamSpdMetersPerSecond_mean"]*3.6
     columns = {"JamSpdKmPerHour_mean": "Velocidade Média (km/h)",
                "JamQtdLengthMeters_mean": "Fila média (m)",
@@ -128,8 +260,15 @@ def transf_flow_features(df_jps, geo_sections):
 
     return df_flow_features
 
-def transf_flow_labels(geo_sections, path_fluxos):
-  
+def transf_flow_labels(geo_sections, path_fluxos, bin_width=15):
+    """
+    Radar flow counts per section, date, hour, minute_bin and direction. The radars count vehicles
+    in fixed 15 minute slots, so bin_width must be a multiple of 15 that divides the hour: the
+    counts of the slots of each wider bin are added up. Use the same bin_width as the features.
+    """
+    if bin_width % 15 or 60 % bin_width:
+        raise ValueError("The radar flow counts are per 15 minutes, bin_width must be 15, 30 or 60")
+
     df_fluxos = pd.read_csv(path_fluxos, sep=';', decimal=',')
     df_fluxos.dropna(subset=["Latitude", "Longitude"], inplace=True)
     df_fluxos["fluxo_Point"] = df_fluxos.apply(lambda x: Point(x["Longitude"], x["Latitude"]), axis=1)
@@ -147,8 +286,8 @@ def transf_flow_labels(geo_sections, path_fluxos):
     geo_fluxos = gpd.GeoDataFrame(df_fluxos, crs={'init': 'epsg:4326'}, geometry="fluxo_Point")
     df_flow_labels = gpd.sjoin(geo_fluxos, geo_sections.reset_index(), how="left", op="within")
     df_flow_labels["hour"] = df_flow_labels["Horario"].str[:2].astype(int)
-    df_flow_labels["minute_bin"] = df_flow_labels["Horario"].str[3:5] + " a " + df_flow_labels["Horario"].str[12:14]
-    df_flow_labels["minute_bin"] = df_flow_labels["minute_bin"].str.replace("00", "0")
+    #Same categories as the minute_bin of the jam features, so that the join is exact
+    df_flow_labels["minute_bin"] = minute_bins(df_flow_labels["Horario"].str[3:5].astype(int), bin_width)
     df_flow_labels.set_index("date", inplace=True) #Done separately because set_index to Multiindex convert date type to Timestamp
     df_flow_labels.set_index(["SctnId", "hour", "minute_bin", "Direction"], append=True, inplace=True)
     df_flow_labels.index = df_flow_labels.index.swaplevel(0,1) #So index will be in the same order as df_flow_features
@@ -157,5 +296,10 @@ def transf_flow_labels(geo_sections, path_fluxos):
                '71 a 80', '81 a 90', '91 a 100', 'Acima de 100', 'Total',
               ]
     df_flow_labels = df_flow_labels[columns]
+    if bin_width > 15:
+        counts = columns[columns.index('00 a 10'):]
+        aggregations = {c: "sum" if c in counts else "first" for c in columns}
+        df_flow_labels = df_flow_labels.groupby(level=list(range(df_flow_labels.index.nlevels)),
+                                                observed=True, sort=False).agg(aggregations)[columns]
   
     return df_flow_labels
\ No newline at end of file
@@ -4,6 +4,7 @@ project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
 sys.path.append(project_dir)
 
 import math
+import json
 import pandas as pd
 import geopandas as gpd
 from sqlalchemy import MetaData, create_engine, extract, select
@@ -16,7 +17,8 @@ import glob
 from timeit import default_timer as timer
 
 from src.data.processing_func import (get_direction, connect_database, extract_geo_sections)
-from src.data.load_func import extract_jps, transf_flow_features, transf_flow_labels
+from src.data.database_func import database_dict_from_env
+from src.data.load_func import extract_jps_page, transf_flow_features, transf_flow_labels
 
 import dotenv
 dotenv_path = os.path.join(project_dir, '.env')
@@ -33,36 +35,42 @@ elif (rewrite_files == "Y") or (rewrite_files == "y"):
         os.remove(f)
 
 #Connection and initial setup
-DATABASE = {
-'drivername': os.environ.get("db_drivername"),
-'host': os.environ.get("db_host"), 
-'port': os.environ.get("db_port"),
-'username': os.environ.get("db_username"),
-'password': os.environ.get("db_password"),
-'database': os.environ.get("db_database"),
-}
+DATABASE = database_dict_from_env()
 
-meta = connect_database(DATABASE)
+meta = connect_database(DATABASE, schemas=[None])
 
 geo_sections = extract_geo_sections(meta)
 geo_sections.set_index("SctnId", inplace=True)
 
 path_fluxos = project_dir + "/data/external/fotosensores_Fluxo_veiculos.csv"
-df_flow_labels = transf_flow_labels(geo_sections, path_fluxos)
+#Minutes per time bin, the same for the jam features and the radar labels
+bin_width = 15
+df_flow_labels = transf_flow_labels(geo_sections, path_fluxos, bin_width)
 
 date_begin = datetime.date(day=1, month=9, year=2017)
 date_end = datetime.date(day=31, month=1, year=2018)
 
-total_rows = extract_jps(meta, date_begin, date_end, weekends=True, summary=True, return_count=True)
 batch_size = 50000
-number_batches = math.ceil(total_rows / batch_size)
-width = len(str(number_batches))
-
-for i in range(0, number_batches):
-    if glob.glob(project_dir + "/data/test/flow_dataset_" + str(i+1).zfill(width) + ".csv"):
-        continue
-
-    df_jps = extract_jps(meta, date_begin, date_end, weekends=True, summary=True, skip=i*batch_size, limit=batch_size)
+width = 5
+
+#Resume token of the batch following each stored file, so an interrupted run goes on from the last file
+tokens_path = project_dir + "/data/test/flow_dataset_tokens.json"
+tokens = {}
+if os.path.exists(tokens_path) and glob.glob(project_dir + "/data/test/flow_dataset_*.csv"):
+    with open(tokens_path) as f:
+        tokens = json.load(f)
+
+i = 0
+token = None
+while glob.glob(project_dir + "/data/test/flow_dataset_" + str(i+1).zfill(width) + ".csv") and str(i+1) in tokens:
+    i += 1
+    token = tokens[str(i)]
+    if token is None:
+        break
+
+while i == 0 or token is not None:
+    df_jps, token = extract_jps_page(meta, date_begin, date_end, after=token, limit=batch_size, weekends=True,
+                                     bin_width=bin_width)
 
     start = timer()
     df_flow_features = transf_flow_features(df_jps, geo_sections)
@@ -71,20 +79,17 @@ for i in range(0, number_batches):
         flow_dataset = df_flow_features.merge(df_flow_labels, how="inner", left_index=True, right_index=True)
     except TypeError as e:
         print(e)
-        continue
+        flow_dataset = df_flow_features.iloc[0:0]
     
     end = timer()
     duration = str(round(end - start))
     num_matches = len(flow_dataset)
-    flow_dataset.to_csv(project_dir + "/data/test/flow_dataset_" + str(i+1).zfill(width) + ".csv")
-    print("Batch " + str(i+1) + " of " + str(number_batches) + " took " + \
+    i += 1
+    flow_dataset.to_csv(project_dir + "/data/test/flow_dataset_" + str(i).zfill(width) + ".csv")
+    tokens[str(i)] = token
+    with open(tokens_path, "w") as f:
+        json.dump(tokens, f)
+    print("Batch " + str(i) + " took " + \
           duration + "s to process " + \
           str(num_matches) + \
           " matches, and document was successfully stored")
-
-
-
-
-
-
-
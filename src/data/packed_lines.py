@@ -0,0 +1,94 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+sys.path.append(project_dir)
+
+import struct
+import argparse
+from timeit import default_timer as timer
+
+import dotenv
+import numpy as np
+from sqlalchemy import text
+
+dotenv_path = os.path.join(project_dir, '.env')
+dotenv.load_dotenv(dotenv_path)
+
+#Tables whose JSON "line" column has a packed copy in "line_wkb"
+PACKED_TABLES = ("jams", "irregularities")
+#WKB LineString header: byte order (1 is little endian), geometry type (2 is LineString), number of points
+WKB_HEADER = struct.Struct("<BII")
+
+def pack_line(line):
+    """
+    WKB LineString of a line given as a list of {"x", "y"}, or None if there is no line.
+    """
+    if not isinstance(line, (list, tuple)):
+        return None
+    coords = np.array([(point["x"], point["y"]) for point in line], dtype="<f8")
+    return WKB_HEADER.pack(1, 2, len(line)) + coords.tobytes()
+
+def pack_lines(lines):
+    return [pack_line(line) for line in lines]
+
+def unpack_line(wkb):
+    """
+    (n, 2) array of the points of a WKB LineString (bytes or the memoryview returned for BYTEA).
+    """
+    byte_order = "<" if bytes(wkb[:1]) == b"\x01" else ">"
+    _, geometry_type, n = struct.unpack_from(byte_order + "BII", wkb)
+    if geometry_type != 2:
+        raise ValueError("Not a WKB LineString")
+    return np.frombuffer(wkb, dtype=byte_order + "f8", count=2*n, offset=WKB_HEADER.size).reshape(n, 2)
+
+def wkb_line_arrays(wkbs):
+    """
+    line_arrays (processing_func.py) of WKB LineStrings: flat x and y arrays and the offsets of each line.
+    Missing lines have no points.
+    """
+    coords = [unpack_line(wkb) if wkb is not None else np.empty((0, 2)) for wkb in wkbs]
+    offsets = np.zeros(len(coords) + 1, dtype=np.int64)
+    np.cumsum([len(c) for c in coords], out=offsets[1:])
+    coords = np.concatenate(coords) if coords else np.empty((0, 2))
+    return coords[:, 0].astype(float), coords[:, 1].astype(float), offsets
+
+def add_line_columns(con, schema="waze"):
+    for table in PACKED_TABLES:
+        con.execute('ALTER TABLE "%s"."%s" ADD COLUMN IF NOT EXISTS "line_wkb" BYTEA' % (schema, table))
+
+def backfill(engine, table, batch_size=10000, schema="waze"):
+    """
+    Fill line_wkb of the rows of "table" stored before it existed, batch_size rows per transaction,
+    in id order. Can be interrupted and run again. Returns the number of rows filled.
+    """
+    select_query = text('''SELECT id, line FROM "%s"."%s"
+                           WHERE line_wkb IS NULL AND line IS NOT NULL AND id > :last_id
+                           ORDER BY id LIMIT :batch_size''' % (schema, table))
+    update_query = text('UPDATE "%s"."%s" SET line_wkb = :line_wkb WHERE id = :id' % (schema, table))
+    last_id = ""
+    filled = 0
+    while True:
+        start = timer()
+        with engine.begin() as con:
+            rows = con.execute(select_query, last_id=last_id, batch_size=batch_size).fetchall()
+            if not rows:
+                break
+            con.execute(update_query, [{"id": row[0], "line_wkb": pack_line(row[1])} for row in rows])
+        last_id = rows[-1][0]
+        filled += len(rows)
+        print(schema + "." + table + ":", str(filled), "rows filled, last batch took",
+              str(round(timer() - start, 2)), "s.")
+    return filled
+
+if __name__ == "__main__":
+    from src.data.database_func import connect_database, database_dict_from_env
+
+    parser = argparse.ArgumentParser(description="Add and backfill the packed line_wkb column of waze.jams and waze.irregularities")
+    parser.add_argument('--batchsize', type=int, default=10000, help="Rows per transaction")
+    args = parser.parse_args()
+
+    meta = connect_database(database_dict_from_env())
+    with meta.bind.begin() as con:
+        add_line_columns(con)
+    for table in PACKED_TABLES:
+        backfill(meta.bind, table, args.batchsize)
@@ -5,28 +5,43 @@ from pandas.io.json import json_normalize
 from pyproj import Proj
 import geojson
 from pymongo import MongoClient, DESCENDING
-from shapely.geometry import LineString, MultiLineString
+from shapely.geometry import LineString, MultiLineString, Point
+from shapely.strtree import STRtree
 from shapely.wkt import loads as wkt_loads
 import geopandas as gpd
 import math
 from timeit import default_timer as timer
 
-from sqlalchemy import MetaData, create_engine, extract, select, desc
+from sqlalchemy import MetaData, create_engine, extract, select, desc, case
+from sqlalchemy.sql import or_, and_
 from sqlalchemy.engine.url import URL
 
-def connect_database(database_dict):
+from src.data.database_func import connect_database
+from src.data.packed_lines import wkb_line_arrays, pack_line
 
-    DATABASE = database_dict
-
-    db_url = URL(**DATABASE)
-    engine = create_engine(db_url)
-    meta = MetaData()
-    meta.bind = engine
-
-    return meta
+def line_columns(table):
+    """
+    Columns to read the lines of waze.jams or waze.irregularities: the JSON line column, or when the
+    table has the packed line_wkb column (see packed_lines.py), line_wkb and the JSON line of the rows
+    where line_wkb is still NULL, so that only rows stored before line_wkb was filled are read as JSON.
+    """
+    if "line_wkb" not in table.c:
+        return [table.c.line]
+    return [table.c.line_wkb, case([(table.c.line_wkb.is_(None), table.c.line)]).label("line")]
 
-def extract_df_jams(meta, date_begin, date_end, weekends=True, periods=None):
-    meta.reflect(schema="waze")
+def df_line_arrays(df):
+    """
+    line_arrays of the lines of a DataFrame read with line_columns.
+    """
+    if "line_wkb" not in df.columns:
+        return line_arrays(list(df["line"]))
+    lines = df["line"] if "line" in df.columns else [None] * len(df)
+    return wkb_line_arrays([wkb if wkb is not None else pack_line(line)
+                            for wkb, line in zip(df["line_wkb"], lines)])
+
+def jams_query(meta, date_begin, date_end, weekends=True, periods=None):
+    if "waze.jams" not in meta.tables:
+        meta.reflect(schema="waze")
     jams = meta.tables['waze.jams']
     data_files = meta.tables["waze.data_files"]
 
@@ -39,22 +54,13 @@ def extract_df_jams(meta, date_begin, date_end, weekends=True, periods=None):
                     jams.c.speed_kmh,
                     jams.c.speed,
                     jams.c.delay,
-                    jams.c.line])
+                    *line_columns(jams)])
     
     query = query.select_from(jams.join(data_files)).where(data_files.c.start_time.between(date_begin, date_end))
+    if "start_time" in jams.c:
+        #Lets PostgreSQL skip the partitions of waze.jams outside the period (src/database/partitions.py)
+        query = query.where(jams.c.start_time.between(date_begin, date_end))
 
-    if not weekends:
-        query = query.where(extract("isodow", data_files.c.start_time).in_(list(range(1,6))))
-
-    if periods:
-        or_list=[]
-        for t in periods:
-            or_list.append(and_(extract("hour", data_files.c.start_time)>=t[0],
-                                extract("hour", data_files.c.start_time)<t[1]
-                                )
-                          )
-        query = query.where(or_(*or_list))
-    
     if not weekends:
         query = query.where(extract("isodow", data_files.c.start_time).in_(list(range(1,6))))
 
@@ -69,42 +75,180 @@ def extract_df_jams(meta, date_begin, date_end, weekends=True, periods=None):
         
     query = query.order_by(desc(data_files.c.start_time))
 
+    return query
+
+def extract_df_jams(meta, date_begin, date_end, weekends=True, periods=None):
+    query = jams_query(meta, date_begin, date_end, weekends, periods)
     df_jams = pd.read_sql(query, meta.bind)
         
     return df_jams
 
-def transform_geo_jams(df_jams):
+def stream_sql(query, engine, chunksize):
+    """
+    Read the result of query in DataFrames of chunksize rows through a server-side cursor,
+    so that only one chunk at a time is held in memory.
+    """
+    with engine.connect() as con:
+        con = con.execution_options(stream_results=True)
+        for df in pd.read_sql(query, con, chunksize=chunksize):
+            yield df
+
+def align_chunks(chunks, key):
+    """
+    Re-cut a sequence of DataFrames sorted by key(df) so that rows with the same key are never split
+    between two chunks: the rows of the last key of each chunk are moved to the next one.
+    """
+    held = None
+    for df in chunks:
+        if held is not None:
+            df = pd.concat([held, df], ignore_index=True)
+        if len(df) == 0:
+            continue
+        keys = key(df)
+        last = (keys == keys.iloc[-1]).all(axis=1) if isinstance(keys, pd.DataFrame) else keys == keys.iloc[-1]
+        held = df[last]
+        if (~last).any():
+            yield df[~last].reset_index(drop=True)
+    if held is not None and len(held):
+        yield held.reset_index(drop=True)
+
+def iter_df_jams(meta, date_begin, date_end, weekends=True, periods=None, chunksize=50000):
+    """
+    extract_df_jams in chunks of about chunksize rows, read through a server-side cursor.
+    The jams of a data file are never split between chunks, so transform_geo_jams and allocate_jams
+    can be applied chunk by chunk over any period.
+    """
+    query = jams_query(meta, date_begin, date_end, weekends, periods)
+    return align_chunks(stream_sql(query, meta.bind, chunksize), lambda df: df["id"])
+
+LOCAL_TIMEZONE = "America/Sao_Paulo"
+
+def minute_bin_labels(bin_width=15):
+    """
+    Labels of the minute bins of an hour: "0 a 14", "15 a 29", ... for 15 minute bins.
+    """
+    if 60 % bin_width:
+        raise ValueError("bin_width must divide an hour, e.g. 5, 10 or 15 minutes")
+    return [str(m) + " a " + str(m + bin_width - 1) for m in range(0, 60, bin_width)]
+
+def minute_bins(minute, bin_width=15):
+    """
+    Categorical minute_bin of minutes (0 to 59), with the categories of minute_bin_labels.
+    """
+    codes = np.asarray(minute, dtype=int) // bin_width
+    return pd.Categorical.from_codes(codes, minute_bin_labels(bin_width))
+
+def local_time(start_time, tz=LOCAL_TIMEZONE):
+    """
+    Timestamps converted to local time. Naive timestamps are taken as UTC.
+    """
+    return pd.to_datetime(start_time, utc=True).dt.tz_convert(tz)
+
+def time_features(start_time, bin_width=15, tz=LOCAL_TIMEZONE):
+    """
+    Local date, hour, minute, period (-1 morning, 0 noon, 1 afternoon), categorical minute_bin and
+    time_slot (bin of the day as an integer, hour*60/bin_width + minute bin) of timestamps,
+    from datetime fields without formatting them as strings.
+    """
+    start_time = local_time(start_time, tz)
+    hour = start_time.dt.hour.values
+    minute = start_time.dt.minute.values
+    return pd.DataFrame({"date": start_time.dt.date.values,
+                         "hour": hour,
+                         "minute": minute,
+                         "period": np.sign(hour - 12),
+                         "minute_bin": minute_bins(minute, bin_width),
+                         "time_slot": ((hour * 60 + minute) // bin_width).astype(np.int16)},
+                        index=start_time.index,
+                        columns=["date", "hour", "minute", "period", "minute_bin", "time_slot"])
+
+UTM_CRS = "+proj=utm +zone=22J, +south +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
+#Projections by proj string, built once per process
+_projections = {}
+
+def get_projection(crs=UTM_CRS):
+    if crs not in _projections:
+        _projections[crs] = Proj(crs)
+    return _projections[crs]
+
+def line_arrays(lines):
+    """
+    Points of lines given as lists of {"x", "y"}, unpacked into flat x and y arrays, with the offsets
+    of each line: the points of line i are x[offsets[i]:offsets[i+1]]. Missing lines have no points.
+    """
+    lines = [line or () for line in lines]
+    lengths = np.fromiter((len(line) for line in lines), dtype=np.int64, count=len(lines))
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    x = np.fromiter((point["x"] for line in lines for point in line), dtype=float, count=offsets[-1])
+    y = np.fromiter((point["y"] for line in lines for point in line), dtype=float, count=offsets[-1])
+    return x, y, offsets
+
+def build_linestrings(x, y, offsets):
+    """
+    LineStrings of the flat coordinate arrays of line_arrays, one per offset range.
+    Lines with less than 2 points are not valid LineStrings and are None.
+    """
+    coords = np.column_stack([x, y])
+    counts = np.diff(offsets)
+    valid = np.flatnonzero(counts >= 2)
+    geometries = [None] * len(counts)
+    try:
+        #shapely >= 2.0 builds them all in one call
+        from shapely import linestrings
+    except ImportError:
+        for i in valid:
+            geometries[i] = LineString(coords[offsets[i]:offsets[i + 1]])
+        return geometries
+    if len(valid):
+        points = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in valid])
+        indices = np.repeat(np.arange(len(valid)), counts[valid])
+        for i, geometry in zip(valid, linestrings(coords[points], indices=indices)):
+            geometries[i] = geometry
+    return geometries
+
+def project_linestrings(x, y, offsets, crs=UTM_CRS):
+    """
+    LineStrings of the lon/lat arrays of line_arrays projected to "crs", with every point
+    projected in a single call.
+    """
+    x, y = get_projection(crs)(x, y)
+    return build_linestrings(np.asarray(x), np.asarray(y), offsets)
+
+def lines_to_geometries(lines, crs=UTM_CRS):
+    """
+    project_linestrings of lines given as lists of {"x", "y"}.
+    """
+    return project_linestrings(*line_arrays(lines), crs=crs)
+
+def array_endpoints(x, y, offsets):
+    """
+    line_endpoints of the arrays of line_arrays. Lines without points have NaN endpoints.
+    """
+    endpoints = np.full((len(offsets) - 1, 4), np.nan)
+    first, last = offsets[:-1], offsets[1:] - 1
+    present = last >= first
+    endpoints[present] = np.column_stack([x[first[present]], y[first[present]],
+                                          x[last[present]], y[last[present]]])
+    return endpoints
+
+def transform_geo_jams(df_jams, bin_width=15):
     df_jams = df_jams.copy()
+    #Unpack the lines, from line_wkb if the jams were read with it
+    x, y, offsets = df_line_arrays(df_jams)
+
     #Get Directions
-    df_jams[["LonDirection","LatDirection", "MajorDirection"]] = df_jams["line"].apply(get_direction)
+    df_jams[["LonDirection","LatDirection", "MajorDirection"]] = directions(array_endpoints(x, y, offsets),
+                                                                            index=df_jams.index)
 
     #Get date information
-    df_jams.loc[:, "start_time"] = pd.to_datetime(df_jams["start_time"], utc=True)
-    df_jams.loc[:, "start_time"] = df_jams["start_time"].dt.tz_convert("America/Sao_Paulo")
-    df_jams["date"] = df_jams["start_time"].dt.date
-    df_jams["hour"] = df_jams["start_time"].astype(str).str[11:13].astype(int)
-    df_jams["minute"] = df_jams["start_time"].astype(str).str[14:16].astype(int)
-    df_jams["period"] = np.sign(df_jams["hour"]-12)
-
-    #Get minute bins
-    bins = [0, 14, 29, 44, 59]
-    labels = []
-    for i in range(1,len(bins)):
-        if i==1:
-            labels.append(str(bins[i-1]) + " a " + str(bins[i]))
-        else:
-            labels.append(str(bins[i-1]+1) + " a " + str(bins[i]))
-
-    df_jams['minute_bin'] = pd.cut(df_jams["minute"], bins, labels=labels, include_lowest=True)
+    df_jams["start_time"] = local_time(df_jams["start_time"])
+    df_times = time_features(df_jams["start_time"], bin_width)
+    df_jams[df_times.columns.tolist()] = df_times
 
-    #Get Geometries
-    df_jams['jams_line_list'] = df_jams['line'].apply(lambda x: [tuple([d['x'], d['y']]) for d in x])
-    #df_jams['jams_line_UTM'] = df_jams['jams_line_list'].apply(lon_lat_to_UTM)
-    df_jams['linestring'] = df_jams.apply(lambda x: LineString(x['jams_line_list']), axis=1)
-    crs_1 = {'init': 'epsg:4326'}
-    geo_jams = gpd.GeoDataFrame(df_jams, crs=crs_1, geometry="linestring")
-    crs_2 = "+proj=utm +zone=22J, +south +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
-    geo_jams = geo_jams.to_crs(crs_2)
+    #Get Geometries, projected to UTM all at once
+    df_jams["linestring"] = project_linestrings(x, y, offsets, UTM_CRS)
+    geo_jams = gpd.GeoDataFrame(df_jams, crs=UTM_CRS, geometry="linestring")
 
     return geo_jams
 
@@ -194,37 +338,6 @@ def allocate_jams(jams, network, big_buffer, small_buffer, network_directional=F
     Common cross-referencing algorithm to be used by both ArcGis and OSM data.
     """
 
-    def get_main_direction(geometry):
-        if type(geometry) is LineString:
-            delta_x = geometry.coords[-1][0] - geometry.coords[0][0]
-            delta_y = geometry.coords[-1][1] - geometry.coords[0][1]
-        elif type(geometry) is MultiLineString:
-            first_line = list(geometry.geoms)[0]
-            last_line = list(geometry.geoms)[-1]
-
-            delta_x = last_line.coords[-1][0] - first_line.coords[0][0]
-            delta_y = last_line.coords[-1][1] - first_line.coords[0][1]
-        else:
-            raise Exception("geometry must be a Linestring or MultiLineString")
-
-        if network_directional == True:
-            if abs(delta_y) >= abs(delta_x):
-                if delta_y >=0:
-                    return "Norte"
-                else:
-                    return "Sul"
-            else:
-                if delta_x >=0:
-                    return "Leste"
-                else:
-                    return "Oeste"
-
-        if network_directional == False:
-            if abs(delta_y) >= abs(delta_x):
-                return "Norte/Sul"
-            else:
-                return "Leste/Oeste"
-
     def check_directions(x):
         """
         Check for jams whose direction is not aligned with the direction of the street or the section.
@@ -237,7 +350,7 @@ def allocate_jams(jams, network, big_buffer, small_buffer, network_directional=F
             return False
 
     #check CRS
-    crs = "+proj=utm +zone=22J, +south +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
+    crs = UTM_CRS
     if jams.crs != crs:
         jams = jams.to_crs(crs)
         jams.crs = crs
@@ -250,17 +363,12 @@ def allocate_jams(jams, network, big_buffer, small_buffer, network_directional=F
     jams_geometry_name = jams.geometry.name
     network_geometry_name = network.geometry.name 
 
-    jams = (jams
-            .assign(direction=lambda gdf: pd.Series([get_main_direction(row[jams_geometry_name]) for _, row in gdf.iterrows()],
-                                                    index=gdf.index),                      
-            )
-    )
+    #Jams whose line has less than 2 points have no geometry to allocate
+    jams = jams[jams[jams_geometry_name].notnull()]
 
-    network = (network
-            .assign(direction=lambda gdf: pd.Series([get_main_direction(row[network_geometry_name]) for _, row in gdf.iterrows()],
-                                                    index=gdf.index),                      
-            )
-    )
+    jams = jams.assign(direction=main_directions(geometry_endpoints(jams[jams_geometry_name]), network_directional))
+    network = network.assign(direction=main_directions(geometry_endpoints(network[network_geometry_name]),
+                                                       network_directional))
 
     #Create big and small polygons
     jams['jams_small_polygon'] = jams.apply(lambda x: x[jams_geometry_name].buffer(small_buffer), axis=1)
@@ -304,6 +412,40 @@ def allocate_jams(jams, network, big_buffer, small_buffer, network_directional=F
     
     return allocated_jams
 
+class SectionIndex:
+    """
+    R-tree of the section geometries of each street, to find the sections a jam may touch without
+    comparing it with the whole network. Geometries are indexed in lon/lat, like the jam lines,
+    and queried with the jam line buffered by "buffer" degrees (0.0005 is about 50 m).
+    The sections must have a CRS, so that they can be converted to lon/lat.
+    """
+    def __init__(self, sections, street_column, buffer=0.0005):
+        if not sections.crs:
+            raise ValueError("The sections have no CRS")
+        if sections.crs != {'init': 'epsg:4326'}:
+            sections = sections.to_crs({'init': 'epsg:4326'})
+        self.buffer = buffer
+        self.trees = {}
+        for street, group in sections.groupby(street_column):
+            geometries = list(group.geometry)
+            self.trees[street] = (STRtree(geometries), geometries, group.index.values)
+
+    def candidates(self, street, line):
+        """
+        Index labels of the sections of "street" whose bounding box is near the line (a list of {"x", "y"}).
+        """
+        if street not in self.trees or not line:
+            return []
+        coords = [(point["x"], point["y"]) for point in line]
+        geometry = LineString(coords) if len(coords) > 1 else Point(coords[0])
+        tree, geometries, labels = self.trees[street]
+        hits = tree.query(geometry.buffer(self.buffer))
+        if len(hits) and not isinstance(hits[0], (int, np.integer)):
+            #shapely < 2.0 returns the geometries instead of their positions
+            position = {id(g): i for i, g in enumerate(geometries)}
+            hits = [position[id(g)] for g in hits]
+        return list(labels[sorted(hits)])
+
 def df_to_geojson(df, filename="result_geojson.json"):
     features = []
     df.apply(lambda x: features.append(
@@ -323,35 +465,81 @@ def df_to_geojson(df, filename="result_geojson.json"):
     with open(filename, "w") as fp:
         geojson.dump(geojson.FeatureCollection(features), fp, sort_keys=True)
 
-def get_direction(coord_list):
-    try:
-      num_coords = len(coord_list)
-    except:
-      return pd.Series([None, None])
-    
-    #North/South
-    y_start = coord_list[0]["y"]
-    y_end = coord_list[num_coords-1]["y"]
-    delta_y = (y_end-y_start)
-    if delta_y >= 0:
-        lat_direction = "North"
-    else:
-        lat_direction = "South"
-        
-    #East/West
-    x_start = coord_list[0]["x"]
-    x_end = coord_list[num_coords-1]["x"]
-    delta_x = (x_end-x_start)
-    if delta_x >= 0:
-        lon_direction = "East"
-    else:
-        lon_direction = "West"
-
-    #MajorDirection
-    if abs(delta_y) > abs(delta_x):
-        major_direction = "North/South"
-    else:
-        major_direction = "East/West"
+LON_DIRECTIONS = ["East", "West"]
+LAT_DIRECTIONS = ["North", "South"]
+MAJOR_DIRECTIONS = ["East/West", "North/South"]
 
-        
-    return pd.Series([lon_direction, lat_direction, major_direction])
+def line_endpoints(lines):
+    """
+    First and last points of lines given as lists of {"x", "y"}, packed in an (n, 4) float array of
+    x_start, y_start, x_end, y_end. Rows of missing or empty lines are NaN.
+    """
+    endpoints = np.full((len(lines), 4), np.nan)
+    for i, line in enumerate(lines):
+        if isinstance(line, (list, tuple)) and line:
+            endpoints[i] = (line[0]["x"], line[0]["y"], line[-1]["x"], line[-1]["y"])
+    return endpoints
+
+def geometry_endpoints(geometries):
+    """
+    line_endpoints of shapely LineStrings and MultiLineStrings (first point of the first line,
+    last point of the last one).
+    """
+    endpoints = np.full((len(geometries), 4), np.nan)
+    for i, geometry in enumerate(geometries):
+        if type(geometry) is MultiLineString:
+            lines = list(geometry.geoms)
+            first, last = lines[0].coords[0], lines[-1].coords[-1]
+        elif type(geometry) is LineString:
+            first, last = geometry.coords[0], geometry.coords[-1]
+        else:
+            raise Exception("geometry must be a Linestring or MultiLineString")
+        endpoints[i] = (first[0], first[1], last[0], last[1])
+    return endpoints
+
+def directions(endpoints, index=None):
+    """
+    LonDirection, LatDirection and MajorDirection (categoricals) of packed endpoints, as get_direction:
+    a line that does not move north or east goes north or east, and a line goes North/South only if
+    it moves more in latitude than in longitude. Missing endpoints give missing directions.
+    """
+    delta_x = endpoints[:, 2] - endpoints[:, 0]
+    delta_y = endpoints[:, 3] - endpoints[:, 1]
+    missing = np.isnan(delta_x) | np.isnan(delta_y)
+
+    def categorical(codes, categories):
+        return pd.Categorical.from_codes(np.where(missing, -1, codes), categories)
+
+    return pd.DataFrame({"LonDirection": categorical((delta_x < 0).astype(int), LON_DIRECTIONS),
+                         "LatDirection": categorical((delta_y < 0).astype(int), LAT_DIRECTIONS),
+                         "MajorDirection": categorical((np.abs(delta_y) > np.abs(delta_x)).astype(int),
+                                                       MAJOR_DIRECTIONS)},
+                        index=index,
+                        columns=["LonDirection", "LatDirection", "MajorDirection"])
+
+def line_directions(lines):
+    """
+    directions of a Series of lines (lists of {"x", "y"}), with the same index.
+    """
+    return directions(line_endpoints(list(lines)), index=lines.index)
+
+def main_directions(endpoints, directional=False):
+    """
+    Direction of each line in Portuguese, as allocate_jams compares them: "Norte", "Sul", "Leste" or
+    "Oeste" if directional, else "Norte/Sul" or "Leste/Oeste". Ties go to north/south.
+    """
+    delta_x = endpoints[:, 2] - endpoints[:, 0]
+    delta_y = endpoints[:, 3] - endpoints[:, 1]
+    vertical = np.abs(delta_y) >= np.abs(delta_x)
+    if directional:
+        return np.where(vertical, np.where(delta_y >= 0, "Norte", "Sul"),
+                        np.where(delta_x >= 0, "Leste", "Oeste"))
+    return np.where(vertical, "Norte/Sul", "Leste/Oeste")
+
+def get_direction(coord_list):
+    """
+    directions of a single line, as a Series of LonDirection, LatDirection and MajorDirection.
+    Use line_directions for a whole column.
+    """
+    endpoints = line_endpoints([coord_list])
+    return pd.Series(directions(endpoints).astype(object).iloc[0].values)
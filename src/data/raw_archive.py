@@ -0,0 +1,153 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+sys.path.append(project_dir)
+
+import csv
+import json
+import gzip
+import datetime
+import argparse
+
+import pandas as pd
+
+INDEX_FILE = "index.csv"
+INDEX_COLUMNS = ["file", "n_records", "first_id", "last_id", "start_time_min", "start_time_max"]
+
+def id_string(rec):
+    """
+    _id of a record as a string, for pymongo documents (ObjectId) as well as extended JSON ({"$oid": ...}).
+    """
+    _id = rec.get("_id")
+    if type(_id) is dict and "$oid" in _id:
+        return _id["$oid"]
+    return str(_id) if _id is not None else ""
+
+def write_archive_file(archive_dir, filename, records, dumps=json.dumps, compresslevel=6):
+    """
+    Write records as gzip compressed NDJSON (one data file per line) and add the file to the archive index.
+    "dumps" serializes one record; pass bson.json_util.dumps for documents read with pymongo.
+    Returns the index entry.
+    """
+    tmp_path = os.path.join(archive_dir, filename + ".tmp")
+    start_times = []
+    with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=compresslevel) as f:
+        for rec in records:
+            f.write(dumps(rec))
+            f.write("\n")
+            if rec.get("startTimeMillis") is not None:
+                start_times.append(rec["startTimeMillis"])
+    os.replace(tmp_path, os.path.join(archive_dir, filename))
+
+    entry = {"file": filename,
+             "n_records": len(records),
+             "first_id": id_string(records[0]) if records else "",
+             "last_id": id_string(records[-1]) if records else "",
+             "start_time_min": min(start_times) if start_times else "",
+             "start_time_max": max(start_times) if start_times else "",
+            }
+    index_path = os.path.join(archive_dir, INDEX_FILE)
+    new_index = not os.path.exists(index_path)
+    with open(index_path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS)
+        if new_index:
+            writer.writeheader()
+        writer.writerow(entry)
+
+    return entry
+
+def read_index(archive_dir):
+    """
+    Archive index as a DataFrame sorted by file name. A file written twice (an export that was
+    interrupted and resumed) keeps its last entry.
+    """
+    index_path = os.path.join(archive_dir, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+    index = pd.read_csv(index_path, dtype={"file": str, "first_id": str, "last_id": str})
+    index = index.drop_duplicates("file", keep="last").sort_values("file").reset_index(drop=True)
+    return index
+
+def select_files(index, time_begin=None, time_end=None):
+    """
+    Files that may hold records with time_begin <= startTimeMillis < time_end (in milliseconds).
+    """
+    selected = index
+    if time_begin is not None:
+        selected = selected[~(selected["start_time_max"] < time_begin)]
+    if time_end is not None:
+        selected = selected[~(selected["start_time_min"] >= time_end)]
+    return selected["file"].tolist()
+
+def iter_archive_file(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def iter_archive_chunks(archive_dir, chunksize=60, time_begin=None, time_end=None):
+    """
+    Yields (file name, position of the first record in the file, list of at most "chunksize" records),
+    reading only the files whose time range overlaps [time_begin, time_end).
+    """
+    for filename in select_files(read_index(archive_dir), time_begin, time_end):
+        rec_list = []
+        first_position = 0
+        for position, rec in enumerate(iter_archive_file(os.path.join(archive_dir, filename))):
+            start_time = rec.get("startTimeMillis")
+            in_range = not ((time_begin is not None and start_time < time_begin) or
+                            (time_end is not None and start_time >= time_end))
+            if in_range:
+                if not rec_list:
+                    first_position = position
+                rec_list.append(rec)
+            if rec_list and (len(rec_list) == chunksize or not in_range):
+                yield filename, first_position, rec_list
+                rec_list = []
+        if rec_list:
+            yield filename, first_position, rec_list
+
+def tab_archive(archive_dir, chunksize=60, digest="sha1", time_begin=None, time_end=None):
+    """
+    Streaming counterpart of store_data_file.tab_raw_data_chunks for the archive:
+    yields the raw_data DataFrame of each chunk of records.
+    """
+    from src.data.store_data_file import tab_records
+
+    for filename, first_position, rec_list in iter_archive_chunks(archive_dir, chunksize, time_begin, time_end):
+        yield tab_records(filename, rec_list, digest, first_position)
+
+def convert_legacy_file(path, archive_dir, filename=None):
+    """
+    Rewrite a file of the old layout (a JSON string holding the JSON list of records) into the archive.
+    """
+    with open(path) as f:
+        records = json.loads(json.load(f))
+    if filename is None:
+        filename = os.path.basename(path).replace("_.txt", ".ndjson.gz")
+    return write_archive_file(archive_dir, filename, records)
+
+def millis(date_string):
+    date = datetime.datetime.strptime(date_string, "%Y-%m-%d")
+    return int((date - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compressed archive of Waze raw data files")
+    parser.add_argument('archive', type=str, help="Archive directory")
+    parser.add_argument('--convert', type=str, help="Directory with files in the old text layout to add to the archive")
+    parser.add_argument('--begin', type=str, help="YYYY-MM-DD. Only list files with records from this date on")
+    parser.add_argument('--end', type=str, help="YYYY-MM-DD. Only list files with records before this date")
+    args = parser.parse_args()
+
+    if args.convert:
+        files = sorted(f for f in os.listdir(args.convert) if "wazerawdata" in f and f.endswith("_.txt"))
+        for filename in files:
+            path = os.path.join(args.convert, filename)
+            entry = convert_legacy_file(path, args.archive)
+            archived = os.path.getsize(os.path.join(args.archive, entry["file"]))
+            print(filename + ":", str(entry["n_records"]), "records,", str(os.path.getsize(path) // 1024), "KB ->",
+                  str(archived // 1024), "KB.")
+
+    index = read_index(args.archive)
+    files = select_files(index, millis(args.begin) if args.begin else None, millis(args.end) if args.end else None)
+    print(index[index["file"].isin(files)].to_string(index=False))
@@ -0,0 +1,306 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+sys.path.append(project_dir)
+
+import argparse
+import datetime
+from timeit import default_timer as timer
+
+import dotenv
+import numpy as np
+import pandas as pd
+from sqlalchemy import MetaData, Table, Column, select, func, extract, case, and_, or_, not_
+from sqlalchemy import BigInteger, Integer, SmallInteger, Float, Text, Date, TIMESTAMP
+from sqlalchemy.dialects.postgresql import insert as pg_insert, ARRAY
+
+from src.data.database_func import connect_database, database_dict_from_env
+from src.data.processing_func import (transform_geo_jams, transform_geo_sections, allocate_jams, time_features,
+                                      line_columns)
+
+dotenv_path = os.path.join(project_dir, '.env')
+dotenv.load_dotenv(dotenv_path)
+
+#Keys of the section rollups: the groups of the TrafficProbabilities and MonitorInterventions notebooks,
+#per date so that any date range (and weekday or holiday filter) can be read back. Jams are also
+#kept apart by level, so that blocked roads (level 5) can be left out when reading.
+SECTION_KEYS = ["id_arcgis", "date", "hour", "minute_bin", "LonDirection", "LatDirection", "MajorDirection", "level"]
+#Summed measures, as (rollup column, allocated_jams column). Each sum has the count of its non null values.
+MEASURES = [("length", "length_jams"), ("speed_kmh", "speed_kmh"), ("delay", "delay")]
+TIMESLOT_KEYS = ["date", "hour", "minute_bin"]
+
+rollup_meta = MetaData()
+section_rollups = Table("section_rollups", rollup_meta,
+                        Column("id_arcgis", BigInteger, primary_key=True),
+                        Column("date", Date, primary_key=True),
+                        Column("hour", SmallInteger, primary_key=True),
+                        Column("minute_bin", Text, primary_key=True),
+                        Column("LonDirection", Text, primary_key=True),
+                        Column("LatDirection", Text, primary_key=True),
+                        Column("MajorDirection", Text, primary_key=True),
+                        Column("level", SmallInteger, primary_key=True),
+                        Column("count_jams", Integer, nullable=False),
+                        Column("length_sum", Float, nullable=False),
+                        Column("length_count", Integer, nullable=False),
+                        Column("speed_kmh_sum", Float, nullable=False),
+                        Column("speed_kmh_count", Integer, nullable=False),
+                        Column("delay_sum", Float, nullable=False),
+                        Column("delay_count", Integer, nullable=False),
+                        schema="waze")
+#Data files added to the rollups and their time slot, the denominator of the slot traffic probability,
+#with the levels of their jams and of their jams allocated to a section (-1 for jams without a level),
+#so that the data files can be counted as in the notebooks for any levels left out.
+#New data files are those missing here: data_files ids are not committed in order by concurrent
+#ingestion workers, so a high-water mark on the id would skip some of them.
+rollup_datafiles = Table("rollup_datafiles", rollup_meta,
+                         Column("datafile_id", BigInteger, primary_key=True),
+                         Column("date", Date, nullable=False),
+                         Column("hour", SmallInteger, nullable=False),
+                         Column("minute_bin", Text, nullable=False),
+                         Column("jam_levels", ARRAY(SmallInteger), nullable=False),
+                         Column("allocated_levels", ARRAY(SmallInteger), nullable=False),
+                         schema="waze")
+#Row locked by each update, so that concurrent updates never add the same data file twice
+rollup_progress = Table("rollup_progress", rollup_meta,
+                        Column("name", Text, primary_key=True),
+                        Column("date_updated", TIMESTAMP),
+                        schema="waze")
+
+def create_rollup_tables(con):
+    rollup_meta.create_all(con)
+    con.execute(pg_insert(rollup_progress).values(name=section_rollups.name).on_conflict_do_nothing())
+
+def timeslots(start_time):
+    """
+    Local date, hour and minute_bin of UTC start times, as computed by transform_geo_jams.
+    """
+    df_times = time_features(start_time)
+    return df_times[TIMESLOT_KEYS].assign(minute_bin=df_times["minute_bin"].astype(str))
+
+def aggregate_jams(allocated_jams):
+    """
+    Section rollup rows (SECTION_KEYS, count and sums) of the output of allocate_jams.
+    Jams without a level are kept under level -1.
+    """
+    df = allocated_jams.assign(minute_bin=allocated_jams["minute_bin"].astype(str),
+                               id_arcgis=allocated_jams["id_arcgis"].astype(np.int64),
+                               level=allocated_jams["level"].fillna(-1).astype(int))
+    aggregations = {"uuid": "count"}
+    renames = {"uuid": "count_jams"}
+    for column, source in MEASURES:
+        df[column + "_sum"] = df[source]
+        df[column + "_count"] = df[source]
+        aggregations[column + "_sum"] = "sum"
+        aggregations[column + "_count"] = "count"
+    return (df.groupby(SECTION_KEYS, observed=True)
+              .agg(aggregations)
+              .rename(columns=renames)
+              .reset_index())
+
+def datafile_levels(df_jams, datafile_ids):
+    """
+    Sorted levels of the jams of each data file in datafile_ids (-1 for jams without a level).
+    """
+    levels = {}
+    if len(df_jams):
+        levels = (df_jams.assign(level=df_jams["level"].fillna(-1).astype(int))
+                         .groupby("datafile_id")["level"]
+                         .apply(lambda l: sorted(set(int(level) for level in l)))
+                         .to_dict())
+    return [levels.get(i, []) for i in datafile_ids]
+
+def upsert_sums(con, table, df, keys):
+    """
+    Insert the rows of df, adding their values to those of the rows already stored with the same keys.
+    """
+    if len(df) == 0:
+        return
+    stmt = pg_insert(table)
+    stmt = stmt.on_conflict_do_update(index_elements=keys,
+                                      set_={c.name: c + stmt.excluded[c.name]
+                                            for c in table.c if c.name not in keys})
+    #astype(object) turns numpy scalars into python ones, which the driver can adapt
+    con.execute(stmt, df.astype(object).to_dict("records"))
+
+def read_new_jams(con, meta, chunksize):
+    """
+    Data files not added to the rollups yet (at most chunksize of them, oldest ids first), and their jams.
+    """
+    jams = meta.tables["waze.jams"]
+    data_files = meta.tables["waze.data_files"]
+    df_files = pd.read_sql(select([data_files.c.id, data_files.c.start_time, data_files.c.start_time_millis])
+                           .select_from(data_files.outerjoin(rollup_datafiles,
+                                                             rollup_datafiles.c.datafile_id == data_files.c.id))
+                           .where(rollup_datafiles.c.datafile_id.is_(None))
+                           .order_by(data_files.c.id)
+                           .limit(chunksize), con)
+    if len(df_files) == 0:
+        return df_files, None
+    #Data files stored before start_time was filled have only start_time_millis
+    df_files["start_time"] = df_files["start_time"].fillna(pd.to_datetime(df_files["start_time_millis"], unit="ms"))
+
+    query = (select([data_files.c.start_time,
+                     data_files.c.id.label("datafile_id"),
+                     jams.c.uuid,
+                     jams.c.street,
+                     jams.c.level,
+                     jams.c.length,
+                     jams.c.speed_kmh,
+                     jams.c.speed,
+                     jams.c.delay,
+                     *line_columns(jams)])
+             .select_from(jams.join(data_files))
+             .where(data_files.c.id.in_([int(i) for i in df_files["id"]])))
+    if "start_time" in jams.c:
+        #Partition pruning (src/database/partitions.py)
+        query = query.where(jams.c.start_time.between(df_files["start_time"].min(), df_files["start_time"].max()))
+    df_jams = pd.read_sql(query, con)
+    df_jams["start_time"] = df_jams["datafile_id"].map(df_files.set_index("id")["start_time"])
+    return df_files, df_jams
+
+def update_rollups(meta, geo_sections, chunksize=360, big_buffer=20, small_buffer=10):
+    """
+    Allocate the jams of the data files not added to the rollups yet to the sections and add them
+    to the rollups, chunksize data files at a time. Each chunk is one transaction that also records
+    its data files in rollup_datafiles, so a failed or concurrent update never counts a data file twice.
+    Returns the number of data files added.
+    """
+    if "waze.jams" not in meta.tables:
+        meta.reflect(schema="waze")
+    with meta.bind.begin() as con:
+        create_rollup_tables(con)
+
+    added = 0
+    while True:
+        start = timer()
+        with meta.bind.begin() as con:
+            con.execute(select([rollup_progress.c.name])
+                        .where(rollup_progress.c.name == section_rollups.name)
+                        .with_for_update())
+            df_files, df_jams = read_new_jams(con, meta, chunksize)
+            if len(df_files) == 0:
+                break
+
+            allocated_jams = df_jams.iloc[:0]
+            if len(df_jams):
+                allocated_jams = allocate_jams(transform_geo_jams(df_jams), geo_sections, big_buffer, small_buffer)
+                upsert_sums(con, section_rollups, aggregate_jams(allocated_jams), SECTION_KEYS)
+
+            df_slots = timeslots(df_files["start_time"]).assign(datafile_id=df_files["id"].astype(np.int64),
+                                                                jam_levels=datafile_levels(df_jams, df_files["id"]),
+                                                                allocated_levels=datafile_levels(allocated_jams,
+                                                                                                 df_files["id"]))
+            con.execute(rollup_datafiles.insert(), df_slots.astype(object).to_dict("records"))
+
+            con.execute(rollup_progress.update()
+                        .where(rollup_progress.c.name == section_rollups.name)
+                        .values(date_updated=func.now()))
+        added += len(df_files)
+        print("Added", str(len(df_files)), "data files to the rollups in", str(round(timer() - start, 2)), "s.")
+
+    return added
+
+def read_geo_sections(meta):
+    if "geo.sections" not in meta.tables:
+        meta.reflect(schema="geo")
+    sections = meta.tables["geo.sections"]
+    df_sections = pd.read_sql(select([c for c in sections.c if c.name != "id"]), meta.bind)
+    return transform_geo_sections(df_sections)
+
+def rollup_filters(table, date_begin, date_end, weekends=True, periods=None, exclude_dates=None):
+    """
+    Filters of extract_df_jams (date range, weekdays, hour periods), plus dates to leave out (holidays).
+    """
+    filters = [table.c.date.between(date_begin, date_end)]
+    if not weekends:
+        filters.append(extract("isodow", table.c.date).in_(list(range(1,6))))
+    if periods:
+        filters.append(or_(*[and_(table.c.hour >= t[0], table.c.hour < t[1]) for t in periods]))
+    if exclude_dates:
+        filters.append(not_(table.c.date.in_(list(exclude_dates))))
+    return filters
+
+def read_section_traffic(meta, date_begin, date_end, weekends=True, periods=None, exclude_dates=None,
+                         exclude_levels=(5,), count_datafiles="allocated", group_by=("hour", "minute_bin")):
+    """
+    Per section, direction and time slot over the period: count_uuid, the means of length_jams,
+    speed_kmh, delay and level, period, count_datafiles and slot_traffic_prob (count_uuid/count_datafiles,
+    capped at 1), as computed from allocate_jams in the TrafficProbabilities notebook.
+    exclude_levels are left out of the jams, as blocked roads (level 5) are in that notebook.
+    count_datafiles is the number of data files per time slot that have: "allocated", a jam of a
+    level not excluded allocated to a section (the unique start_time of the allocated jams in that
+    notebook); "jams", any jam of a level not excluded (as in the MonitorInterventions notebooks);
+    "all", every data file of the slot, with or without jams.
+    group_by are the time slot keys, e.g. ("date", "hour", "minute_bin") to keep days apart.
+    """
+    group_by = list(group_by)
+    section_keys = ["id_arcgis", "LonDirection", "LatDirection", "MajorDirection"] + group_by
+    filters = rollup_filters(section_rollups, date_begin, date_end, weekends, periods, exclude_dates)
+    if exclude_levels:
+        filters.append(not_(section_rollups.c.level.in_(list(exclude_levels))))
+
+    #Jams without a level are stored with level -1 and left out of the mean level
+    has_level = section_rollups.c.level >= 0
+    sums = [func.sum(section_rollups.c.count_jams).label("count_uuid"),
+            func.sum(case([(has_level, section_rollups.c.level * section_rollups.c.count_jams)])).label("level_sum"),
+            func.sum(case([(has_level, section_rollups.c.count_jams)])).label("level_count")]
+    for column, _ in MEASURES:
+        sums += [func.sum(section_rollups.c[column + "_sum"]).label(column + "_sum"),
+                 func.sum(section_rollups.c[column + "_count"]).label(column + "_count")]
+    query = (select([section_rollups.c[k] for k in section_keys] + sums)
+             .where(and_(*filters))
+             .group_by(*[section_rollups.c[k] for k in section_keys]))
+    df = pd.read_sql(query, meta.bind)
+
+    slot_filters = rollup_filters(rollup_datafiles, date_begin, date_end, weekends, periods, exclude_dates)
+    if count_datafiles not in ("allocated", "jams", "all"):
+        raise ValueError("count_datafiles must be 'allocated', 'jams' or 'all'")
+    if count_datafiles != "all":
+        levels = rollup_datafiles.c.allocated_levels if count_datafiles == "allocated" else rollup_datafiles.c.jam_levels
+        if exclude_levels:
+            #Some level of the data file is not excluded
+            slot_filters.append(not_(levels.contained_by([int(l) for l in exclude_levels])))
+        else:
+            slot_filters.append(func.cardinality(levels) > 0)
+    slot_query = (select([rollup_datafiles.c[k] for k in group_by]
+                         + [func.count(rollup_datafiles.c.datafile_id).label("count_datafiles")])
+                  .where(and_(*slot_filters))
+                  .group_by(*[rollup_datafiles.c[k] for k in group_by]))
+    df_slots = pd.read_sql(slot_query, meta.bind)
+
+    df["level"] = df["level_sum"] / df["level_count"].replace(0, np.nan)
+    for column, source in MEASURES:
+        df[source] = df[column + "_sum"] / df[column + "_count"].replace(0, np.nan)
+    df["period"] = np.sign(df["hour"] - 12) if "hour" in group_by else np.nan
+    df = df.drop([c for c in df.columns if c.endswith("_sum") or c.endswith("_count")], axis=1)
+
+    df = df.merge(df_slots, on=group_by, how="left")
+    df["slot_traffic_prob"] = (df["count_uuid"] / df["count_datafiles"]).clip(upper=1)
+
+    return df
+
+def read_pre_post(meta, intervention_begin, intervention_end, days, **kwargs):
+    """
+    read_section_traffic for the "days" before the intervention ("pre") and after it ("post"),
+    with a pre_post column, as in the MonitorInterventions notebooks: unless given, jams of every level
+    are kept and count_datafiles counts the data files with any jam.
+    """
+    kwargs.setdefault("exclude_levels", None)
+    kwargs.setdefault("count_datafiles", "jams")
+    pre = read_section_traffic(meta, intervention_begin - datetime.timedelta(days=days),
+                               intervention_begin - datetime.timedelta(days=1), **kwargs)
+    post = read_section_traffic(meta, intervention_end + datetime.timedelta(days=1),
+                                intervention_end + datetime.timedelta(days=days), **kwargs)
+    return pd.concat([pre.assign(pre_post="pre"), post.assign(pre_post="post")], ignore_index=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add the data files stored since the last run to the section rollups")
+    parser.add_argument('--chunksize', type=int, default=360, help="Data files per transaction")
+    parser.add_argument('--bigbuffer', type=float, default=20, help="Big buffer of allocate_jams, in meters")
+    parser.add_argument('--smallbuffer', type=float, default=10, help="Small buffer of allocate_jams, in meters")
+    args = parser.parse_args()
+
+    meta = connect_database(database_dict_from_env(), schemas=["waze", "geo"])
+    geo_sections = read_geo_sections(meta)
+    added = update_rollups(meta, geo_sections, args.chunksize, args.bigbuffer, args.smallbuffer)
+    print("Added", str(added), "data files to the rollups.")
@@ -4,48 +4,157 @@ project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
 sys.path.append(project_dir)
 
 import json
+import codecs
+from contextlib import closing
+import argparse
+from io import StringIO
 import numpy as np
 import pandas as pd
 from pandas.io.json import json_normalize
 import hashlib 
 import time
+import multiprocessing
 import boto3
 
-from sqlalchemy import create_engine, exc, MetaData, select
+from src.data.database_func import connect_database, reset_engines
+from src.data.fingerprint import canonical_record, get_hasher
+from src.data.ingestion_manifest import IngestionManifest
+from src.data.packed_lines import pack_lines, PACKED_TABLES
+
+from sqlalchemy import create_engine, exc, MetaData, select, Table, Column, text
+from sqlalchemy import Integer, BigInteger, Text, String, TIMESTAMP, LargeBinary
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.engine.url import URL
 from sqlalchemy.sql import or_, and_
 from sqlalchemy.types import JSON as typeJSON
 
-def connect_database(database_dict):
-
-    DATABASE = database_dict
-
-    db_url = URL(**DATABASE)
-    engine = create_engine(db_url)
-    meta = MetaData()
-    meta.bind = engine
-
-    return meta
-
-def tab_raw_data(s3key, s3object):
-
-    def build_raw_df(rec_list):
-        df_list = []
-        for rec in rec_list:
-            rec["rec_string"] = json.dumps(rec, sort_keys=True)
-            rec = json_normalize(rec)
-            df_list.append(rec)
-        raw_data = pd.concat(df_list)
-        return raw_data
+#waze.data_files as declared in src/database/schema.sql, so that inserts don't need to reflect the schema.
+waze_meta = MetaData()
+data_files_table = Table("data_files", waze_meta,
+                         Column("id", Integer, primary_key=True),
+                         Column("start_time_millis", BigInteger, nullable=False),
+                         Column("end_time_millis", BigInteger, nullable=False),
+                         Column("start_time", TIMESTAMP),
+                         Column("end_time", TIMESTAMP),
+                         Column("date_created", TIMESTAMP),
+                         Column("date_updated", TIMESTAMP),
+                         Column("file_name", Text, nullable=False),
+                         Column("json_hash", String(40), nullable=False),
+                         schema="waze")
+
+def iter_json_records(stream, read_size=2**16):
+    """
+    Parse a JSON list of records (or a single record) incrementally from a binary or text stream,
+    yielding one dict at a time, so that the whole file never has to be held in memory.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def read_more(buffer, pos):
+        chunk = stream.read(read_size)
+        if not chunk:
+            return buffer[pos:], 0, True
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk)
+        return buffer[pos:] + chunk, 0, False
+
+    def skip_whitespace(buffer, pos, eof, separators=" \t\r\n"):
+        while True:
+            while pos < len(buffer) and buffer[pos] in separators:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return buffer, pos, eof
+            buffer, pos, eof = read_more(buffer, pos)
+
+    buffer, pos, eof = skip_whitespace(buffer, pos, eof)
+    if pos == len(buffer):
+        return
+    if buffer[pos] != "[":
+        #Single record: there is nothing to stream
+        while not eof:
+            buffer, pos, eof = read_more(buffer, pos)
+        rec = json.loads(buffer[pos:])
+        if type(rec) is not dict:
+            raise Exception("It should be a list.")
+        yield rec
+        return
+    pos += 1
+
+    while True:
+        buffer, pos, eof = skip_whitespace(buffer, pos, eof, separators=" \t\r\n,")
+        if pos == len(buffer):
+            raise Exception("Unexpected end of data file.")
+        if buffer[pos] == "]":
+            return
+        try:
+            rec, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            if eof:
+                raise
+            buffer, pos, eof = read_more(buffer, pos)
+            continue
+        if end == len(buffer) and not eof:
+            #The record may still continue in the next read
+            buffer, pos, eof = read_more(buffer, pos)
+            continue
+        yield rec
+        pos = end
+
+def build_raw_df(rec_list):
+    df_list = []
+    for rec in rec_list:
+        rec_string, aji_strings = canonical_record(rec)
+        rec = json_normalize(rec)
+        rec["rec_string"] = rec_string
+        rec["aji_strings"] = [aji_strings]
+        df_list.append(rec)
+    raw_data = pd.concat(df_list)
+    return raw_data
 
+def tab_raw_data(s3key, s3object, digest="sha1"):
     #read data file and convert it to a list of dicts.
-    file = s3object['Body'].read()
+    with closing(s3object['Body']) as body:
+        file = body.read()
     rec_list = json.loads(file)
     if type(rec_list) is dict:
         rec_list = [rec_list]
     if type(rec_list) is not list:
         raise Exception("It should be a list.")
 
+    return tab_records(s3key, rec_list, digest)
+
+def tab_raw_data_chunks(s3key, s3object, chunksize=60, digest="sha1", skip=0):
+    """
+    Streaming version of tab_raw_data: records are parsed from the body stream as it is read
+    and tabulated in DataFrames of at most "chunksize" data files.
+    The first "skip" records are parsed but not tabulated, to resume a partially stored object.
+    """
+    rec_list = []
+    first_position = skip
+    #The body is closed when the object is exhausted, or when the generator is closed or collected
+    with closing(s3object['Body']) as body:
+        for position, rec in enumerate(iter_json_records(body)):
+            if position < skip:
+                continue
+            rec_list.append(rec)
+            if len(rec_list) == chunksize:
+                yield tab_records(s3key, rec_list, digest, first_position)
+                first_position += len(rec_list)
+                rec_list = []
+    if rec_list:
+        yield tab_records(s3key, rec_list, digest, first_position)
+
+def tab_records(s3key, rec_list, digest="sha1", first_position=0):
+    """
+    Tabulate a list of data file records. Every record and child object is serialized once by
+    canonical_record and hashed with "digest" (see fingerprint.get_hasher); the child hashes are kept
+    in the "aji_ids" column and used as jam, alert and irregularity ids by flatten_aji.
+    "record_position" is the position of each record in its S3 object, starting at first_position.
+    """
+    hasher = get_hasher(digest)
     raw_data = build_raw_df(rec_list)
 
     #Get rid of oid (pymongo) if it exists. From now on, object is the same regardless of source.
@@ -65,33 +174,79 @@ def tab_raw_data(s3key, s3object):
 
     #get_file_name
     raw_data['file_name'] = s3key
+    raw_data['record_position'] = range(first_position, first_position + len(raw_data))
 
-    #get DataFile hash
-    raw_data['json_hash'] = raw_data["rec_string"].apply(lambda x: hashlib.sha1(x.encode()).hexdigest()) 
+    #get DataFile hash and the hashes of its jams, alerts and irregularities
+    raw_data['json_hash'] = [hasher(rec_string) for rec_string in raw_data["rec_string"]]
+    raw_data['aji_ids'] = [{aji_type: [hasher(aji_string) for aji_string in aji_list]
+                            for aji_type, aji_list in aji_strings.items()}
+                           for aji_strings in raw_data["aji_strings"]]
 
     return raw_data
 
-def sep_aji_records(raw_data, aji_type):
-    recs = []
-    for aji in raw_data[aji_type].iloc[0]:
-        aji["rootStartTime"] = raw_data.startTimeMillis.iloc[0]
-        df_aji = json_normalize(aji)
-        df_aji["rec"] = json.dumps(aji, sort_keys=True)
-        recs.append(df_aji)
-    df = pd.concat(recs)
+def flatten_aji(raw_data, aji_type, col_dict, other_cols):
+    """
+    Tabulate the jams, alerts or irregularities of every data file in raw_data in a single pass.
+    Each output column is filled from the key renamed to it in col_dict, or from the key with the
+    same name for other_cols. Missing keys are left as NaN.
+    The "rec" column holds the serialized object (with its data file's startTimeMillis as rootStartTime)
+    and "id" its hash, both taken from the "aji_strings"/"aji_ids" columns of tab_records when present.
+    The index is the json_hash of the parent data file.
+    """
+    col_list = list(col_dict.values()) + other_cols
+    src_keys = {v: k for k, v in col_dict.items()}
+    for col in other_cols:
+        if col not in col_dict:
+            src_keys.setdefault(col, col)
+
+    n_files = len(raw_data)
+    aji_strings = raw_data["aji_strings"] if "aji_strings" in raw_data else [None]*n_files
+    aji_ids = raw_data["aji_ids"] if "aji_ids" in raw_data else [None]*n_files
+    parents = [(json_hash, int(root_start_time), aji_list,
+                strings.get(aji_type) if strings else None,
+                ids.get(aji_type) if ids else None)
+               for json_hash, root_start_time, aji_list, strings, ids in zip(raw_data["json_hash"],
+                                                                             raw_data["startTimeMillis"],
+                                                                             raw_data[aji_type],
+                                                                             aji_strings,
+                                                                             aji_ids)
+               if type(aji_list) is list]
+    n = sum(len(aji_list) for _, _, aji_list, _, _ in parents)
+
+    columns = {col: [None]*n for col in col_list}
+    recs = [None]*n
+    index = [None]*n
+    i = 0
+    for json_hash, root_start_time, aji_list, strings, ids in parents:
+        if strings is None:
+            strings = [json.dumps(dict(aji, rootStartTime=root_start_time), sort_keys=True) for aji in aji_list]
+        if ids is None:
+            ids = [hash_raw_aji(aji_string) for aji_string in strings]
+        for j, aji in enumerate(aji_list):
+            for col in col_list:
+                key = src_keys.get(col)
+                if key is not None:
+                    columns[col][i] = aji.get(key)
+            columns["id"][i] = ids[j]
+            recs[i] = strings[j]
+            index[i] = json_hash
+            i += 1
+
+    df = pd.DataFrame(columns, columns=col_list, index=pd.Index(index, name="json_hash"))
+    df["rec"] = recs
+
     return df
 
 def hash_raw_aji(raw_aji):
     aji_hash = hashlib.sha1(raw_aji.encode()).hexdigest()
     return aji_hash
 
-def align_all_columns(df, col_list):
-    all_columns = pd.DataFrame(np.nan, index=[0], columns=col_list)
-    df,_ = df.align(all_columns, axis=1)
-    return df
+def has_aji(raw_data, aji_type):
+    return (aji_type in raw_data) and any(type(aji_list) is list and len(aji_list) > 0
+                                          for aji_list in raw_data[aji_type])
 
-def tab_jams(raw_data):
-    if ('jams' not in raw_data) or (raw_data.jams.iloc[0] is np.nan):
+def tab_jams(raw_data, packed=False):
+    if not has_aji(raw_data, "jams"):
         print("No jams in this data file.")
         return
 
@@ -110,20 +265,19 @@ def tab_jams(raw_data):
     col_list = list(col_dict.values())
     col_list = col_list + other_cols
 
-    df_jams = sep_aji_records(raw_data, "jams")
+    df_jams = flatten_aji(raw_data, "jams", col_dict, other_cols)
     df_jams = (df_jams
-               .rename(columns=col_dict)
-               .pipe(align_all_columns, col_list=col_list)
-               .assign(pub_utc_date=lambda x: pd.to_datetime(x["pub_millis"], unit='ms'),
-                       id=df_jams["rec"].apply(hash_raw_aji)
+               .assign(pub_utc_date=lambda x: pd.to_datetime(x["pub_millis"], unit='ms')
                       )
               )
     df_jams = df_jams[col_list]
+    if packed:
+        df_jams["line_wkb"] = pack_lines(df_jams["line"])
 
     return df_jams
 
-def tab_irregularities(raw_data):
-    if ('irregularities' not in raw_data) or (raw_data.irregularities.iloc[0] is np.nan):
+def tab_irregularities(raw_data, packed=False):
+    if not has_aji(raw_data, "irregularities"):
         print("No irregularities in this data file.")
         return
 
@@ -148,21 +302,20 @@ def tab_irregularities(raw_data):
     col_list = list(col_dict.values())
     col_list = col_list + other_cols
 
-    df_irregs = sep_aji_records(raw_data, "irregularities")
+    df_irregs = flatten_aji(raw_data, "irregularities", col_dict, other_cols)
     df_irregs = (df_irregs
-                 .rename(columns=col_dict)
-                 .pipe(align_all_columns, col_list=col_list)
                  .assign(detection_utc_date=lambda x: pd.to_datetime(x["detection_date_millis"], unit='ms'),
-                         update_utc_date=lambda x: pd.to_datetime(x["update_date_millis"], unit='ms'),
-                         id=df_irregs["rec"].apply(hash_raw_aji)
+                         update_utc_date=lambda x: pd.to_datetime(x["update_date_millis"], unit='ms')
                         )
               )
     df_irregs = df_irregs[col_list]
+    if packed:
+        df_irregs["line_wkb"] = pack_lines(df_irregs["line"])
 
     return df_irregs
 
 def tab_alerts(raw_data):
-    if ('alerts' not in raw_data) or (raw_data.alerts.iloc[0] is np.nan):
+    if not has_aji(raw_data, "alerts"):
         print("No alerts in this data file.")
         return
    
@@ -181,14 +334,11 @@ def tab_alerts(raw_data):
     col_list = list(col_dict.values())
     col_list = col_list + other_cols
 
-    df_alerts = sep_aji_records(raw_data, "alerts")
+    df_alerts = flatten_aji(raw_data, "alerts", col_dict, other_cols)
     df_alerts = (df_alerts
-                 .rename(columns=col_dict)
-                 .pipe(align_all_columns, col_list=col_list)
-                 .assign(location=df_alerts.apply(lambda row: {'x': row["location.x"], 'y': row["location.y"]},
-                                                  axis=1),
-                         pub_utc_date=lambda x: pd.to_datetime(x["pub_millis"], unit='ms'),
-                         id=df_alerts["rec"].apply(hash_raw_aji)
+                 .assign(location=[{'x': loc.get('x'), 'y': loc.get('y')} if type(loc) is dict else None
+                                   for loc in df_alerts["location"]],
+                         pub_utc_date=lambda x: pd.to_datetime(x["pub_millis"], unit='ms')
                         )
 
                 )
@@ -196,96 +346,423 @@ def tab_alerts(raw_data):
 
     return df_alerts
 
-#Connection and initial setup
-DATABASE = {
-'drivername': "postgresql",
-'host': "localhost", 
-'port': 5432,
-'username': "tester",
-'password': "testmobility123",
-'database': "test_mobility",
-}
-
-meta = connect_database(DATABASE)
-
-s3 = boto3.client('s3')
-bucket="scripted-waze-data-929310922828-test"
-#Iterate over all s3 raw data objects
-all_data_files = []
-paginator = s3.get_paginator('list_objects')
-page_iterator = paginator.paginate(Bucket=bucket)
-for page in page_iterator:
-    all_data_files += [c["Key"] for c in page["Contents"]]
-
-for file in all_data_files:
-    #Read raw file
-    obj = s3.get_object(Bucket=bucket, Key=file)
-    raw_data = tab_raw_data(file, obj)
-
-    i=1
-    n = len(raw_data)
-    for _, row in raw_data.iterrows():
+def prep_data_files_tosql(raw_data):
+    col_dict = {"startTimeMillis": "start_time_millis",
+                "endTimeMillis": "end_time_millis",
+                "startTime": "start_time",
+                "endTime": "end_time",
+                "date_created": "date_created" ,
+                "date_updated": "date_updated",
+                "file_name": "file_name",
+                "json_hash": "json_hash",
+                }
+
+    data_files_tosql = raw_data.rename(columns=col_dict)
+    data_files_tosql = data_files_tosql[list(col_dict.values())]
+
+    return data_files_tosql
+
+def insert_data_files(con, raw_data, datafile_ids):
+    """
+    Insert the data files of raw_data with a single INSERT ... ON CONFLICT DO NOTHING RETURNING.
+    Hashes already in datafile_ids, the json_hash -> id dict kept by the caller, are not sent, and
+    hashes already stored by another run are ignored by the database. Returns the dict
+    json_hash -> id of the data files inserted by this call; the caller adds it to datafile_ids
+    once the transaction is committed, so that a rollback does not leave ids that were never stored.
+    """
+    data_files_tosql = (prep_data_files_tosql(raw_data)
+                        .drop_duplicates(subset="json_hash")
+                        .pipe(lambda df: df[~df["json_hash"].isin(datafile_ids)])
+                       )
+    if len(data_files_tosql) == 0:
+        return {}
+
+    #psycopg2 does not adapt numpy scalars or NaN
+    data_files_tosql = data_files_tosql.astype(object)
+    data_files_tosql = data_files_tosql.where(pd.notnull(data_files_tosql), None)
+
+    query = (pg_insert(data_files_table)
+             .values(data_files_tosql.to_dict("records"))
+             .on_conflict_do_nothing(index_elements=["json_hash"])
+             .returning(data_files_table.c.json_hash, data_files_table.c.id)
+            )
+    return dict(con.execute(query).fetchall())
+
+#Columns of the waze tables, per database, read once per process by table_columns
+_table_columns = {}
+
+def table_columns(con, name, schema="waze"):
+    key = (str(con.engine.url), schema, name)
+    if key not in _table_columns:
+        query = text("""SELECT column_name FROM information_schema.columns
+                        WHERE table_schema = :schema AND table_name = :name""")
+        _table_columns[key] = set(r[0] for r in con.execute(query, schema=schema, name=name))
+    return _table_columns[key]
+
+def copy_df_to_table(df, name, schema, con, json_cols=None, bytea_cols=None):
+    """
+    Write a DataFrame with PostgreSQL COPY ... FROM STDIN, using the DBAPI connection behind "con".
+    If "con" is an open SQLAlchemy Connection, the COPY runs inside its current transaction.
+    """
+    df = df.copy()
+    if json_cols:
+        for col in json_cols:
+            df[col] = df[col].apply(lambda x: json.dumps(x) if isinstance(x, (dict, list)) else None)
+    if bytea_cols:
+        for col in bytea_cols:
+            df[col] = df[col].apply(lambda x: "\\x" + x.hex() if x is not None else None)
+
+    #Unquoted empty fields are read as NULL. Floats are written without a trailing ".0",
+    #so integer columns that went through NaN alignment are still accepted.
+    buffer = StringIO()
+    df.to_csv(buffer, index=False, header=False, float_format="%.17g")
+    buffer.seek(0)
+
+    columns = ", ".join('"' + col + '"' for col in df.columns)
+    copy_sql = 'COPY "%s"."%s" (%s) FROM STDIN WITH (FORMAT csv)' % (schema, name, columns)
+    cursor = con.connection.cursor()
+    cursor.copy_expert(copy_sql, buffer)
+    cursor.close()
+
+    return len(df)
+
+def packed_tables(con):
+    """
+    Tables of PACKED_TABLES that have the line_wkb column (see packed_lines.py).
+    """
+    return tuple(aji_type for aji_type in PACKED_TABLES if "line_wkb" in table_columns(con, aji_type))
+
+def tab_children(raw_data, packed=()):
+    """
+    Jams, alerts and irregularities of the data files of raw_data, as {table_name: DataFrame or None},
+    indexed by the json_hash of their data file. Tables in "packed" get the line_wkb column.
+    """
+    raw_data = raw_data.drop_duplicates(subset="json_hash")
+    tab_funcs = {"jams": tab_jams, "alerts": tab_alerts, "irregularities": tab_irregularities}
+    return {aji_type: tab_func(raw_data, packed=True) if aji_type in packed else tab_func(raw_data)
+            for aji_type, tab_func in tab_funcs.items()}
+
+def bulk_store_raw_data(meta, raw_data, datafile_ids=None, children=None):
+    """
+    Store a whole batch of data files (the output of one or many tab_raw_data calls) and their
+    jams, alerts and irregularities inside a single transaction. Data files go through
+    insert_data_files, children are written with COPY.
+    Data files whose json_hash is already stored are skipped, as in the row by row mode.
+    children is the tab_children of raw_data, if it was already tabulated (e.g. in another process).
+    Returns a dict {table_name: (number_of_rows, seconds)}.
+    """
+    stats = {}
+    if datafile_ids is None:
+        datafile_ids = {}
+
+    with meta.bind.begin() as con:
         start = time.time()
-        row = row.to_frame().transpose()
-        #Store data_file in database
-        col_dict = {"startTimeMillis": "start_time_millis",
-                    "endTimeMillis": "end_time_millis",
-                    "startTime": "start_time",
-                    "endTime": "end_time",
-                    "date_created": "date_created" ,
-                    "date_updated": "date_updated",
-                    "file_name": "file_name",
-                    "json_hash": "json_hash",
-                    }
-
-        raw_data_tosql = row.rename(columns=col_dict)
-        raw_data_tosql = raw_data_tosql[list(col_dict.values())]
-        try:
-            raw_data_tosql.to_sql(name="data_files", schema="waze", con=meta.bind, if_exists="append", index=False)
-        except exc.IntegrityError:
-            print("Data file is already stored in the relational database. Stopping process.")
-            break
-
-        #Introspect data_file table
-        meta.reflect(schema="waze")
-        data_files = meta.tables["waze.data_files"]
-        datafile_result = (select([data_files.c.id]).where(data_files.c.json_hash == raw_data["json_hash"].iloc[0])
-                                                   .execute()
-                                                   .fetchall()
-                          )
-        if len(datafile_result) > 1:
-            raise Exception("There should be only one result")
-
-        datafile_id = datafile_result[0][0]
-
-        #Store jams in database
-        jams_tosql = tab_jams(row)
-        if jams_tosql is not None:
-            jams_tosql["datafile_id"] = datafile_id
-            jams_tosql.to_sql(name="jams", schema="waze", con=meta.bind, if_exists="append", index=False,
-                                  dtype={"line": typeJSON}
-                                 )
-
-
-
-        #Store alerts in database
-        alerts_tosql = tab_alerts(row)
-        if alerts_tosql is not None:
-            alerts_tosql["datafile_id"] = datafile_id
-            alerts_tosql.to_sql(name="alerts", schema="waze", con=meta.bind, if_exists="append", index=False,
-                                  dtype={"location": typeJSON}
-                                 )
-
-        #Store irregularities in databse
-        irregs_tosql = tab_irregularities(row)
-        if irregs_tosql is not None:
-            irregs_tosql["datafile_id"] = datafile_id
-            irregs_tosql.to_sql(name="irregularities", schema="waze", con=meta.bind, if_exists="append", index=False,
-                                  dtype={"line": typeJSON}
-                                 )
-
-        end = time.time()
-        elapsed = str(int(end-start))
-
-        print("Stored DataFile", str(i), "of", str(n),"from", file, "in", elapsed, "seconds.")
-        i += 1
+        inserted = insert_data_files(con, raw_data, datafile_ids)
+        skipped = raw_data["json_hash"].nunique() - len(inserted)
+        if skipped:
+            print(str(skipped), "data files are already stored in the relational database. Skipping them.")
+        raw_data = raw_data[raw_data["json_hash"].isin(inserted)].drop_duplicates(subset="json_hash")
+        if len(raw_data) == 0:
+            return stats
+        stats["data_files"] = (len(raw_data), time.time() - start)
+        start_times = raw_data.set_index("json_hash")["startTime"]
+
+        #Tabulate children of all data files at once, with the packed copy of the lines
+        #in databases that have the column
+        if children is None:
+            children = tab_children(raw_data, packed_tables(con))
+        json_cols = {"jams": ["line"], "alerts": ["location"], "irregularities": ["line"]}
+        for aji_type, df_aji in children.items():
+            if df_aji is None:
+                continue
+            #Leave out the children of the data files skipped above
+            df_aji = df_aji[df_aji.index.isin(inserted)].copy()
+            if len(df_aji) == 0:
+                continue
+            packed = "line_wkb" in df_aji.columns
+            start = time.time()
+            df_aji["datafile_id"] = [inserted[json_hash] for json_hash in df_aji.index]
+            if "start_time" in table_columns(con, aji_type):
+                #Partition key of the tables partitioned by src/database/partitions.py
+                df_aji["start_time"] = df_aji.index.map(start_times)
+            n = copy_df_to_table(df_aji, aji_type, "waze", con, json_cols=json_cols[aji_type],
+                                 bytea_cols=["line_wkb"] if packed else None)
+            stats[aji_type] = (n, time.time() - start)
+
+    #Only ids of committed data files are kept
+    datafile_ids.update(inserted)
+    return stats
+
+def print_throughput(stats):
+    for table, (n, elapsed) in stats.items():
+        rate = n / elapsed if elapsed > 0 else float("inf")
+        print("waze." + table + ":", str(n), "rows in", str(round(elapsed, 2)), "seconds (" + str(int(rate)), "rows/s).")
+
+def store_raw_data_by_row(meta, file, raw_data, datafile_ids=None):
+    if datafile_ids is None:
+        datafile_ids = {}
+
+    #The data_files of the object and all their jams, alerts and irregularities are stored in
+    #a single transaction, so that a failure never leaves a data file without its children
+    with meta.bind.begin() as con:
+        #Store all data_files of the object at once and get their ids back
+        inserted = insert_data_files(con, raw_data, datafile_ids)
+        pending = set(inserted)
+        partitioned = {aji_type: "start_time" in table_columns(con, aji_type)
+                       for aji_type in ["jams", "alerts", "irregularities"]}
+        packed = {aji_type: "line_wkb" in table_columns(con, aji_type) for aji_type in PACKED_TABLES}
+
+        i=1
+        n = len(raw_data)
+        for _, row in raw_data.iterrows():
+            start = time.time()
+            if row["json_hash"] not in pending:
+                print("Data file", str(i), "of", str(n), "is already stored in the relational database. Skipping it.")
+                i += 1
+                continue
+            datafile_id = inserted[row["json_hash"]]
+            pending.discard(row["json_hash"])
+            row = row.to_frame().transpose()
+
+            #Store jams in database
+            jams_tosql = tab_jams(row, packed=packed["jams"])
+            if jams_tosql is not None:
+                jams_tosql["datafile_id"] = datafile_id
+                if partitioned["jams"]:
+                    jams_tosql["start_time"] = row["startTime"].iloc[0]
+                jams_tosql.to_sql(name="jams", schema="waze", con=con, if_exists="append", index=False,
+                                      dtype={"line": typeJSON, "line_wkb": LargeBinary}
+                                     )
+
+
+
+            #Store alerts in database
+            alerts_tosql = tab_alerts(row)
+            if alerts_tosql is not None:
+                alerts_tosql["datafile_id"] = datafile_id
+                if partitioned["alerts"]:
+                    alerts_tosql["start_time"] = row["startTime"].iloc[0]
+                alerts_tosql.to_sql(name="alerts", schema="waze", con=con, if_exists="append", index=False,
+                                      dtype={"location": typeJSON}
+                                     )
+
+            #Store irregularities in databse
+            irregs_tosql = tab_irregularities(row, packed=packed["irregularities"])
+            if irregs_tosql is not None:
+                irregs_tosql["datafile_id"] = datafile_id
+                if partitioned["irregularities"]:
+                    irregs_tosql["start_time"] = row["startTime"].iloc[0]
+                irregs_tosql.to_sql(name="irregularities", schema="waze", con=con, if_exists="append", index=False,
+                                      dtype={"line": typeJSON, "line_wkb": LargeBinary}
+                                     )
+
+            end = time.time()
+            elapsed = str(int(end-start))
+
+            print("Stored DataFile", str(i), "of", str(n),"from", file, "in", elapsed, "seconds.")
+            i += 1
+
+    #Only ids of committed data files are kept
+    datafile_ids.update(inserted)
+
+class S3Source:
+    """
+    Raw data files stored as objects of an S3 bucket.
+    The boto3 client is created on first use, so that each worker process opens its own.
+    """
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = boto3.client('s3')
+        return self._client
+
+    def __getstate__(self):
+        return {"bucket": self.bucket, "_client": None}
+
+    def list_keys(self):
+        keys = []
+        paginator = self.client.get_paginator('list_objects')
+        for page in paginator.paginate(Bucket=self.bucket):
+            keys += [c["Key"] for c in page.get("Contents", [])]
+        return keys
+
+    def get_object(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)
+
+class LocalDirectorySource:
+    """
+    Stand-in for an S3 bucket: every file below "path" is an object, keyed by its relative path.
+    get_object returns a dict with a "Body" stream, like boto3 does. The stream is an open file:
+    tab_raw_data and tab_raw_data_chunks close it once read.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def list_keys(self):
+        keys = []
+        for root, _, files in os.walk(self.path):
+            keys += [os.path.relpath(os.path.join(root, f), self.path) for f in files]
+        keys.sort()
+        return keys
+
+    def get_object(self, key):
+        return {"Body": open(os.path.join(self.path, key), "rb")}
+
+#Per process state of the ingestion workers, set by init_ingestion_worker
+_worker = {}
+
+def init_ingestion_worker(database_dict, source, digest="sha1", manifest_path=None):
+    reset_engines()
+    _worker["meta"] = connect_database(database_dict)
+    _worker["source"] = source
+    _worker["digest"] = digest
+    _worker["manifest"] = IngestionManifest(manifest_path) if manifest_path else None
+
+def store_object(key):
+    """
+    Download, tabulate and bulk store one object with the connection of the current worker.
+    The object is streamed through tab_raw_data_chunks, one transaction per chunk.
+    Returns (key, number_of_data_files, stats, seconds).
+    """
+    start = time.time()
+    manifest = _worker["manifest"]
+    skip = manifest.resume_position(key) if manifest else 0
+    s3object = _worker["source"].get_object(key)
+    n = 0
+    stats = {}
+    for raw_data in tab_raw_data_chunks(key, s3object, digest=_worker["digest"], skip=skip):
+        n += len(raw_data)
+        for table, (rows, seconds) in bulk_store_raw_data(_worker["meta"], raw_data).items():
+            stats[table] = (stats.get(table, (0, 0))[0] + rows, stats.get(table, (0, 0))[1] + seconds)
+        if manifest:
+            manifest.add_records(key, raw_data["record_position"], raw_data["json_hash"])
+    if manifest:
+        manifest.finish(key, skip + n)
+
+    return key, n, stats, time.time() - start
+
+def parallel_store_objects(database_dict, source, keys, workers, max_tasks_per_worker=50, digest="sha1",
+                           manifest_path=None):
+    """
+    Spread the objects in "keys" over a pool of worker processes, each one with its own database
+    connection. Objects are handed out one at a time, so at most one object per worker is held in memory,
+    and workers are replaced after max_tasks_per_worker objects to give memory back to the system.
+    Prints the throughput of every object as it finishes and a summary at the end.
+    If manifest_path is given, progress is kept in an IngestionManifest shared by all workers.
+    """
+    start = time.time()
+    summary = []
+    pool = multiprocessing.Pool(processes=workers, initializer=init_ingestion_worker,
+                                initargs=(database_dict, source, digest, manifest_path), maxtasksperchild=max_tasks_per_worker)
+    try:
+        for key, n, stats, elapsed in pool.imap_unordered(store_object, keys, chunksize=1):
+            rows = sum(s[0] for s in stats.values())
+            summary.append({"key": key,
+                            "data_files": n,
+                            "rows": rows,
+                            "seconds": elapsed,
+                            "rows_per_second": rows / elapsed if elapsed > 0 else np.nan,
+                           })
+            print("Stored", key, "(" + str(n), "data files,", str(rows), "rows) in", str(round(elapsed, 2)), "seconds.")
+    finally:
+        pool.close()
+        pool.join()
+
+    summary = pd.DataFrame(summary, columns=["key", "data_files", "rows", "seconds", "rows_per_second"])
+    elapsed = time.time() - start
+    print(summary.to_string(index=False))
+    print("Stored", str(len(summary)), "objects,", str(summary["rows"].sum()), "rows, in", str(round(elapsed, 2)),
+          "seconds with", str(workers), "workers (" + str(int(summary["rows"].sum() / elapsed)), "rows/s).")
+
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store Waze data files from S3 in the relational database")
+    parser.add_argument('--bucket', type=str, default="scripted-waze-data-929310922828-test",
+                        help="S3 bucket holding the raw data files")
+    parser.add_argument('--bulk', action='store_true',
+                        help="Load with COPY, one transaction per batch of objects, instead of row by row")
+    parser.add_argument('--batchobjects', type=int, default=1,
+                        help="Number of S3 objects tabulated and stored per transaction in bulk mode")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="If bigger than 1, spread objects over this many processes (implies --bulk, one object per transaction)")
+    parser.add_argument('--sourcedir', type=str,
+                        help="Read raw data files from this local directory instead of the S3 bucket")
+    parser.add_argument('--digest', type=str, default="sha1", choices=["sha1", "blake2b", "xxh128"],
+                        help="Hash used for data file and child ids. Anything but sha1 is only consistent with data stored with the same digest")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Overlap downloads, tabulation and database writes (see ingest_pipeline.py). Uses --workers tabulation processes")
+    parser.add_argument('--manifest', type=str,
+                        help="SQLite file keeping track of stored objects and data files, to skip or resume them on later runs")
+    args = parser.parse_args()
+
+    #Connection and initial setup
+    DATABASE = {
+    'drivername': "postgresql",
+    'host': "localhost", 
+    'port': 5432,
+    'username': "tester",
+    'password': "testmobility123",
+    'database': "test_mobility",
+    }
+
+    meta = connect_database(DATABASE)
+
+    if args.sourcedir:
+        source = LocalDirectorySource(args.sourcedir)
+    else:
+        source = S3Source(args.bucket)
+    #Iterate over all raw data objects
+    all_data_files = source.list_keys()
+
+    manifest = None
+    if args.manifest:
+        manifest = IngestionManifest(args.manifest)
+        finished = manifest.finished_keys()
+        print("Skipping", str(len(finished & set(all_data_files))), "objects already stored according to the manifest.")
+        all_data_files = [file for file in all_data_files if file not in finished]
+
+    datafile_ids = {}
+    if args.pipeline:
+        from src.data.ingest_pipeline import run_pipeline
+        run_pipeline(DATABASE, source, all_data_files, tabulators=args.workers, digest=args.digest,
+                     manifest_path=args.manifest)
+    elif args.workers > 1:
+        parallel_store_objects(DATABASE, source, all_data_files, args.workers, digest=args.digest,
+                               manifest_path=args.manifest)
+    elif args.bulk:
+        for i in range(0, len(all_data_files), args.batchobjects):
+            batch = all_data_files[i:i+args.batchobjects]
+            raw_data = []
+            for file in batch:
+                skip = manifest.resume_position(file) if manifest else 0
+                raw_data += list(tab_raw_data_chunks(file, source.get_object(file), digest=args.digest, skip=skip))
+            stats = {}
+            if raw_data:
+                raw_data = pd.concat(raw_data)
+                stats = bulk_store_raw_data(meta, raw_data, datafile_ids)
+                if manifest:
+                    for file, file_data in raw_data.groupby("file_name"):
+                        manifest.add_records(file, file_data["record_position"], file_data["json_hash"])
+            if manifest:
+                for file in batch:
+                    manifest.finish(file, manifest.resume_position(file))
+            print("Stored", str(len(batch)), "objects, from", batch[0], "to", batch[-1] + ".")
+            print_throughput(stats)
+    else:
+        for file in all_data_files:
+            #Read raw file
+            obj = source.get_object(file)
+            skip = manifest.resume_position(file) if manifest else 0
+            n = skip
+            for raw_data in tab_raw_data_chunks(file, obj, digest=args.digest, skip=skip):
+                store_raw_data_by_row(meta, file, raw_data, datafile_ids)
+                n += len(raw_data)
+                if manifest:
+                    manifest.add_records(file, raw_data["record_position"], raw_data["json_hash"])
+            if manifest:
+                manifest.finish(file, n)
@@ -12,22 +12,16 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.types import TIMESTAMP as typeTIMESTAMP
 
 from src.data.processing_func import (extract_geo_jams, extract_geo_sections, store_jps, connect_database)
+from src.data.database_func import database_dict_from_env
 
 project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
 dotenv_path = os.path.join(project_dir, '.env')
 dotenv.load_dotenv(dotenv_path)
 
 #Connection and initial setup
-DATABASE = {
-'drivername': os.environ.get("db_drivername"),
-'host': os.environ.get("db_host"), 
-'port': os.environ.get("db_port"),
-'username': os.environ.get("db_username"),
-'password': os.environ.get("db_password"),
-'database': os.environ.get("db_database"),
-}
-
-meta = connect_database(DATABASE)
+DATABASE = database_dict_from_env()
+
+meta = connect_database(DATABASE, schemas=[None])
 
 #Flush JamPersection and Build geo_sections
 flush = None
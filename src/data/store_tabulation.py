@@ -4,8 +4,6 @@ project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
 sys.path.append(project_dir)
 
 import dotenv
-import json
-from io import StringIO
 import geopandas as gpd
 from timeit import default_timer as timer
 
@@ -16,6 +14,7 @@ from sqlalchemy.types import JSON as typeJSON
 
 from src.data.processing_func import (tabulate_records, prep_rawdata_tosql, tabulate_jams,
                                      prep_jams_tosql, connect_database)
+from src.data.raw_archive import iter_archive_chunks
 
 project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
 dotenv_path = os.path.join(project_dir, '.env')
@@ -39,16 +38,9 @@ while (flush != "Y") and (flush != "N") and (flush != "y") and (flush != "n"):
         sys.exit()
 
 #Store Mongo Record info
-all_files = os.listdir(project_dir+"/data/raw/")
-all_files = [file for file in all_files if "_.txt" in file]
-all_files.sort()
-
-for filename in all_files:
+archive_dir = project_dir + "/data/raw/"
+for filename, first_position, records in iter_archive_chunks(archive_dir, chunksize=200):
     start = timer()
-    doc = open(project_dir + "/data/raw/" + filename, "r")
-    json_string = json.load(doc)
-    json_io = StringIO(json_string)
-    records = json.load(json_io)
 
     #Store MongoRecords 
     raw_data = tabulate_records(records)
@@ -65,11 +57,9 @@ for filename in all_files:
                      )
     end = timer()
     duration = str(round(end - start))
-    file_info = filename.split("_")
-    batch_number = file_info[1]
-    batch_size = file_info[-2]
 
-    print("Stored jams from batch " + batch_number + ", with a size of " + batch_size + " documents, in " + duration + " seconds.")
+    print("Stored jams from " + filename + " (records " + str(first_position) + " to " +
+          str(first_position + len(records)) + ") in " + duration + " seconds.")
 
     #Build dataframe of alerts and store in PostgreSQL
 
@@ -0,0 +1,161 @@
+import json
+import random
+import datetime
+import uuid
+
+#Rough bounding box of Joinville's urban area
+LON_RANGE = (-48.95, -48.78)
+LAT_RANGE = (-26.36, -26.20)
+
+STREETS = ["R. Alm. Jaceguay", "R. Timbó", "R. Dr. João Colin", "Av. Santos Dumont", "R. Ottokar Doerffel",
+           "R. Dona Francisca", "Av. Marquês de Olinda", "R. Blumenau", "R. Nove de Março", "R. Otto Boehm",
+           "R. Max Colin", "Av. Getúlio Vargas", "R. Inácio Bastos", "R. Guaíra", "R. Santa Catarina"]
+
+ALERT_TYPES = [("JAM", "JAM_HEAVY_TRAFFIC"), ("JAM", "JAM_STAND_STILL_TRAFFIC"), ("ACCIDENT", "ACCIDENT_MINOR"),
+               ("WEATHERHAZARD", "HAZARD_ON_ROAD_POT_HOLE"), ("WEATHERHAZARD", "HAZARD_ON_ROAD_CAR_STOPPED"),
+               ("ROAD_CLOSED", "ROAD_CLOSED_EVENT")]
+
+def waze_time_string(millis):
+    """
+    Format used by the Waze CCP feed for startTime/endTime, e.g. "2017-09-27 20:17:00:000".
+    """
+    date = datetime.datetime.utcfromtimestamp(millis / 1000)
+    return date.strftime("%Y-%m-%d %H:%M:%S") + ":000"
+
+def random_line(rng, line_length):
+    x = rng.uniform(*LON_RANGE)
+    y = rng.uniform(*LAT_RANGE)
+    heading_x, heading_y = rng.choice([(1, 0), (-1, 0), (0, 1), (0, -1)])
+    line = []
+    for _ in range(line_length):
+        line.append({"x": round(x, 6), "y": round(y, 6)})
+        step = rng.uniform(0.0002, 0.001)
+        x += heading_x*step + rng.gauss(0, 0.00005)
+        y += heading_y*step + rng.gauss(0, 0.00005)
+    return line
+
+def random_length(rng, mean_length):
+    return max(2, int(rng.expovariate(1 / max(mean_length - 2, 1))) + 2)
+
+def generate_jam(rng, start_millis, mean_line_length):
+    line = random_line(rng, random_length(rng, mean_line_length))
+    level = rng.randint(1, 5)
+    speed = rng.uniform(0, 12) if level < 5 else 0
+    jam = {"uuid": rng.randint(1000000, 9999999),
+           "pubMillis": start_millis - rng.randint(0, 3600000),
+           "street": rng.choice(STREETS),
+           "city": "Joinville",
+           "country": "BR",
+           "roadType": rng.choice([1, 2, 6, 7]),
+           "turnType": "NONE",
+           "type": "NONE",
+           "level": level,
+           "delay": -1 if level == 5 else rng.randint(10, 900),
+           "speed": speed,
+           "speedKMH": speed*3.6,
+           "length": rng.randint(50, 3000),
+           "line": line,
+           "segments": [{"fromNode": rng.randint(1, 10**6), "ID": rng.randint(1, 10**8),
+                         "toNode": rng.randint(1, 10**6), "isForward": rng.random() < 0.5}
+                        for _ in range(len(line) - 1)],
+          }
+    if rng.random() < 0.7:
+        jam["endNode"] = rng.choice(STREETS)
+    if rng.random() < 0.05:
+        jam["blockingAlertUuid"] = str(uuid.UUID(int=rng.getrandbits(128)))
+    return jam
+
+def generate_alert(rng, start_millis):
+    alert_type, subtype = rng.choice(ALERT_TYPES)
+    location = random_line(rng, 1)[0]
+    alert = {"uuid": str(uuid.UUID(int=rng.getrandbits(128))),
+             "pubMillis": start_millis - rng.randint(0, 7200000),
+             "street": rng.choice(STREETS),
+             "city": "Joinville",
+             "country": "BR",
+             "roadType": rng.choice([1, 2, 6, 7]),
+             "location": location,
+             "magvar": rng.randint(0, 359),
+             "reliability": rng.randint(0, 10),
+             "confidence": rng.randint(0, 5),
+             "reportRating": rng.randint(0, 5),
+             "nThumbsUp": rng.randint(0, 3),
+             "type": alert_type,
+             "subtype": subtype,
+            }
+    if rng.random() < 0.1:
+        alert["reportDescription"] = "Descrição " + str(rng.randint(1, 100))
+    if rng.random() < 0.3:
+        alert["jamUuid"] = str(uuid.UUID(int=rng.getrandbits(128)))
+    return alert
+
+def generate_irregularity(rng, start_millis, mean_line_length):
+    detection = start_millis - rng.randint(600000, 7200000)
+    update = start_millis - rng.randint(0, 600000)
+    speed = rng.uniform(0, 15)
+    return {"id": rng.randint(10**8, 10**9),
+            "detectionDateMillis": detection,
+            "detectionDate": datetime.datetime.utcfromtimestamp(detection / 1000).strftime("%a %b %d %H:%M:%S +0000 %Y"),
+            "updateDateMillis": update,
+            "updateDate": datetime.datetime.utcfromtimestamp(update / 1000).strftime("%a %b %d %H:%M:%S +0000 %Y"),
+            "street": rng.choice(STREETS),
+            "city": "Joinville",
+            "country": "BR",
+            "speed": speed,
+            "regularSpeed": speed + rng.uniform(5, 30),
+            "delaySeconds": rng.randint(60, 1800),
+            "seconds": rng.randint(60, 3600),
+            "length": rng.randint(200, 5000),
+            "trend": rng.choice([-1, 0, 1]),
+            "type": rng.choice(["SMALL", "MEDIUM", "LARGE"]),
+            "severity": rng.randint(0, 5),
+            "jamLevel": rng.randint(1, 5),
+            "driversCount": rng.randint(1, 50),
+            "alertsCount": rng.randint(0, 5),
+            "nThumbsUp": rng.randint(0, 3),
+            "nComments": rng.randint(0, 3),
+            "nImages": rng.randint(0, 1),
+            "line": random_line(rng, random_length(rng, mean_line_length)),
+           }
+
+def generate_snapshot(rng, start_millis, jams=300, alerts=150, irregularities=20, line_length=20):
+    """
+    One minute of Waze CCP feed, shaped like the records stored in MongoDB.
+    The number of jams, alerts and irregularities varies around the given means,
+    and so does the number of points of each line.
+    """
+    def around(mean):
+        return max(0, int(rng.gauss(mean, mean**0.5))) if mean > 0 else 0
+
+    record = {"_id": {"$oid": "%024x" % rng.getrandbits(96)},
+              "startTimeMillis": start_millis,
+              "endTimeMillis": start_millis + 60000,
+              "startTime": waze_time_string(start_millis),
+              "endTime": waze_time_string(start_millis + 60000),
+             }
+    n_jams, n_alerts, n_irregularities = around(jams), around(alerts), around(irregularities)
+    if n_jams:
+        record["jams"] = [generate_jam(rng, start_millis, line_length) for _ in range(n_jams)]
+    if n_alerts:
+        record["alerts"] = [generate_alert(rng, start_millis) for _ in range(n_alerts)]
+    if n_irregularities:
+        record["irregularities"] = [generate_irregularity(rng, start_millis, line_length)
+                                    for _ in range(n_irregularities)]
+
+    return record
+
+def generate_feed(seed=0, minutes=60, start=datetime.datetime(2018, 3, 15, 7, 0), **kwargs):
+    """
+    A list of "minutes" consecutive snapshots. The same seed always generates the same feed.
+    Extra keyword arguments (jams, alerts, irregularities, line_length) go to generate_snapshot.
+    """
+    rng = random.Random(seed)
+    start_millis = int((start - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+    return [generate_snapshot(rng, start_millis + i*60000, **kwargs) for i in range(minutes)]
+
+def write_feed(path, seed=0, minutes=60, **kwargs):
+    """
+    Write a synthetic data file with the same layout as the S3 objects read by store_data_file.py.
+    """
+    with open(path, "w") as f:
+        json.dump(generate_feed(seed, minutes, **kwargs), f)
@@ -1,8 +1,13 @@
 import sys
 import os
+import time
+import json
+import argparse
+from timeit import default_timer as timer
 
 import pandas as pd
-from pymongo import MongoClient
+import geopandas as gpd
+from pymongo import MongoClient, ASCENDING
 import requests
 import functions
 
@@ -18,78 +23,293 @@ import exceptions
 import dotenv
 
 project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.append(os.path.join(project_dir, os.pardir))
 dotenv_path = os.path.join(project_dir, '.env')
 dotenv.load_dotenv(dotenv_path)
 
-#Collect Data
-r = os.environ.get("waze_url")
-
-record = r.json()
-
-#Insert in MongoDB
-uri = os.environ.get("mongo_uri") #change password and include in ENV VARIABLE
-client = MongoClient(uri)
-db = client.ccp
-collection = db.ccp_collection
-
-try:    
-    result = collection.insert(record)
-except:
-    print("Document already stored")
-
-#Connection and initial setup
-DATABASE = {
-    'drivername': os.environ.get("db_drivername"),
-    'host': os.environ.get("db_host"), 
-    'port': os.environ.get("db_port"),
-    'username': os.environ.get("db_username"),
-    'password': os.environ.get("db_password"), #change password and include in ENV VARIABLE
-    'database': os.environ.get("db_database"),
-}
-db_url = URL(**DATABASE)
-engine = create_engine(db_url)
-meta = MetaData()
-meta.bind = engine
-meta.reflect()
-
-#Store Mongo Record info
-records = [record]
-raw_data = functions.tabulate_records(records)
-rawdata_tosql = functions.prep_rawdata_tosql(raw_data)
-try:
-  rawdata_tosql.to_sql("MongoRecord", con=meta.bind, if_exists="append", index=False)
-except (exc.IntegrityError):
-    print("MongoRecord already stored")
-
-#Build dataframe
-try:
-  df_jams = functions.build_df_jams(raw_data)
-except exceptions.NoJamError:
-    print("No Jam in the given period")
-    sys.exit()
-
-jams_tosql = functions.prep_jams_tosql(df_jams)
-
-#Append jam in "Jam" table
-try:    
-    jams_tosql.to_sql("Jam", con=meta.bind, if_exists="append", index=False, dtype={"JamDscCoordinatesLonLat": typeJSON,                                                                                   "JamDscSegments": typeJSON})
-except (exc.IntegrityError):
-    print("Jam already stored")
-
-#Build df_logr e df_trechos
-lws = meta.tables['LkpWazeSepud']
-logr_query = lws.select()
-df_logr = pd.read_sql(logr_query, con=meta.bind, index_col="LwsId")
-
-df_trechos = functions.build_df_trechos(meta)
-
-#Append jams_per_trecho
-df_jams = pd.merge(df_jams, df_logr, left_on="jams_street", right_on="LwsDscWazeStreet", how="left")
-df_jams['impacted_trechos'] = df_jams.apply(lambda x: functions.get_impacted_trechos(x, df_trechos), axis=1)
-jams_per_trecho = functions.explode_impacted_trechos(df_jams)
-jpt_tosql = functions.prep_jpt_tosql(jams_per_trecho)
-   
-try:
-  jpt_tosql.to_sql("JamPerTrecho", con=meta.bind, if_exists="append", index=False)
-except (exc.IntegrityError):
-    print("JamPerTrecho already stored")
+from src.data.processing_func import SectionIndex
+from src.data.database_func import database_dict_from_env, get_engine, load_metadata
+
+#Tables of the reference data kept by the Collector: the street lookup (df_logr) and the sections
+#read by functions.build_df_trechos (df_trechos)
+REFERENCE_TABLES = ("LkpWazeSepud", "Section")
+#Columns joining the sections to the street lookup (LkpWazeSepud). The lookup table is not
+#defined in this repository, so they are checked when the reference data is loaded.
+SECTION_STREET_KEYS = ["SctnCodRua"]
+
+def fetch_record(url, timeout=30):
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+class Collector:
+    """
+    Keeps the database engine, the reflected tables, the street lookup (df_logr), the section
+    geometries (df_trechos) and their spatial index between snapshots. The reference data is reloaded
+    only when the write counters of the reference tables in pg_stat_user_tables change, or after
+    "max_age" seconds. Sections of jams already allocated in the previous snapshot are reused.
+    With catch_up, every snapshot in MongoDB newer than the last one stored in PostgreSQL is stored,
+    not only the one just collected, so a backlog left by an outage clears on the next run.
+    """
+    def __init__(self, database, collection, url, max_age=3600, catch_up=False, batch_size=60):
+        self.engine = get_engine(database)
+        self.meta = MetaData()
+        self.meta.bind = self.engine
+        self.collection = collection
+        self.url = url
+        self.max_age = max_age
+        self.catch_up = catch_up
+        self.batch_size = batch_size
+        self.version = None
+        self.loaded_at = None
+        self.df_logr = None
+        self.df_trechos = None
+        self.section_index = None
+        self.allocations = {}
+
+    def reference_version(self):
+        """
+        Row write counters of the REFERENCE_TABLES, so that writes to the ingestion, waze.* or rollup
+        tables do not reload the reference data. The statistics collector updates them within a second
+        or so of each commit.
+        """
+        query = text("""SELECT schemaname, relname, n_tup_ins, n_tup_upd, n_tup_del
+                        FROM pg_stat_user_tables WHERE relname = ANY(:tables)
+                        ORDER BY schemaname, relname""")
+        rows = self.engine.execute(query, tables=list(REFERENCE_TABLES)).fetchall()
+        return tuple(tuple(r) for r in rows)
+
+    def refresh_reference(self, force=False):
+        version = self.reference_version()
+        expired = self.loaded_at is None or (time.time() - self.loaded_at) > self.max_age
+        if not force and not expired and version == self.version:
+            return False
+
+        start = timer()
+        tables = set(r[:2] for r in version)
+        if self.version is None or tables != set(r[:2] for r in self.version):
+            self.meta = load_metadata(self.engine, [None])
+        lws = self.meta.tables['LkpWazeSepud']
+        self.df_logr = pd.read_sql(lws.select(), con=self.meta.bind, index_col="LwsId")
+        self.df_trechos = functions.build_df_trechos(self.meta)
+        self.section_index = build_section_index(self.df_trechos, self.df_logr)
+        self.allocations = {}
+        self.version = version
+        self.loaded_at = time.time()
+        print("Reference data loaded in", str(round(timer() - start, 2)), "s.")
+        return True
+
+    def collect(self):
+        #Collect Data
+        record = fetch_record(self.url)
+
+        #Insert in MongoDB
+        try:
+            self.collection.insert(record)
+        except:
+            print("Document already stored")
+
+        self.refresh_reference()
+        if self.catch_up and self.store_pending():
+            return
+        self.allocations = store_record(self.meta, record, self.df_logr, self.df_trechos,
+                                        self.section_index, self.allocations)
+
+    def last_stored_millis(self):
+        """
+        startTimeMillis of the newest snapshot in PostgreSQL, from MongoRecord or waze.data_files.
+        """
+        queries = [('"MongoRecord"', 'SELECT extract(epoch FROM max("MgrcDateStart")) * 1000 FROM "MongoRecord"'),
+                   ('waze.data_files', 'SELECT max(start_time_millis) FROM waze.data_files')]
+        for table, query in queries:
+            if self.engine.execute(text("SELECT to_regclass(:table)"), table=table).scalar() is not None:
+                last = self.engine.execute(text(query)).scalar()
+                if last is not None:
+                    return int(last)
+        return None
+
+    def store_pending(self):
+        """
+        Store every snapshot newer than the last one in PostgreSQL, read with one sorted query and
+        written in batches of batch_size snapshots, one transaction per batch. A batch that conflicts
+        with rows already stored is written again one snapshot at a time.
+        Returns the number of snapshots stored, or None if nothing is stored in PostgreSQL yet.
+        """
+        last = self.last_stored_millis()
+        if last is None:
+            return None
+
+        self.collection.create_index([("startTimeMillis", ASCENDING)])
+        cursor = self.collection.find({"startTimeMillis": {"$gt": last}}, sort=[("startTimeMillis", ASCENDING)],
+                                      batch_size=self.batch_size)
+        stored = 0
+        batch = []
+        for record in cursor:
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                stored += self.store_batch(batch)
+                batch = []
+        if batch:
+            stored += self.store_batch(batch)
+        if stored > 1:
+            print("Caught up", str(stored), "snapshots.")
+        return stored
+
+    def store_batch(self, records):
+        start = timer()
+        try:
+            self.allocations = store_snapshots(self.engine, records, self.df_logr, self.df_trechos,
+                                               self.section_index, self.allocations)
+        except exc.IntegrityError:
+            print("Batch already partially stored, storing its snapshots one by one.")
+            for record in records:
+                self.allocations = store_record(self.meta, record, self.df_logr, self.df_trechos,
+                                                self.section_index, self.allocations)
+        print("Stored", str(len(records)), "snapshots in", str(round(timer() - start, 2)), "s.")
+        return len(records)
+
+    def run(self, interval=60):
+        """
+        Collect a snapshot every "interval" seconds, aligned to the clock, until interrupted.
+        An error in one snapshot is printed and the next one is collected as usual.
+        """
+        while True:
+            start = timer()
+            try:
+                self.collect()
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                print("Snapshot failed:", repr(e))
+            print("Snapshot processed in", str(round(timer() - start, 2)), "s.")
+            time.sleep(interval - (time.time() % interval))
+
+def build_section_index(df_trechos, df_logr):
+    """
+    Spatial index of the sections keyed by the Waze street name (LwsDscWazeStreet): the sections
+    are joined with the street lookup on SECTION_STREET_KEYS. Returns None, and the jams are matched
+    against every section as before, if the key columns are missing or the sections have no CRS.
+    """
+    missing = [k for k in SECTION_STREET_KEYS if k not in df_trechos.columns or k not in df_logr.columns]
+    if missing:
+        print("Warning: no spatial index of the sections, missing key columns:", ", ".join(missing))
+        return None
+    if not getattr(df_trechos, "crs", None):
+        print("Warning: no spatial index of the sections, they have no CRS.")
+        return None
+    sections = (df_trechos.assign(trecho_label=df_trechos.index)
+                          .merge(df_logr[SECTION_STREET_KEYS + ["LwsDscWazeStreet"]], on=SECTION_STREET_KEYS,
+                                 how="inner")
+                          .set_index("trecho_label"))
+    sections = gpd.GeoDataFrame(sections, crs=df_trechos.crs, geometry=df_trechos.geometry.name)
+    return SectionIndex(sections, "LwsDscWazeStreet")
+
+def tabulate_snapshots(records, df_logr, df_trechos, section_index=None, allocations=None):
+    """
+    MongoRecord, Jam and JamPerTrecho rows of a list of snapshots, and the allocations of its jams
+    (keyed by jam uuid and line) to be passed with the next snapshots: jams that did not move are
+    not matched again. The jam tables are None if there is no jam.
+    """
+    raw_data = functions.tabulate_records(records)
+    rawdata_tosql = functions.prep_rawdata_tosql(raw_data)
+
+    #Build dataframe
+    try:
+      df_jams = functions.build_df_jams(raw_data)
+    except exceptions.NoJamError:
+        print("No Jam in the given period")
+        return rawdata_tosql, None, None, {}
+
+    jams_tosql = functions.prep_jams_tosql(df_jams)
+
+    #Build jams_per_trecho
+    df_jams = pd.merge(df_jams, df_logr, left_on="jams_street", right_on="LwsDscWazeStreet", how="left")
+    if allocations is None:
+        allocations = {}
+    new_allocations = {}
+
+    def impacted_trechos(x):
+        if section_index is None:
+            return functions.get_impacted_trechos(x, df_trechos)
+        key = (x["jams_uuid"], json.dumps(x["jams_line"]))
+        if key not in allocations:
+            #Only the sections of the jam's street near its line can be impacted
+            candidates = section_index.candidates(x["LwsDscWazeStreet"], x["jams_line"])
+            allocations[key] = functions.get_impacted_trechos(x, df_trechos.loc[candidates])
+        new_allocations[key] = allocations[key]
+        return allocations[key]
+
+    df_jams['impacted_trechos'] = df_jams.apply(impacted_trechos, axis=1)
+    jams_per_trecho = functions.explode_impacted_trechos(df_jams)
+    jpt_tosql = functions.prep_jpt_tosql(jams_per_trecho)
+
+    return rawdata_tosql, jams_tosql, jpt_tosql, new_allocations
+
+def store_record(meta, record, df_logr, df_trechos, section_index=None, allocations=None):
+    """
+    Store one snapshot, skipping the tables where it is already stored. Returns the jam allocations.
+    """
+    rawdata_tosql, jams_tosql, jpt_tosql, new_allocations = tabulate_snapshots([record], df_logr, df_trechos,
+                                                                              section_index, allocations)
+    #Store Mongo Record info
+    try:
+      rawdata_tosql.to_sql("MongoRecord", con=meta.bind, if_exists="append", index=False)
+    except (exc.IntegrityError):
+        print("MongoRecord already stored")
+
+    if jams_tosql is None:
+        return new_allocations
+
+    #Append jam in "Jam" table
+    try:
+        jams_tosql.to_sql("Jam", con=meta.bind, if_exists="append", index=False, dtype={"JamDscCoordinatesLonLat": typeJSON,                                                                                   "JamDscSegments": typeJSON})
+    except (exc.IntegrityError):
+        print("Jam already stored")
+
+    #Append jams_per_trecho
+    try:
+      jpt_tosql.to_sql("JamPerTrecho", con=meta.bind, if_exists="append", index=False)
+    except (exc.IntegrityError):
+        print("JamPerTrecho already stored")
+
+    return new_allocations
+
+def store_snapshots(engine, records, df_logr, df_trechos, section_index=None, allocations=None):
+    """
+    Store a batch of snapshots in a single transaction. Raises IntegrityError, with nothing stored,
+    if any of them is already stored. Returns the jam allocations.
+    """
+    rawdata_tosql, jams_tosql, jpt_tosql, new_allocations = tabulate_snapshots(records, df_logr, df_trechos,
+                                                                              section_index, allocations)
+    with engine.begin() as con:
+        rawdata_tosql.to_sql("MongoRecord", con=con, if_exists="append", index=False)
+        if jams_tosql is not None:
+            jams_tosql.to_sql("Jam", con=con, if_exists="append", index=False,
+                              dtype={"JamDscCoordinatesLonLat": typeJSON, "JamDscSegments": typeJSON})
+            jpt_tosql.to_sql("JamPerTrecho", con=con, if_exists="append", index=False)
+
+    return new_allocations
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect and store the Waze feed")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep running and collect a snapshot every --interval seconds, instead of once (cron)")
+    parser.add_argument('--interval', type=int, default=60)
+    parser.add_argument('--maxage', type=int, default=3600,
+                        help="Reload the reference data after this many seconds even if it did not change")
+    parser.add_argument('--catchup', action='store_true',
+                        help="Also store the snapshots in MongoDB missing from PostgreSQL, e.g. after an outage")
+    parser.add_argument('--batchsize', type=int, default=60, help="Snapshots per transaction when catching up")
+    args = parser.parse_args()
+
+    uri = os.environ.get("mongo_uri") #change password and include in ENV VARIABLE
+    client = MongoClient(uri)
+    db = client.ccp
+    collection = db.ccp_collection
+
+    collector = Collector(database_dict_from_env(), collection, os.environ.get("waze_url"), args.maxage,
+                          args.catchup, args.batchsize)
+    if args.daemon:
+        collector.run(args.interval)
+    else:
+        collector.collect()
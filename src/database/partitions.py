@@ -0,0 +1,197 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+sys.path.append(project_dir)
+
+import datetime
+import argparse
+
+import dotenv
+from sqlalchemy import text
+
+from src.data.database_func import connect_database, database_dict_from_env
+
+dotenv_path = os.path.join(project_dir, '.env')
+dotenv.load_dotenv(dotenv_path)
+
+#Tables partitioned by month on start_time (the start_time of their data file), and their indexes
+PARTITIONED_TABLES = {"jams": [["start_time"], ["datafile_id"], ["street", "start_time"]],
+                      "alerts": [["start_time"], ["datafile_id"], ["type", "start_time"]],
+                      "irregularities": [["start_time"], ["datafile_id"]],
+                     }
+DATA_FILES_INDEXES = [["start_time"], ["start_time_millis"]]
+
+def month_start(date):
+    return datetime.date(date.year, date.month, 1)
+
+def add_months(date, months):
+    month = date.month - 1 + months
+    return datetime.date(date.year + month // 12, month % 12 + 1, 1)
+
+def partition_name(table, month):
+    return "%s_y%04dm%02d" % (table, month.year, month.month)
+
+def is_partitioned(con, table, schema="waze"):
+    query = text("""SELECT 1 FROM pg_partitioned_table p
+                    JOIN pg_class c ON c.oid = p.partrelid
+                    JOIN pg_namespace n ON n.oid = c.relnamespace
+                    WHERE n.nspname = :schema AND c.relname = :table""")
+    return con.execute(query, schema=schema, table=table).scalar() is not None
+
+def partitions(con, table, schema="waze"):
+    query = text("""SELECT c.relname FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    JOIN pg_class parent ON parent.oid = i.inhparent
+                    JOIN pg_namespace n ON n.oid = parent.relnamespace
+                    WHERE n.nspname = :schema AND parent.relname = :table
+                    ORDER BY c.relname""")
+    return [r[0] for r in con.execute(query, schema=schema, table=table)]
+
+def create_index(con, table, columns, schema="waze"):
+    name = "IDX_" + table + "_" + "_".join(columns)
+    con.execute('CREATE INDEX IF NOT EXISTS "%s" ON "%s"."%s" (%s)'
+                % (name, schema, table, ", ".join('"' + c + '"' for c in columns)))
+
+def create_indexes(con, schema="waze"):
+    """
+    Indexes of the partitioned tables (created on the parent, so every partition gets them)
+    and of waze.data_files.
+    """
+    for table, indexes in PARTITIONED_TABLES.items():
+        for columns in indexes:
+            create_index(con, table, columns, schema)
+    for columns in DATA_FILES_INDEXES:
+        create_index(con, "data_files", columns, schema)
+
+def create_partition(con, table, month, schema="waze"):
+    """
+    Partition of "table" for the month starting at "month". Rows of that month that went to the
+    default partition (because the partition did not exist yet) are moved into it.
+    Returns False if it already exists.
+    """
+    name = partition_name(table, month)
+    if name in partitions(con, table, schema):
+        return False
+
+    params = {"begin": month, "end": add_months(month, 1)}
+    con.execute('CREATE TABLE "%s"."%s" (LIKE "%s"."%s" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+                % (schema, name, schema, table))
+    default = table + "_default"
+    if default in partitions(con, table, schema):
+        con.execute(text("""WITH moved AS (DELETE FROM "%s"."%s" WHERE start_time >= :begin AND start_time < :end
+                                           RETURNING *)
+                            INSERT INTO "%s"."%s" SELECT * FROM moved""" % (schema, default, schema, name)), params)
+    #Partition bounds must be literals
+    con.execute("""ALTER TABLE "%s"."%s" ATTACH PARTITION "%s"."%s" FOR VALUES FROM ('%s') TO ('%s')"""
+                % (schema, table, schema, name, params["begin"].isoformat(), params["end"].isoformat()))
+    return True
+
+def create_partitions_ahead(con, months_ahead=3, today=None, schema="waze"):
+    """
+    Make sure every partitioned table has partitions from the current month to "months_ahead" months
+    later, so that new rows never land in the default partition. Meant to run from cron.
+    """
+    first = month_start(today or datetime.date.today())
+    created = []
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(con, table, schema):
+            continue
+        for i in range(months_ahead + 1):
+            month = add_months(first, i)
+            if create_partition(con, table, month, schema):
+                created.append(partition_name(table, month))
+    return created
+
+def referencing_foreign_keys(con, table, schema="waze"):
+    """
+    (table, constraint) of the foreign keys of other tables that reference "table".
+    """
+    query = text("""SELECT c.relname, con.conname FROM pg_constraint con
+                    JOIN pg_class c ON c.oid = con.conrelid
+                    JOIN pg_class ref ON ref.oid = con.confrelid
+                    JOIN pg_namespace n ON n.oid = ref.relnamespace
+                    WHERE con.contype = 'f' AND n.nspname = :schema AND ref.relname = :table
+                      AND con.conrelid <> con.confrelid""")
+    return [tuple(r) for r in con.execute(query, schema=schema, table=table)]
+
+def count_orphan_rows(con, table, schema="waze"):
+    """
+    Rows of "table" without a data file (NULL datafile_id or one that is not in data_files).
+    """
+    return con.execute('''SELECT count(*) FROM "%s"."%s" t LEFT JOIN "%s"."data_files" d ON d.id = t.datafile_id
+                          WHERE d.id IS NULL''' % (schema, table, schema)).scalar()
+
+def partition_table(con, table, months_ahead=3, drop_old=False, schema="waze"):
+    """
+    Replace an unpartitioned waze table by one range partitioned by month on start_time, copied from
+    the start_time of each row's data file. The primary key becomes (id, start_time); ids are hashes
+    that include the data file start time, so this does not change which rows are unique.
+    Foreign keys of other tables that reference it by id alone (those of waze.coordinates) cannot
+    reference the new primary key, so they are dropped. Rows without a data file would have no
+    start_time, so the migration fails if there are any. The old table is kept as
+    <table>_unpartitioned unless drop_old. Run it inside a transaction.
+    """
+    if is_partitioned(con, table, schema):
+        print(schema + "." + table, "is already partitioned.")
+        return
+
+    orphans = count_orphan_rows(con, table, schema)
+    if orphans:
+        raise Exception("%s.%s has %d rows without a data file; fix them before partitioning it."
+                        % (schema, table, orphans))
+    for referencing, constraint in referencing_foreign_keys(con, table, schema):
+        print("Dropping foreign key", constraint, "of", schema + "." + referencing, "to", schema + "." + table)
+        con.execute('ALTER TABLE "%s"."%s" DROP CONSTRAINT "%s"' % (schema, referencing, constraint))
+
+    old = table + "_unpartitioned"
+    columns = [r[0] for r in con.execute(text("""SELECT column_name FROM information_schema.columns
+                                                 WHERE table_schema = :schema AND table_name = :table
+                                                 ORDER BY ordinal_position"""), schema=schema, table=table)]
+    select_columns = ", ".join('t."' + c + '"' for c in columns if c != "start_time")
+
+    con.execute('ALTER TABLE "%s"."%s" RENAME TO "%s"' % (schema, table, old))
+    con.execute('ALTER INDEX IF EXISTS "%s"."%s_pkey" RENAME TO "%s_pkey"' % (schema, table, old))
+    new_column = ', "start_time" TIMESTAMP' if "start_time" not in columns else ""
+    con.execute('CREATE TABLE "%s"."%s" (LIKE "%s"."%s" INCLUDING DEFAULTS%s) PARTITION BY RANGE (start_time)'
+                % (schema, table, schema, old, new_column))
+    con.execute('ALTER TABLE "%s"."%s" ALTER COLUMN "start_time" SET NOT NULL' % (schema, table))
+    con.execute('ALTER TABLE "%s"."%s" ADD PRIMARY KEY ("id", "start_time")' % (schema, table))
+    con.execute('ALTER TABLE "%s"."%s" ADD FOREIGN KEY ("datafile_id") REFERENCES "%s"."data_files" ("id")'
+                % (schema, table, schema))
+    con.execute('CREATE TABLE "%s"."%s_default" PARTITION OF "%s"."%s" DEFAULT' % (schema, table, schema, table))
+
+    first = con.execute(text('SELECT min(start_time) FROM "%s"."data_files"' % schema)).scalar()
+    month = month_start(first) if first else month_start(datetime.date.today())
+    last = add_months(month_start(datetime.date.today()), months_ahead)
+    while month <= last:
+        create_partition(con, table, month, schema)
+        month = add_months(month, 1)
+
+    column_list = ", ".join('"' + c + '"' for c in columns if c != "start_time")
+    con.execute('''INSERT INTO "%s"."%s" (%s, "start_time")
+                   SELECT %s, COALESCE(d.start_time, to_timestamp(d.start_time_millis / 1000.0) AT TIME ZONE 'UTC')
+                   FROM "%s"."%s" t JOIN "%s"."data_files" d ON d.id = t.datafile_id'''
+                % (schema, table, column_list, select_columns, schema, old, schema))
+    for columns_index in PARTITIONED_TABLES[table]:
+        create_index(con, table, columns_index, schema)
+
+    if drop_old:
+        con.execute('DROP TABLE "%s"."%s"' % (schema, old))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monthly partitions and indexes of the waze tables")
+    parser.add_argument('--partition', action='store_true',
+                        help="Convert waze.jams, alerts and irregularities to partitioned tables (one transaction)")
+    parser.add_argument('--drop', action='store_true', help="With --partition, drop the unpartitioned tables")
+    parser.add_argument('--ahead', type=int, default=3, help="Months of partitions to create ahead of time")
+    args = parser.parse_args()
+
+    meta = connect_database(database_dict_from_env())
+    with meta.bind.begin() as con:
+        if args.partition:
+            for table in PARTITIONED_TABLES:
+                print("Partitioning waze." + table + "...")
+                partition_table(con, table, args.ahead, args.drop)
+        created = create_partitions_ahead(con, args.ahead)
+        create_indexes(con)
+    print("Created partitions:", ", ".join(created) if created else "none")
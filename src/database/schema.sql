@@ -18,9 +18,12 @@ ON waze.data_files USING btree
 (json_hash COLLATE pg_catalog."default")
 TABLESPACE pg_default;
 
+-- waze.jams, waze.alerts and waze.irregularities are partitioned by month on the start_time of their
+-- data file. The monthly partitions and the indexes are created by src/database/partitions.py (run it from
+-- cron), and rows of months without a partition go to the default partition until it is created.
 CREATE TABLE IF NOT EXISTS waze.jams 
 (
-  "id"                              VARCHAR(40) PRIMARY KEY NOT NULL,
+  "id"                              VARCHAR(40) NOT NULL,
   "uuid"                            TEXT NOT NULL,
   "pub_millis"                      BIGINT NOT NULL,
   "pub_utc_date"                    TIMESTAMP,
@@ -38,12 +41,17 @@ CREATE TABLE IF NOT EXISTS waze.jams
   "level"                           INTEGER,
   "blocking_alert_id"               TEXT,
   "line"                            JSONB,
-  "datafile_id"                     BIGINT NOT NULL REFERENCES waze.data_files (id)
-);
+  "line_wkb"                        BYTEA,
+  "datafile_id"                     BIGINT NOT NULL REFERENCES waze.data_files (id),
+  "start_time"                      TIMESTAMP NOT NULL,
+  PRIMARY KEY ("id", "start_time")
+) PARTITION BY RANGE ("start_time");
+
+CREATE TABLE IF NOT EXISTS waze.jams_default PARTITION OF waze.jams DEFAULT;
 
 CREATE TABLE IF NOT EXISTS waze.alerts
 (
-  "id"                              VARCHAR(40) PRIMARY KEY NOT NULL,
+  "id"                              VARCHAR(40) NOT NULL,
   "uuid"                            TEXT NOT NULL, 
   "pub_millis"                      BIGINT NOT NULL,
   "pub_utc_date"                    TIMESTAMP,
@@ -62,12 +70,16 @@ CREATE TABLE IF NOT EXISTS waze.alerts
   "report_by_municipality_user"     BOOLEAN,
   "thumbs_up"                       INTEGER,
   "jam_uuid"                        TEXT,
-  "datafile_id"                     BIGINT NOT NULL REFERENCES waze.data_files (id)
-);
+  "datafile_id"                     BIGINT NOT NULL REFERENCES waze.data_files (id),
+  "start_time"                      TIMESTAMP NOT NULL,
+  PRIMARY KEY ("id", "start_time")
+) PARTITION BY RANGE ("start_time");
+
+CREATE TABLE IF NOT EXISTS waze.alerts_default PARTITION OF waze.alerts DEFAULT;
 
 CREATE TABLE IF NOT EXISTS waze.irregularities
 (
-  "id"                              VARCHAR(40) PRIMARY KEY NOT NULL,
+  "id"                              VARCHAR(40) NOT NULL,
   "uuid"                            TEXT NOT NULL,
   "detection_date_millis"           BIGINT NOT NULL,
   "detection_date"                  TEXT,
@@ -94,19 +106,25 @@ CREATE TABLE IF NOT EXISTS waze.irregularities
   "n_comments"                      INTEGER,
   "n_images"                        INTEGER,
   "line"                            JSONB,
-  "datafile_id"                     BIGINT NOT NULL REFERENCES waze.data_files (id)
-);
+  "line_wkb"                        BYTEA,
+  "datafile_id"                     BIGINT NOT NULL REFERENCES waze.data_files (id),
+  "start_time"                      TIMESTAMP NOT NULL,
+  PRIMARY KEY ("id", "start_time")
+) PARTITION BY RANGE ("start_time");
+
+CREATE TABLE IF NOT EXISTS waze.irregularities_default PARTITION OF waze.irregularities DEFAULT;
 
 
+-- No foreign keys to the partitioned tables, whose primary key is (id, start_time)
 CREATE TABLE IF NOT EXISTS waze.coordinates 
 (
   "id"                              SERIAL PRIMARY KEY NOT NULL,
   "latitude"                        float8 NOT NULL,
   "longitude"                       float8 NOT NULL,
   "order"                           INTEGER NOT NULL,
-  "jam_id"                          VARCHAR(40) REFERENCES waze.jams (id),
-  "irregularity_id"                 VARCHAR(40) REFERENCES waze.irregularities (id),
-  "alert_id"                        VARCHAR(40) REFERENCES waze.alerts (id)
+  "jam_id"                          VARCHAR(40),
+  "irregularity_id"                 VARCHAR(40),
+  "alert_id"                        VARCHAR(40)
 );
 
 CREATE TABLE IF NOT EXISTS waze.roads 
@@ -123,6 +141,42 @@ CREATE TABLE IF NOT EXISTS waze.alert_types
   "subtype"                         TEXT
 );
 
+CREATE TABLE IF NOT EXISTS waze.section_rollups
+(
+  "id_arcgis"                       BIGINT NOT NULL,
+  "date"                            DATE NOT NULL,
+  "hour"                            SMALLINT NOT NULL,
+  "minute_bin"                      TEXT NOT NULL,
+  "LonDirection"                    TEXT NOT NULL,
+  "LatDirection"                    TEXT NOT NULL,
+  "MajorDirection"                  TEXT NOT NULL,
+  "level"                           SMALLINT NOT NULL,
+  "count_jams"                      INTEGER NOT NULL,
+  "length_sum"                      float8 NOT NULL,
+  "length_count"                    INTEGER NOT NULL,
+  "speed_kmh_sum"                   float8 NOT NULL,
+  "speed_kmh_count"                 INTEGER NOT NULL,
+  "delay_sum"                       float8 NOT NULL,
+  "delay_count"                     INTEGER NOT NULL,
+  PRIMARY KEY ("id_arcgis", "date", "hour", "minute_bin", "LonDirection", "LatDirection", "MajorDirection", "level")
+);
+
+CREATE TABLE IF NOT EXISTS waze.rollup_datafiles
+(
+  "datafile_id"                     BIGINT PRIMARY KEY NOT NULL,
+  "date"                            DATE NOT NULL,
+  "hour"                            SMALLINT NOT NULL,
+  "minute_bin"                      TEXT NOT NULL,
+  "jam_levels"                      SMALLINT[] NOT NULL,
+  "allocated_levels"                SMALLINT[] NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS waze.rollup_progress
+(
+  "name"                            TEXT PRIMARY KEY NOT NULL,
+  "date_updated"                    TIMESTAMP
+);
+
 CREATE SCHEMA IF NOT EXISTS geo;
 
 CREATE TABLE IF NOT EXISTS geo.sections
@@ -0,0 +1,32 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.append(project_dir)
+
+import unittest
+import tempfile
+
+from src.data.database_func import connect_database
+
+class TestDatabaseFunc(unittest.TestCase):
+
+    def test_schema_snapshot(self):
+        """
+        1 - The reflected metadata is written to the cache and read back while the schema is unchanged
+        2 - A schema change invalidates it
+        """
+        tmp_dir = tempfile.mkdtemp()
+        database = {"drivername": "sqlite", "database": os.path.join(tmp_dir, "test.sqlite")}
+        cache_dir = os.path.join(tmp_dir, "cache")
+        meta = connect_database(database)
+        meta.bind.execute("CREATE TABLE data_files (id INTEGER PRIMARY KEY, json_hash TEXT)")
+
+        meta = connect_database(database, schemas=[None], cache_dir=cache_dir)
+        self.assertEqual(list(meta.tables), ["data_files"])
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(list(connect_database(database, schemas=[None], cache_dir=cache_dir).tables), ["data_files"])
+
+        meta.bind.execute("CREATE TABLE jams (id TEXT PRIMARY KEY)")
+        meta = connect_database(database, schemas=[None], cache_dir=cache_dir)
+        self.assertEqual(sorted(meta.tables), ["data_files", "jams"])
+        self.assertEqual(meta.tables["jams"].select().execute().fetchall(), [])
@@ -0,0 +1,27 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.append(project_dir)
+
+import unittest
+import json
+
+from src.data.fingerprint import canonical_record
+from src.data.synthetic_waze import generate_feed
+
+class TestFingerprint(unittest.TestCase):
+
+    def test_canonical_record(self):
+        """
+        Data file and child strings are the same as serializing each object with json.dumps
+        """
+        rec = generate_feed(minutes=1, jams=3, alerts=2, irregularities=1, line_length=3)[0]
+        rec["alerts"].append({})
+        rec["irregularities"][0]["rootStartTime"] = 0
+        rec_string, aji_strings = canonical_record(rec)
+
+        self.assertEqual(rec_string, json.dumps(rec, sort_keys=True))
+        for aji_type in ["jams", "alerts", "irregularities"]:
+            expected = [json.dumps(dict(aji, rootStartTime=rec["startTimeMillis"]), sort_keys=True)
+                        for aji in rec[aji_type]]
+            self.assertEqual(aji_strings[aji_type], expected)
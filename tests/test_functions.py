@@ -12,23 +12,52 @@ from io import StringIO
 import pytz
 from sqlalchemy import create_engine, exc, MetaData
 from sqlalchemy.engine.url import URL
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.types import JSON as typeJSON
 import datetime
 import math
+import tempfile
 from bson.objectid import ObjectId
 from pymongo import MongoClient
 from shapely.geometry import Point
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
 
 from src.data.processing_func import (connect_database, collect_records, tabulate_records, json_to_df,
                                 tabulate_jams, lon_lat_to_UTM, UTM_to_lon_lat,
                                 prep_jams_tosql, prep_rawdata_tosql, extract_geo_sections,
-                                prep_section_tosql, store_jps)
+                                prep_section_tosql, store_jps, get_direction, line_directions, time_features,
+                                line_arrays, build_linestrings, df_line_arrays, align_chunks)
 
-from src.data.load_func import (extract_jps)
+from src.data.packed_lines import pack_line
+from src.data.load_func import (extract_jps, extract_jps_page, jps_page_query, extract_jps_aggregated)
+from src.data.get_waze_rawdata import export_collection, read_checkpoint
+from src.data.raw_archive import iter_archive_chunks
+from src.data.database_func import database_dict_from_env
+from src.database.partitions import (partition_table, create_partition, is_partitioned,
+                                     referencing_foreign_keys)
+from src.data.rollup_func import aggregate_jams, timeslots, datafile_levels
+from src.data.jams_cache import evict, write_day, read_day, day_path, cached_days
 
 dotenv_path = os.path.join(project_dir, '.env')
 dotenv.load_dotenv(dotenv_path)
 
+def postgres_version():
+    """
+    Server version of the test database, None if it is not a reachable PostgreSQL database.
+    """
+    try:
+        with create_engine(URL(**database_dict_from_env())).connect() as con:
+            if con.dialect.name == "postgresql":
+                return con.dialect.server_version_info
+    except Exception:
+        pass
+    return None
+
+POSTGRES_VERSION = postgres_version()
+
 class TestProcessingFunc(unittest.TestCase):
     
     def test_collect_records(self):
@@ -201,6 +230,81 @@ class TestProcessingFunc(unittest.TestCase):
         self.assertFalse((test_geo_sections.min_x > test_geo_sections.max_x).any())
         self.assertFalse((test_geo_sections.min_y > test_geo_sections.max_y).any())
 
+    def test_line_directions(self):
+        """
+        1 - Directions match get_direction row by row
+        2 - Missing or empty lines have missing directions
+        """
+        lines = pd.Series([[{"x": 0, "y": 0}, {"x": 1, "y": 2}], [{"x": 0, "y": 0}, {"x": -3, "y": -1}], None, []])
+        df_directions = line_directions(lines)
+
+        for i in [0, 1]:
+            self.assertEqual(df_directions.iloc[i].tolist(), get_direction(lines[i]).tolist())
+        self.assertEqual(df_directions.iloc[0].tolist(), ["East", "North", "North/South"])
+        self.assertTrue(df_directions.iloc[2:].isnull().all().all())
+
+    def test_time_features(self):
+        """
+        1 - Hour, date and bins are in local time
+        2 - Bins follow the bin width
+        """
+        start_time = pd.Series(pd.to_datetime(["2018-06-01 13:14:59", "2018-06-02 02:45:00"]))
+        df_times = time_features(start_time)
+
+        self.assertEqual(df_times["hour"].tolist(), [10, 23])
+        self.assertEqual(df_times["date"].tolist(), [datetime.date(2018, 6, 1)] * 2)
+        self.assertEqual(df_times["minute_bin"].tolist(), ["0 a 14", "45 a 59"])
+        self.assertEqual(df_times["time_slot"].tolist(), [40, 95])
+        self.assertEqual(time_features(start_time, 5)["minute_bin"].tolist(), ["10 a 14", "45 a 49"])
+
+    def test_line_arrays(self):
+        """
+        Lines are unpacked into flat arrays and rebuilt point by point
+        """
+        lines = [[{"x": -48.85, "y": -26.30}, {"x": -48.84, "y": -26.31}],
+                 [{"x": -48.80, "y": -26.20}, {"x": -48.81, "y": -26.21}, {"x": -48.82, "y": -26.20}]]
+        x, y, offsets = line_arrays(lines)
+        linestrings = build_linestrings(x, y, offsets)
+
+        self.assertEqual(offsets.tolist(), [0, 2, 5])
+        self.assertEqual([list(l.coords) for l in linestrings],
+                         [[(p["x"], p["y"]) for p in line] for line in lines])
+
+    def test_build_linestrings_degenerate(self):
+        """
+        Lines without points or with a single point are None, and the other lines keep their positions
+        """
+        lines = [[{"x": 0.0, "y": 0.0}, {"x": 1.0, "y": 1.0}], [], [{"x": 2.0, "y": 2.0}],
+                 [{"x": 3.0, "y": 3.0}, {"x": 4.0, "y": 4.0}], None]
+        linestrings = build_linestrings(*line_arrays(lines))
+
+        self.assertEqual(len(linestrings), len(lines))
+        self.assertEqual(linestrings[1:3], [None, None])
+        self.assertIsNone(linestrings[4])
+        self.assertEqual(list(linestrings[0].coords), [(0.0, 0.0), (1.0, 1.0)])
+        self.assertEqual(list(linestrings[3].coords), [(3.0, 3.0), (4.0, 4.0)])
+
+    def test_df_line_arrays_null_wkb(self):
+        """
+        Rows without line_wkb (stored before it was filled) are read from the JSON line
+        """
+        lines = [[{"x": 0.0, "y": 0.0}, {"x": 1.0, "y": 1.0}],
+                 [{"x": 2.0, "y": 2.0}, {"x": 3.0, "y": 3.0}, {"x": 4.0, "y": 4.0}]]
+        df = pd.DataFrame({"line_wkb": [pack_line(lines[0]), None], "line": [None, lines[1]]})
+        x, y, offsets = df_line_arrays(df)
+
+        self.assertEqual(offsets.tolist(), [0, 2, 5])
+        self.assertEqual(x.tolist(), [0.0, 1.0, 2.0, 3.0, 4.0])
+
+    def test_align_chunks(self):
+        """
+        Rows with the same key are moved to a single chunk, in order
+        """
+        chunks = [pd.DataFrame({"id": [1, 1, 2]}), pd.DataFrame({"id": [2, 2]}), pd.DataFrame({"id": [2, 3, 3]})]
+        aligned = [df["id"].tolist() for df in align_chunks(chunks, lambda df: df["id"])]
+
+        self.assertEqual(aligned, [[1, 1], [2, 2, 2, 2], [3, 3]])
+
 class TestLoadFunc(unittest.TestCase):
     DATABASE = {
         'drivername': os.environ.get("db_drivername"),
@@ -263,4 +367,245 @@ class TestLoadFunc(unittest.TestCase):
         self.assertEqual(df_jps["minute_bin_check"].sum(), 0)
 
 
-    
\ No newline at end of file
+    
+    def test_extract_jps_page(self):
+        """
+        Keyset pages hold the same rows as OFFSET/LIMIT batches, and the last page has no token
+        """
+        date_begin = datetime.date(day=27, month=9, year=2017)
+        date_end = datetime.date(day=28, month=9, year=2017)
+        df_jps = extract_jps(self.meta, date_begin, date_end, weekends=True, limit=None)
+
+        pages = []
+        token = None
+        while True:
+            df_page, token = extract_jps_page(self.meta, date_begin, date_end, after=token, limit=1000, weekends=True)
+            pages.append(df_page)
+            if token is None:
+                break
+
+        self.assertEqual(pd.concat(pages)["JpsId"].dropna().tolist(), df_jps["JpsId"].dropna().tolist())
+
+    def test_jps_page_query(self):
+        """
+        The resume token bounds MgrcDateStart on its own, so the index scan starts at the token
+        """
+        date_begin = datetime.date(day=27, month=9, year=2017)
+        date_end = datetime.date(day=28, month=9, year=2017)
+        token = {"MgrcDateStart": "2017-09-27T18:00:00", "JpsId": 10}
+        query = jps_page_query(self.meta, date_begin, date_end, after=token, limit=1000, weekends=True)
+        sql = str(query.compile(dialect=postgresql.dialect()))
+
+        self.assertRegex(sql, r'AND "MongoRecord"."MgrcDateStart" >= %\(\w+\)s AND \(')
+
+    def test_extract_jps_aggregated(self):
+        """
+        Groups (in local time) and means computed in SQL are the ones computed in pandas
+        """
+        date_begin = datetime.date(day=27, month=9, year=2017)
+        date_end = datetime.date(day=28, month=9, year=2017)
+        df_jps = extract_jps(self.meta, date_begin, date_end, weekends=True, limit=None)
+        df_jps_agg = extract_jps_aggregated(self.meta, date_begin, date_end, weekends=True)
+
+        keys = ["SctnId", "date", "hour", "minute_bin", "LonDirection", "LatDirection"]
+        expected = (df_jps.dropna(subset=["SctnId"])
+                          .assign(minute_bin=lambda df: df["minute_bin"].astype(str),
+                                  LonDirection=lambda df: df["LonDirection"].astype(str),
+                                  LatDirection=lambda df: df["LatDirection"].astype(str))
+                          .groupby(keys)["JamSpdMetersPerSecond"].agg(["mean", "size"]))
+        result = (df_jps_agg.assign(minute_bin=lambda df: df["minute_bin"].astype(str))
+                            .set_index(keys))
+
+        self.assertEqual(len(result), len(expected))
+        pd.testing.assert_series_equal(result["JamSpdMetersPerSecond_mean"].sort_index(),
+                                       expected["mean"].sort_index(), check_names=False)
+        pd.testing.assert_series_equal(result["JamId_count"].sort_index(),
+                                       expected["size"].sort_index(), check_names=False, check_dtype=False)
+
+@unittest.skipIf(mongomock is None, "Needs mongomock")
+class TestGetWazeRawdata(unittest.TestCase):
+
+    def test_export_collection_resume(self):
+        """
+        1 - Every document is exported once, in _id order
+        2 - A second run only exports documents inserted after the checkpoint
+        """
+        collection = mongomock.MongoClient().ccp.ccp_collection
+        collection.insert_many([{"_id": ObjectId(), "startTimeMillis": i} for i in range(7)])
+        out_dir = tempfile.mkdtemp()
+
+        self.assertEqual(export_collection(collection, out_dir, batch_size=3), 7)
+        collection.insert_many([{"_id": ObjectId(), "startTimeMillis": i} for i in range(7, 9)])
+        self.assertEqual(export_collection(collection, out_dir, batch_size=3), 2)
+
+        records = []
+        for _, _, rec_list in iter_archive_chunks(out_dir):
+            records += rec_list
+        self.assertEqual([r["startTimeMillis"] for r in records], list(range(9)))
+        last_id = ObjectId(records[-1]["_id"]["$oid"])
+        self.assertEqual(read_checkpoint(os.path.join(out_dir, "wazerawdata.checkpoint")), (last_id, 9))
+
+@unittest.skipIf(POSTGRES_VERSION is None or POSTGRES_VERSION < (11,), "Needs a PostgreSQL 11 or later database")
+class TestPartitions(unittest.TestCase):
+    SCHEMA = "waze_test_partitions"
+
+    def setUp(self):
+        self.meta = connect_database(database_dict_from_env())
+        with self.meta.bind.begin() as con:
+            con.execute('CREATE SCHEMA "%s"' % self.SCHEMA)
+            con.execute('''CREATE TABLE "%s".data_files (id SERIAL PRIMARY KEY, start_time_millis BIGINT NOT NULL,
+                                                         start_time TIMESTAMP)''' % self.SCHEMA)
+            con.execute('''CREATE TABLE "%s".jams (id VARCHAR(40) PRIMARY KEY, street TEXT,
+                                                   datafile_id BIGINT NOT NULL REFERENCES "%s".data_files (id))'''
+                        % (self.SCHEMA, self.SCHEMA))
+            con.execute('''INSERT INTO "%s".data_files (id, start_time_millis, start_time) VALUES
+                           (1, 1515000000000, '2018-01-03 17:20:00'), (2, 1520000000000, NULL)''' % self.SCHEMA)
+            con.execute('''INSERT INTO "%s".jams VALUES ('a', 'R. Timbó', 1), ('b', 'R. Timbó', 1),
+                                                        ('c', 'R. Blumenau', 2)''' % self.SCHEMA)
+            con.execute('''CREATE TABLE "%s".coordinates (id SERIAL PRIMARY KEY, jam_id VARCHAR(40) REFERENCES "%s".jams (id))'''
+                        % (self.SCHEMA, self.SCHEMA))
+            con.execute('''INSERT INTO "%s".coordinates (jam_id) VALUES ('a')''' % self.SCHEMA)
+
+    def tearDown(self):
+        self.meta.bind.execute('DROP SCHEMA IF EXISTS "%s" CASCADE' % self.SCHEMA)
+
+    def test_partition_table(self):
+        """
+        1 - Rows are copied to the partition of their data file's month
+        2 - Rows in the default partition are moved when their month's partition is created
+        3 - Date range queries only scan the matching partitions
+        """
+        with self.meta.bind.begin() as con:
+            partition_table(con, "jams", months_ahead=0, schema=self.SCHEMA)
+        count = lambda table: self.meta.bind.execute('SELECT count(*) FROM "%s".%s' % (self.SCHEMA, table)).scalar()
+
+        self.assertTrue(is_partitioned(self.meta.bind, "jams", self.SCHEMA))
+        self.assertEqual(count("jams_y2018m01"), 2)
+        self.assertEqual(count("jams_y2018m03"), 1)
+        #The foreign key of coordinates to the old primary key is dropped, its rows are kept
+        self.assertEqual(referencing_foreign_keys(self.meta.bind, "jams_unpartitioned", self.SCHEMA), [])
+        self.assertEqual(count("coordinates"), 1)
+
+        self.meta.bind.execute('''INSERT INTO "%s".jams (id, street, datafile_id, start_time)
+                                  VALUES ('d', 'R. Timbó', 1, '2100-01-01')''' % self.SCHEMA)
+        self.assertEqual(count("jams_default"), 1)
+        with self.meta.bind.begin() as con:
+            create_partition(con, "jams", datetime.date(2100, 1, 1), self.SCHEMA)
+        self.assertEqual(count("jams_default"), 0)
+        self.assertEqual(count("jams_y2100m01"), 1)
+
+        plan = "\n".join(r[0] for r in self.meta.bind.execute(
+            '''EXPLAIN SELECT * FROM "%s".jams WHERE start_time BETWEEN '2018-01-01' AND '2018-01-31' '''
+            % self.SCHEMA))
+        self.assertIn("jams_y2018m01", plan)
+        self.assertNotIn("jams_y2018m03", plan)
+
+    def test_partition_table_orphans(self):
+        """
+        Rows without a data file stop the migration before anything is changed
+        """
+        with self.meta.bind.begin() as con:
+            con.execute('ALTER TABLE "%s".jams DROP CONSTRAINT jams_datafile_id_fkey' % self.SCHEMA)
+            con.execute("""INSERT INTO "%s".jams VALUES ('e', 'R. Timbó', 99)""" % self.SCHEMA)
+        with self.assertRaises(Exception):
+            with self.meta.bind.begin() as con:
+                partition_table(con, "jams", months_ahead=0, schema=self.SCHEMA)
+
+        self.assertFalse(is_partitioned(self.meta.bind, "jams", self.SCHEMA))
+
+class TestRollupFunc(unittest.TestCase):
+    def test_aggregate_jams(self):
+        """
+        1 - Jams are summed per section, time slot, direction and level
+        2 - Null measures are left out of their counts
+        3 - Time slots are in local time
+        """
+        slots = timeslots(pd.Series(pd.to_datetime(["2018-06-01 13:14:00", "2018-06-01 13:16:00"])))
+        self.assertEqual(slots["hour"].tolist(), [10, 10])
+        self.assertEqual(slots["minute_bin"].tolist(), ["0 a 14", "15 a 29"])
+
+        allocated_jams = pd.DataFrame({"id_arcgis": [1.0, 1.0, 2.0], "date": [datetime.date(2018, 6, 1)] * 3,
+                                       "hour": [10, 10, 10], "minute_bin": pd.Categorical(["0 a 14"] * 3),
+                                       "LonDirection": ["Leste"] * 3, "LatDirection": ["Norte"] * 3,
+                                       "MajorDirection": ["Leste"] * 3, "level": [2, 2, 5], "uuid": ["a", "b", "c"],
+                                       "length_jams": [100, 200, None], "speed_kmh": [10.0, 20.0, 0.0],
+                                       "delay": [30, 40, -1]})
+        rollups = aggregate_jams(allocated_jams).set_index("id_arcgis")
+
+        self.assertEqual(rollups.loc[1, "count_jams"], 2)
+        self.assertEqual(rollups.loc[1, "length_sum"], 300)
+        self.assertEqual(rollups.loc[1, "delay_sum"], 70)
+        self.assertEqual(rollups.loc[2, "level"], 5)
+        self.assertEqual(rollups.loc[2, "length_count"], 0)
+        self.assertEqual(rollups.loc[2, "speed_kmh_count"], 1)
+
+        #Jams without a level are kept apart, under level -1
+        allocated_jams.loc[2, "level"] = None
+        self.assertEqual(aggregate_jams(allocated_jams).set_index("id_arcgis").loc[2, "level"], -1)
+
+    def test_datafile_levels(self):
+        """
+        Levels of the jams of each data file, -1 for jams without a level and none for files without jams
+        """
+        df_jams = pd.DataFrame({"datafile_id": [1, 1, 1, 2], "level": [2, None, 2, 5]})
+
+        self.assertEqual(datafile_levels(df_jams, [1, 2, 3]), [[-1, 2], [5], []])
+        self.assertEqual(datafile_levels(df_jams.iloc[:0], [1]), [[]])
+
+class TestJamsCache(unittest.TestCase):
+    def test_evict(self):
+        """
+        The least recently used days are deleted first, until the cache fits
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            os.makedirs(os.path.join(cache_dir, "key"))
+            paths = [os.path.join(cache_dir, "key", "2018-06-0" + str(i) + ".parquet") for i in range(1, 4)]
+            for i, path in enumerate(paths):
+                with open(path, "wb") as f:
+                    f.write(b"0" * 100)
+                os.utime(path, (1000 + i, 1000 + i))
+            os.utime(paths[0], (2000, 2000))
+
+            evict(cache_dir, max_bytes=200)
+
+            self.assertEqual([os.path.exists(path) for path in paths], [True, False, True])
+
+    def test_write_read_day(self):
+        """
+        A day is read back as it was written, with its JSON and packed lines
+        """
+        df = pd.DataFrame({"start_time": pd.to_datetime(["2018-06-01 10:00:00", "2018-06-01 10:02:00"]),
+                           "uuid": ["a", "b"], "level": [2, 5],
+                           "line_wkb": [b"\x01\x02\x00\x00\x00\x00\x00\x00\x00", None],
+                           "line": [None, [{"x": -48.85, "y": -26.3}, {"x": -48.84, "y": -26.31}]]},
+                          index=[5, 7])
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "key", "2018-06-01_2-10.parquet")
+            write_day(path, df)
+            df_read = read_day(path)
+
+        self.assertEqual(df_read.index.tolist(), [0, 1])
+        self.assertEqual(df_read["start_time"].tolist(), df["start_time"].tolist())
+        self.assertEqual(df_read["line_wkb"].tolist(), df["line_wkb"].tolist())
+        self.assertEqual(df_read["line"].tolist(), df["line"].tolist())
+
+    def test_cached_day_refreshed(self):
+        """
+        1 - A cached day is read from the cache while its data files do not change
+        2 - A day that got late data files is fetched again, and its old file is replaced
+        3 - Today is never read from the cache
+        """
+        day = datetime.date(2018, 6, 1)
+        today = datetime.date(2018, 6, 2)
+        df = pd.DataFrame({"uuid": ["a"]})
+        with tempfile.TemporaryDirectory() as cache_dir:
+            write_day(day_path(cache_dir, "key", day, "2-10"), df)
+
+            paths, missing = cached_days(cache_dir, "key", [day, today], {day: "2-10", today: "1-11"}, today)
+            self.assertEqual((list(paths), missing), ([day], [today]))
+
+            paths, missing = cached_days(cache_dir, "key", [day], {day: "3-12"}, today)
+            self.assertEqual((paths, missing), ({}, [day]))
+
+            write_day(day_path(cache_dir, "key", day, "3-12"), df)
+            self.assertEqual(os.listdir(os.path.join(cache_dir, "key")), ["2018-06-01_3-12.parquet"])
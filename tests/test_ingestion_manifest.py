@@ -0,0 +1,33 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.append(project_dir)
+
+import unittest
+import tempfile
+
+from src.data.ingestion_manifest import IngestionManifest
+
+class TestIngestionManifest(unittest.TestCase):
+
+    def test_resume_position(self):
+        """
+        1 - Objects resume at their first missing record
+        2 - Progress survives reopening the manifest
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "manifest.sqlite")
+            manifest = IngestionManifest(path)
+            self.assertEqual(manifest.resume_position("2018/01/01.json"), 0)
+
+            manifest.add_records("2018/01/01.json", [0, 1, 2], ["a", "b", "c"])
+            manifest.add_records("2018/01/01.json", [4], ["e"])
+            manifest.finish("2018/01/02.json", 10)
+            manifest.close()
+
+            manifest = IngestionManifest(path)
+            self.assertEqual(manifest.resume_position("2018/01/01.json"), 3)
+            self.assertEqual(manifest.stored_hashes("2018/01/01.json"), {"a", "b", "c", "e"})
+            self.assertTrue(manifest.is_finished("2018/01/02.json"))
+            self.assertFalse(manifest.is_finished("2018/01/01.json"))
+            manifest.close()
@@ -0,0 +1,33 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.append(project_dir)
+
+import unittest
+import tempfile
+
+from src.data.raw_archive import write_archive_file, read_index, iter_archive_chunks
+from src.data.synthetic_waze import generate_feed
+
+class TestRawArchive(unittest.TestCase):
+
+    def test_archive_round_trip(self):
+        """
+        1 - Records are read back unchanged, in order, with their position in the file
+        2 - Files outside the requested time range are not read
+        """
+        feed = generate_feed(minutes=6, jams=2, alerts=2, irregularities=1, line_length=3)
+        archive_dir = tempfile.mkdtemp()
+        write_archive_file(archive_dir, "wazerawdata_0_to_3.ndjson.gz", feed[:3])
+        write_archive_file(archive_dir, "wazerawdata_3_to_6.ndjson.gz", feed[3:])
+
+        self.assertEqual(read_index(archive_dir)["n_records"].tolist(), [3, 3])
+        chunks = list(iter_archive_chunks(archive_dir, chunksize=2))
+        self.assertEqual([(f, p, len(r)) for f, p, r in chunks],
+                         [("wazerawdata_0_to_3.ndjson.gz", 0, 2), ("wazerawdata_0_to_3.ndjson.gz", 2, 1),
+                          ("wazerawdata_3_to_6.ndjson.gz", 0, 2), ("wazerawdata_3_to_6.ndjson.gz", 2, 1)])
+        self.assertEqual(sum([r for _, _, r in chunks], []), feed)
+
+        time_begin = feed[4]["startTimeMillis"]
+        chunks = list(iter_archive_chunks(archive_dir, time_begin=time_begin))
+        self.assertEqual([(f, p, len(r)) for f, p, r in chunks], [("wazerawdata_3_to_6.ndjson.gz", 1, 2)])
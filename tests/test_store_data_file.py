@@ -0,0 +1,91 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.append(project_dir)
+
+import unittest
+import json
+import hashlib
+import tempfile
+import pandas as pd
+from io import BytesIO, StringIO
+
+from src.data.store_data_file import (iter_json_records, tab_records, tab_jams, tab_alerts, tab_raw_data_chunks,
+                                      LocalDirectorySource)
+from src.data.synthetic_waze import generate_feed
+from src.data.packed_lines import wkb_line_arrays
+
+class TestStoreDataFile(unittest.TestCase):
+
+    def test_iter_json_records(self):
+        """
+        1 - Streamed records are the same as json.loads, whatever the read size
+        2 - A single record is returned as a list of one record
+        """
+        records = [{"startTimeMillis": 1506543420000 + i*60000,
+                    "jams": [{"street": "R. Timbó", "line": [{"x": -48.852581, "y": -26.293511}]}]}
+                   for i in range(5)]
+        file = json.dumps(records, ensure_ascii=False, indent=2).encode()
+
+        for read_size in [1, 7, 2**16]:
+            streamed = list(iter_json_records(BytesIO(file), read_size=read_size))
+            self.assertEqual(streamed, records)
+
+        single = list(iter_json_records(StringIO(json.dumps(records[0]))))
+        self.assertEqual(single, [records[0]])
+        self.assertEqual(list(iter_json_records(StringIO("[]"))), [])
+
+    def test_tab_jams_batch(self):
+        """
+        1 - All jams of all data files are tabulated, indexed by the json_hash of their data file
+        2 - Jam ids are the hash of the jam serialized with its rootStartTime
+        3 - Data files without jams are skipped
+        """
+        jam = {"turnType": "NONE", "delay": 82, "roadType": 1, "street": "R. Alm. Jaceguay", "uuid": 1174570,
+               "line": [{"y": -26.273961, "x": -48.879597}, {"x": -48.878684, "y": -26.273931}],
+               "pubMillis": 1506541721537, "country": "BR", "speed": 4.55277777777778, "length": 743,
+               "type": "NONE", "city": "Joinville"}
+        records = [{"startTime": "2017-09-27 20:17:00:000", "endTime": "2017-09-27 20:18:00:000",
+                    "startTimeMillis": 1506543420000, "endTimeMillis": 1506543480000,
+                    "jams": [jam, dict(jam, level=2, uuid=3246489)]},
+                   {"startTime": "2017-09-27 20:18:00:000", "endTime": "2017-09-27 20:19:00:000",
+                    "startTimeMillis": 1506543480000, "endTimeMillis": 1506543540000,
+                    "alerts": []},
+                   {"startTime": "2017-09-27 20:19:00:000", "endTime": "2017-09-27 20:20:00:000",
+                    "startTimeMillis": 1506543540000, "endTimeMillis": 1506543600000,
+                    "jams": [jam]},
+                  ]
+        raw_data = tab_records("test_key", records)
+        df_jams = tab_jams(raw_data)
+
+        self.assertEqual(df_jams.shape, (3, 17))
+        self.assertEqual(df_jams.index.tolist(), raw_data["json_hash"].iloc[[0, 0, 2]].tolist())
+        self.assertTrue(pd.isnull(df_jams["level"].iloc[0]))
+        self.assertEqual(df_jams["level"].iloc[1], 2)
+        jam_string = json.dumps(dict(jam, rootStartTime=1506543540000), sort_keys=True)
+        self.assertEqual(df_jams["id"].iloc[2], hashlib.sha1(jam_string.encode()).hexdigest())
+        self.assertEqual(df_jams["id"].nunique(), 3)
+        self.assertIsNone(tab_alerts(raw_data))
+
+        packed = tab_jams(raw_data, packed=True)
+        x, y, offsets = wkb_line_arrays(packed["line_wkb"])
+        self.assertEqual(offsets.tolist(), [0, 2, 4, 6])
+        self.assertEqual(list(zip(x[:2], y[:2])), [(p["x"], p["y"]) for p in jam["line"]])
+
+    def test_local_source_closes_files(self):
+        """
+        Files of a LocalDirectorySource are closed once tabulated, even when abandoned half way
+        """
+        with tempfile.TemporaryDirectory() as source_dir:
+            with open(os.path.join(source_dir, "feed.json"), "w") as f:
+                json.dump(generate_feed(seed=1, minutes=3), f)
+            s3object = LocalDirectorySource(source_dir).get_object("feed.json")
+
+            chunks = tab_raw_data_chunks("feed.json", s3object, chunksize=1)
+            next(chunks)
+            chunks.close()
+            self.assertTrue(s3object["Body"].closed)
+
+            s3object = LocalDirectorySource(source_dir).get_object("feed.json")
+            self.assertEqual(sum(len(c) for c in tab_raw_data_chunks("feed.json", s3object)), 3)
+            self.assertTrue(s3object["Body"].closed)
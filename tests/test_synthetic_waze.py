@@ -0,0 +1,20 @@
+import os
+import sys
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.append(project_dir)
+
+import unittest
+
+from src.data.synthetic_waze import generate_feed
+
+class TestSyntheticWaze(unittest.TestCase):
+
+    def test_generate_feed_seed(self):
+        """
+        The same seed generates the same feed, one snapshot per minute
+        """
+        feed = generate_feed(seed=1, minutes=3, jams=5, alerts=5, irregularities=2, line_length=4)
+        self.assertEqual(feed, generate_feed(seed=1, minutes=3, jams=5, alerts=5, irregularities=2, line_length=4))
+        self.assertNotEqual(feed, generate_feed(seed=2, minutes=3, jams=5, alerts=5, irregularities=2, line_length=4))
+        self.assertEqual([rec["endTimeMillis"] - rec["startTimeMillis"] for rec in feed], [60000]*3)
+        self.assertEqual(feed[1]["startTimeMillis"] - feed[0]["startTimeMillis"], 60000)